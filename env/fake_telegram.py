@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the Telegram Bot API, to test the Telegram bridge without Telegram.
+# Point the bots to it in config/telegram.cfg:
+#   api_url="http://127.0.0.1:8081/bot"
+# then start it before the agent:
+#   $ python3 fake_telegram.py --port 8081
+#
+# Bot API calls (/bot<token>/<method>) are answered like Telegram does for the methods the
+# bridge uses, the messages the bots send are recorded. A test plays the user through the
+# control endpoints:
+#   POST /control/message {"token": "...", "chat_id": 1, "text": "hi"}
+#       a user message to the bot, pushed to its webhook if one is set, otherwise queued
+#       for getUpdates
+#   GET  /control/sent?token=...&clear=1
+#       the messages the bot sent, clear=1 empties the record
+
+import argparse
+import email.parser
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+lock = threading.Condition()
+webhooks = {}       # token -> (url, secret)
+updates = {}        # token -> updates waiting for getUpdates
+sent = {}           # token -> messages sent by the bot
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+# bot_id:
+# the bot id is the number before the colon of the token, like Telegram's
+def bot_id(token):
+    head = token.split(":", 1)[0]
+    return int(head) if head.isdigit() else abs(hash(token)) % 10**9
+
+
+# parse_params:
+# Bot API parameters come as a query string, a form, JSON or a multipart form (files),
+# values that look like JSON (numbers, objects) are decoded
+def parse_params(handler, body):
+    params = {}
+    content_type = handler.headers.get("Content-Type", "")
+    query = urllib.parse.urlsplit(handler.path).query
+    pairs = urllib.parse.parse_qsl(query)
+    if content_type.startswith("application/json") and body:
+        params.update(json.loads(body))
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        pairs += urllib.parse.parse_qsl(body.decode())
+    elif content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            filename = part.get_filename()
+            if filename:
+                params[name] = {"filename": filename, "size": len(part.get_payload(decode=True))}
+            else:
+                pairs.append((name, part.get_payload(decode=True).decode()))
+    for key, value in pairs:
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+# new_message:
+# a message dict like the Bot API returns
+def new_message(chat_id, text=None, sender=None):
+    message = {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+    }
+    if sender:
+        message["from"] = sender
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return message
+
+
+# push_update:
+# give a user message to a bot, by webhook or getUpdates
+def push_update(token, chat_id, text):
+    sender = {"id": chat_id if chat_id > 0 else 1, "is_bot": False, "first_name": "Tester"}
+    update = {"update_id": next(update_ids), "message": new_message(chat_id, text, sender)}
+    with lock:
+        webhook = webhooks.get(token)
+        if not webhook:
+            updates.setdefault(token, []).append(update)
+            lock.notify_all()
+            return update
+    url, secret = webhook
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                     headers={"Content-Type": "application/json"})
+    if secret:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    urllib.request.urlopen(request, timeout=10).read()
+    return update
+
+
+# bot_api:
+# answer one Bot API method
+def bot_api(token, method, params):
+    me = {"id": bot_id(token), "is_bot": True, "first_name": "Fake", "username": f"fake_{bot_id(token)}_bot"}
+    match method.lower():
+        case "getme":
+            return me
+        case "setwebhook":
+            with lock:
+                webhooks[token] = (params["url"], params.get("secret_token"))
+                if params.get("drop_pending_updates"):
+                    updates.pop(token, None)
+            return True
+        case "deletewebhook":
+            with lock:
+                webhooks.pop(token, None)
+                if params.get("drop_pending_updates"):
+                    updates.pop(token, None)
+            return True
+        case "getwebhookinfo":
+            url = webhooks.get(token, ("", None))[0]
+            return {"url": url, "has_custom_certificate": False, "pending_update_count": 0}
+        case "getupdates":
+            offset = int(params.get("offset", 0) or 0)
+            deadline = time.time() + min(float(params.get("timeout", 0) or 0), 10)
+            with lock:
+                while True:
+                    queue = [u for u in updates.get(token, []) if u["update_id"] >= offset]
+                    updates[token] = queue
+                    if queue or time.time() >= deadline:
+                        return queue
+                    lock.wait(deadline - time.time())
+        case "sendmessage" | "senddocument" | "sendphoto":
+            chat_id = int(params["chat_id"])
+            message = new_message(chat_id, params.get("text"), me)
+            if "document" in params or "photo" in params:
+                message["caption"] = params.get("caption", "")
+                message["document"] = {"file_id": f"file{message['message_id']}",
+                                       "file_unique_id": f"u{message['message_id']}",
+                                       "file_name": str(params.get("document", {}).get("filename", ""))}
+            with lock:
+                sent.setdefault(token, []).append({"method": method, **params})
+            return message
+        case _:
+            # deleteMessage, sendChatAction, setMyCommands and the like
+            with lock:
+                sent.setdefault(token, []).append({"method": method, **params})
+            return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        path = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        try:
+            params = parse_params(self, body)
+            if path[0] == "control" and len(path) == 2:
+                if path[1] == "message":
+                    update = push_update(params["token"], int(params["chat_id"]), params["text"])
+                    return self.reply(200, {"ok": True, "result": update})
+                if path[1] == "sent":
+                    with lock:
+                        result = list(sent.get(params["token"], []))
+                        if params.get("clear"):
+                            sent.pop(params["token"], None)
+                    return self.reply(200, {"ok": True, "result": result})
+            if path[0].startswith("bot") and len(path) == 2:
+                return self.reply(200, {"ok": True, "result": bot_api(path[0][3:], path[1], params)})
+            self.reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+        except Exception as e:
+            self.reply(400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"})
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+
+# serve:
+# start the server in a daemon thread and return it, for tests in the same process
+def serve(host="127.0.0.1", port=8081):
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    print(f"Fake Telegram Bot API on http://{args.host}:{args.port}/bot<token>/<method>")
+    ThreadingHTTPServer((args.host, args.port), Handler).serve_forever()
@@ -24,8 +24,8 @@ Author: [Your Name or Placeholder]
 Date: [Current Date or Placeholder]
 """
 import re
-import copy
 import time
+import asyncio
 import os
 import json
 import html
@@ -34,75 +34,74 @@ import general as gen
 import global_cfg as glb
 import tools
 import ai
+import memory
+import cascade
+import config
+import session
+import startup
+import toolset
+startup.mark("agent imports")
 
 # =======================================================================================
 # Initialize global variables and configurations
 # =======================================================================================
 # setup all tools
 tools.load_all_tools()
-tool_def = ""
-tool_brief = ""
-tool_list = []
-current_tools = []
-tool_handler_map = {}
-for name, value in tools.tools.items():
-    brief = value['prompt']['brief']
-    rule = value['prompt']['rule']
-    tool_brief += f"<tool name=\"{name}\"><brief>{brief}</brief></tool>\n"
-    tool_def += f"<tool name=\"{name}\"><brief>{brief}</brief><rule>{rule}</rule></tool>\n"
-    tool_list.append(value['definition'])
-    tool_handler_map.update({name: value['handler']})
+# the definitions, prompt fragments and token costs of the tools are compiled once
+toolset.toolset_compile(tools.tools)
+tool_list = toolset.toolset_definitions(tools.tools)
+tool_handler_map = {name: value['handler'] for name, value in tools.tools.items()}
+tool_def = toolset.toolset_prompt(tools.tools)
+tool_brief = toolset.toolset_brief(tools.tools)
+# the most tools offered to grok in a turn, the router ranks them
+tool_subset_max = 3
 
-# setup agent configuration
-agent_cfg = gen.get_cfg(f"agent")
+startup.mark("tools")
 
-system_prompt = agent_cfg["system"]
-system_prompt = system_prompt.replace("<OS_TYPE/>", glb.os_type)
-system_prompt = system_prompt.replace("<USER_NAME/>", glb.username)
-system_prompt = system_prompt.replace("<MEMORY/>", glb.memories)
-system_prompt = system_prompt.replace("<SANDBOX_PATH/>", glb.sandbox)
-system_prompt = system_prompt.replace("<TOOLS_DEF/>", tool_def)
-agent_cfg["system"] = system_prompt
-gen.message_init(system_prompt)
+# agent_cfg_load:
+# setup agent configuration from agent.cfg, at startup and whenever the file changes, the
+# next request of every session uses the new models and prompts
+def agent_cfg_load(cfg):
+    global agent_cfg
+    new_cfg = dict(cfg)
+    new_cfg["model"] = dict(cfg["model"])
+    # <MEMORY/> is kept as a placeholder, it's filled per turn with the memories relevant to
+    # the user input, see build_system_prompt
+    system_prompt = new_cfg["system"]
+    system_prompt = system_prompt.replace("<OS_TYPE/>", glb.os_type)
+    system_prompt = system_prompt.replace("<USER_NAME/>", glb.username)
+    system_prompt = system_prompt.replace("<SANDBOX_PATH/>", glb.sandbox)
+    # <TOOLS_DEF/> is kept as a placeholder too, it's filled with the tools offered in the
+    # turn, see build_system_prompt
+    new_cfg["system"] = system_prompt
+    gen.message_init(system_prompt.replace("<TOOLS_DEF/>", tool_def)
+                     .replace("<MEMORY/>", "No relevant previous conversation."))
 
-tool_router_prompt = agent_cfg["toolRouter"]
-tool_router_prompt = tool_router_prompt.replace("<TOOLS_BRIEF/>", f"<tools>{tool_brief}</tools>")
-agent_cfg["toolRouter"] = tool_router_prompt
+    tool_router_prompt = new_cfg["toolRouter"]
+    tool_router_prompt = tool_router_prompt.replace("<TOOLS_BRIEF/>", f"<tools>{tool_brief}</tools>")
+    new_cfg["toolRouter"] = tool_router_prompt
+    toolset.toolset_section("system prompt", system_prompt.replace("<TOOLS_DEF/>", "").replace("<MEMORY/>", ""))
+    toolset.toolset_section("system prompt <TOOLS_DEF/>", tool_def)
+    toolset.toolset_section("tool router", tool_router_prompt)
+    agent_cfg = new_cfg
+
+agent_cfg_load(config.config_get("agent"))
+config.config_watch("agent", agent_cfg_load)
+
+startup.mark("system prompt")
 
 # setup ai
 ai.load_all_components()
+startup.mark("ai")
 
 # =======================================================================================
 # functions for agent operation
 # =======================================================================================
-# __get_grok_input_from_file:
-# get input from fcomm file, with start flag, and clear the file after reading
-def __get_grok_input_from_file():
-    gen.grok_end()
-    gen.daemon_pause = 0
-    while True:
-        for filename in glb.grok_fcomm_in_table:
-            if not os.path.isfile(filename):
-                continue
-            with open(filename, 'r') as f:
-                fcomm_rx = f.read()
-            # find start flag in the file, if found, clear the file and return 
-            # the content after the start flag as user input
-            if fcomm_rx.find(glb.grok_fcomm_start) >= 0:
-                open(filename, 'w').write('')
-                gen.daemon_pause = 1
-                if filename == glb.grok_fcomm_in_tele:
-                    glb.grok_fcomm_in_src = 1
-                elif filename == glb.grok_fcomm_in:
-                    glb.grok_fcomm_in_src = 0
-                return fcomm_rx.replace(glb.grok_fcomm_start, '').strip()
-        time.sleep(0.1)
-
 # __print_agent_tool:
 # print the tool command and grok's thought, and ask for confirm if needed
 # use lite formatting for reply in mobile terminal like Telegram
 def __print_agent_tool(think, command):
-    if not glb.grok_fcomm_remote():
+    if not session.session_current()["remote"]:
         print_content = f"\n{"="*60}\n"
         if think:
             print_content += f"Grok's thought: {think}"\
@@ -113,39 +112,59 @@ def __print_agent_tool(think, command):
                         f"{'='*60}"
         gen.myprint(print_content)
     else:
-        if len(think) > 300:
-            gen.myprint(f"<grok_tele_file name=\"grok_thought.txt\">{think}</grok_tele_file>\n")
-        else:
-            gen.myprint(f"Grok's thought: {think}\n")
+        # the Telegram bridge streams the output, only an oversized final message becomes a file
+        gen.myprint(f"Grok's thought: {think}\n")
         gen.myprint(f"COMMAND TO EXECUTE:\n{command}")
     if glb.confirm_need:
         gen.myprint("Execute? (y/no and reasons): ", end="", flush=True)
 
+# session_tools:
+# the tool definitions the current session may use, the bot profile can limit them
+def session_tools():
+    allowed = session.session_current()["profile"]["tools"]
+    if allowed is None:
+        return tool_list
+    return [tool for tool in tool_list if tool["function"]["name"] in allowed]
+
+# session_models:
+# the model of each cascade route for the current session, the bot profile can override them
+def session_models():
+    return dict(agent_cfg["model"], **session.session_current()["profile"]["models"])
+
 # print_welcome:
 # print welcome info and instructions for user
 def print_welcome():
     gen.myprint(gen.command_description)
 
-# get_user_input:
-# get user input from terminal or file, with grok_use_fileio switch
-def get_user_input():
-    if glb.grok_use_fileio:
-        user_input = __get_grok_input_from_file() 
-    else:
-        user_input = input()
-    print(f"User input: {user_input}")
-    return user_input
+# __route_tools:
+# the tools named in the reply of the router, in the order it names them (most relevant
+# first), at most tool_subset_max of them, all offered tools when it names none
+def __route_tools(aux_reply, offered):
+    ranked = []
+    for tool in offered:
+        position = aux_reply.find(tool["function"]["name"])
+        if position >= 0:
+            ranked.append((position, tool))
+    if not ranked:
+        return offered
+    ranked.sort(key=lambda item: item[0])
+    return [tool for _, tool in ranked[:tool_subset_max]]
 
 # tool_router:
-# route the tool call to corresponding tool handler based on tool name
+# ask the auxiliary model whether the user input needs tools and which ones, only the
+# ranked subset it names is offered to grok in this turn, and only those tools are
+# described in <TOOLS_DEF/> of the system prompt, so the prompt does not grow with the
+# number of registered tools
 def tool_router(user_input):
     if not gen.tool_enable_flag:
         return 0
-    global current_tools
+    current = session.session_current()
+    if not session_tools():
+        return 0
     time1 = time.time()
     aux_reply = ai.func(func="chat",
                         mode = 'aux',
-                        model=agent_cfg["model"]["aux"],
+                        model=session_models()["aux"],
                         messages=[
                             {"role": "user", "content": agent_cfg["toolRouter"]}, 
                             {"role": "user", "content": user_input}
@@ -155,12 +174,14 @@ def tool_router(user_input):
     time_elapsed = time.time() - time1
     gen.debug_out(f"Tool router auxiliary model latency: {time_elapsed:.2f} seconds")
     gen.debug_out(f"Tool router auxiliary model reply: {aux_reply}")
-    if aux_reply.strip().lower().find("yes") >= 0:
-        gen.tool_used_last_time = 1
-        current_tools = tool_list
+    aux_reply = aux_reply.strip().lower()
+    if aux_reply.find("yes") >= 0:
+        current["tool_used_last_time"] = 1
+        current["current_tools"] = __route_tools(aux_reply, session_tools())
+        gen.debug_out(f"Tool router offers: {toolset.toolset_names(current['current_tools'])}")
     else:
-        gen.tool_used_last_time = 0
-        current_tools = []
+        current["tool_used_last_time"] = 0
+        current["current_tools"] = []
         return 0
     
 # preprocess_user_input:
@@ -182,22 +203,43 @@ def preprocess_user_input(user_input):
     else:
         # use another model to judge whether the user wants to use tools.
         tool_router(user_input)
-        # save user input to conversation, and save_message for potential saving to mem file
-        gen.messages.append({"role":"user", "content": user_input})
-        gen.save_message.append(f"<user>{user_input}</user>\n")
-        gen.debug_json_out({"role":"user", "content": user_input})
+        # save user input to conversation, it's kept for potential saving to memory store too
+        record = session.session_current()["conversation"].add("user", user_input, kind="user")
+        gen.debug_json_out(record.message())
     return continue_flag
 
+# build_system_prompt:
+# fill the <MEMORY/> section with the saved turns nearest to the user input (keyword and
+# semantic search), instead of the whole memory, so the prompt size does not grow with
+# the memory store, the memories are kept in the session for the tool calls of the same
+# user input, and the <TOOLS_DEF/> section with the tools offered in this turn
+def build_system_prompt(user_input):
+    current = session.session_current()
+    if user_input != current["memory_query"]:
+        current["memory_query"] = user_input
+        current["memory_text"] = memory.memory_retrieve(user_input)
+    names = toolset.toolset_names(current["current_tools"])
+    current["memory_prompt"] = agent_cfg["system"]\
+        .replace("<TOOLS_DEF/>", toolset.toolset_prompt(names) or "No tools in this turn.")\
+        .replace("<MEMORY/>", current["memory_text"])
+    return current["memory_prompt"]
+
 # get_tool_confirm_info:
-# if confirm_need is set, get confirm info from user or file,
-# otherwise return default confirm info
-def get_tool_confirm_info():
+# if confirm_need is set, wait for the next input from the user, the runtime resolves
+# the confirm_future of the session with it, otherwise return default confirm info
+async def get_tool_confirm_info():
+    current = session.session_current()
     confirm = "yes, do it now"
     if glb.confirm_need:
-        if glb.grok_use_fileio:
-            confirm_info = __get_grok_input_from_file() 
-        else:
-            confirm_info = input()
+        # the reply ends here, the output is written and the end flag lets the CLI wrapper
+        # and the Telegram stream stop waiting, so the user can answer
+        gen.grok_end()
+        current["confirm_future"] = asyncio.get_running_loop().create_future()
+        try:
+            confirm_info = await current["confirm_future"]
+        finally:
+            current["confirm_future"] = None
+        gen.grok_resume()
         if not confirm_info or confirm_info.startswith(" "):
             confirm_info = confirm
         else:
@@ -214,7 +256,7 @@ def compress_chat():
 # tool_preprocess:
 # preprocess the tool call from grok, print the command and thought, and ask for confirm if needed
 # return the confirm info and the command to execute
-def tool_preprocess(reply: dict, index=0):
+async def tool_preprocess(reply: dict, index=0):
     try:
         tool_call = reply["tool_calls"][index]
         tool_name = tool_call["function"]["name"]
@@ -224,11 +266,12 @@ def tool_preprocess(reply: dict, index=0):
         # DECODE HTML entities if Grok accidentally encodes them in the command, which should be executed
         # as raw syntax
         agent_cmd = html.unescape(agent_cmd)
-        # save the tool command and thought to save_message for potential saving to mem file, with some
-        #  formatting for future use
-        gen.save_message.append(f"<assistant>tool={tool_name}, think={agent_think}, cmd=\n{agent_cmd}\n</assistant>\n")
+        # save the tool command and thought for potential saving to memory store
+        session.session_current()["conversation"].note("assistant", "tool_call",
+                                                        f"think={agent_think}, cmd=\n{agent_cmd}",
+                                                        tool=tool_name)
         __print_agent_tool(agent_think, agent_cmd)
-        confirm_info = get_tool_confirm_info()
+        confirm_info = await get_tool_confirm_info()
     except Exception as e:
         gen.myprint(f"Error in tool_preprocess: {e}")
         agent_think = reply["reasoning"]
@@ -237,71 +280,131 @@ def tool_preprocess(reply: dict, index=0):
     return confirm_info, agent_cmd
 
 # tool_handle:
-# handle the tool calls from grok, currently only print the command and thought, and ask for confirm,
-# then execute the command and return the result to grok, more tools can be added in the future
-def tool_handle(reply):
+# handle the tool calls from grok, print the command and thought, and ask for confirm,
+# then execute the command in a worker thread and return the result to grok
+async def tool_handle(reply):
+    current = session.session_current()
+    allowed = {tool["function"]["name"] for tool in session_tools()}
     for index, tool_call in enumerate(reply["tool_calls"]):
-        tool_handle = tool_handler_map.get(tool_call["function"]["name"])
+        # a bot profile may not offer every tool, the calls of other tools have no handler
+        tool_handle = None
+        if tool_call["function"]["name"] in allowed:
+            tool_handle = tool_handler_map.get(tool_call["function"]["name"])
+        command = None
         if tool_handle:
-            confirm_info, agent_cmd = tool_preprocess(reply, index)
+            confirm_info, agent_cmd = await tool_preprocess(reply, index)
             if confirm_info.startswith("y"):
-                gen.tool_result = tool_handle(agent_cmd)
+                current["tool_result"] = await asyncio.to_thread(tool_handle, agent_cmd)
+                command = agent_cmd
             else:
-                gen.tool_result = f"Tool execution rejected by user, confirm_info: {confirm_info}"
+                current["tool_result"] = f"Tool execution rejected by user, confirm_info: {confirm_info}"
         else:
-            gen.tool_result = f"ERROR: no handler for tool {tool_call['function']['name']}."
-        if glb.grok_fcomm_remote() and len(gen.tool_result) > 300:
-            gen.myprint(f"<grok_tele_file name=\"grok_tool_result.txt\">{gen.tool_result}</grok_tele_file>\n")
+            current["tool_result"] = f"ERROR: no handler for tool {tool_call['function']['name']}."
+        gen.myprint(current["tool_result"])
+        # the result is sent to grok and kept for the memory store, the result of a command
+        # that ran before is sent as a reference or a diff when it did not change much, only
+        # to vendors that get the whole conversation, the others never saw the earlier result
+        if command is None or not ai.capability("full_history", False):
+            record = current["conversation"].add("tool", current["tool_result"], kind="tool_result",
+                                                 tool=tool_call["function"]["name"],
+                                                 tool_call_id=tool_call["id"])
         else:
-            gen.myprint(gen.tool_result)
-        gen.save_message.append(f"<tool_result>{gen.tool_result}</tool_result>\n")
-        new_message = {"role": "tool", "tool_call_id": tool_call["id"], "content": gen.tool_result}
-        gen.messages.append(new_message)
-        gen.debug_json_out(new_message)
+            record = current["conversation"].add_tool_result(tool_call["function"]["name"], command,
+                                                             current["tool_result"], tool_call["id"])
+        gen.debug_json_out(record.message())
         gen.grok_done()
 
+# __close_tool_calls:
+# a cancelled turn may leave tool calls without result, which the vendor API rejects,
+# answer them as cancelled
+def __close_tool_calls():
+    session.session_current()["conversation"].close_tool_calls("Tool call cancelled by a new user input.")
+
 # chat handle:
 # handle the normal chat reply from grok, save the content to conversation and print it,
 # with some formatting for potential future use
 def chat_handle(reply):
-    gen.save_message.append(f"<assistant>{reply["content"]}</assistant>\n")
+    current = session.session_current()
+    current["conversation"].note("assistant", "assistant", reply["content"])
     print_content = reply["content"].rstrip("\n$")
-    if not glb.grok_fcomm_remote():
+    if not current["remote"]:
         gen.myprint(f"{'-'*60}\nGrok: {print_content}", end=f'\n{'-'*60}\n$ ')
     else:
         gen.myprint(f"{print_content}\n$ ")
     gen.grok_done()
 
 # grok_chat:
-# make a chat request to grok, with current messages and tools
+# make a chat request to grok, with current messages and tools, save the reply to the
+# conversation and return it
 def grok_chat():
     # try:
+    current = session.session_current()
+    conversation = current["conversation"]
+    current_tools = current["current_tools"]
     tool_choice = "auto" if current_tools else "none"
     temperature = 0.2 if current_tools else 0.7
     gen.debug_out(f"Grok is thinking, temperature={temperature}, tool_choice={tool_choice}...")
+    # inject only the memories nearest to the latest user input
+    user_message = conversation.last_user()
+    if user_message:
+        conversation.system.content = build_system_prompt(user_message)
+    # send the turn to the cheapest adequate model, escalate when the reply is not usable
+    route = cascade.route_select(user_message, current_tools)
     time1 = time.time()
-    main_reply = ai.func(func="chat",
-                        mode = 'main',
-                        model=agent_cfg["model"]["main"],
-                        messages=gen.messages,
-                        tools=current_tools,
-                        tool_choice=tool_choice,
-                        temperature=temperature,)
+    main_reply, route = cascade.cascade_chat(route, session_models(),
+                                             messages=conversation.view(),
+                                             tools=current_tools,
+                                             tool_choice=tool_choice,
+                                             temperature=temperature,)
     time_elapsed = time.time() - time1
-    gen.debug_out(f"Grok response latency: {time_elapsed:.2f} seconds")
+    gen.debug_out(f"Grok response latency: {time_elapsed:.2f} seconds, route={route}")
     gen.debug_out('Grok made a repy:')
 
-    gen.messages.append({
-            "role": "assistant", 
-            "content": main_reply["content"],
-            "tool_calls": main_reply["tool_calls"]
-        })
-            
-    # if the reply contains tool calls, handle them first, then send the result back to 
-    # grok and get the next reply, until no more tool calls
-    if main_reply["tool_calls"]:
-        gen.tool_used_last_time = 1
-        tool_handle(main_reply)
-    elif main_reply["content"]:
-        chat_handle(main_reply)
-    return
+    conversation.add("assistant", main_reply["content"], tool_calls=main_reply["tool_calls"])
+    return main_reply
+
+# agent_turn:
+# handle one user input: controller commands, or a chat with grok, the reply may contain
+# tool calls, if so, handle the tool calls first, then send the result back to grok and
+# get the next reply, until no more tool calls.
+# blocking calls run in worker threads, so the runtime can cancel the turn at any await
+# when a new input pre-empts it
+async def agent_turn(user_input):
+    current = session.session_current()
+    current["current_tools"] = []
+    gen.debug_out(f"User input: {user_input}")
+    if current["initial"] == 1:
+        # a reset outside a turn, like the /r command of a Telegram chat, the conversation
+        # is reset already, only the welcome info is left, before the input is recorded
+        current["initial"] = 0
+        print_welcome()
+    # when user input starts with "/", it is a command for the python controller,
+    # not a normal conversation input, so handle the command only
+    continue_flag = await asyncio.to_thread(preprocess_user_input, user_input)
+    if current["initial"] == 1:
+        gen.debug_out("SYS: Session reset, print welcome info and set initial conversation.")
+        # the input reset the session (reset_session reset the conversation), print welcome
+        # info and let grok start the hello message and self-introduction
+        current["initial"] = 0
+        print_welcome()
+    elif continue_flag:
+        return
+    # the tools the router picked for this turn, they are offered again after a tool call
+    turn_tools = current["current_tools"]
+    try:
+        while True:
+            current["tool_used_last_time"] = 0
+            main_reply = await asyncio.to_thread(grok_chat)
+            if main_reply["tool_calls"]:
+                current["tool_used_last_time"] = 1
+                await tool_handle(main_reply)
+            elif main_reply["content"]:
+                chat_handle(main_reply)
+            if not current["tool_used_last_time"]:
+                break
+            gen.debug_out("SYS: Agent used tools last time, let it decide to use tools or not once again.")
+            # the agent used tool last time, let it decide to use tools or not once again
+            current["current_tools"] = turn_tools or session_tools()
+    except asyncio.CancelledError:
+        __close_tool_calls()
+        raise
@@ -20,8 +20,11 @@ components = {
         'chat': chat_function,
         'reset': reset_function,
         'init': init_function,
+        'full_history': False,
     },
 }
+full_history: whether every request sends the whole conversation, otherwise only the
+latest message is sent and the vendor keeps the history
 """
 components = {}
 
@@ -33,7 +36,11 @@ def load_components(components_dir: str) -> dict:
     if str(components_path.parent) not in sys.path:
         sys.path.insert(0, str(components_path.parent))
 
+    # only the module of the selected vendor is imported, the SDKs of the others are not
+    # loaded at all
     for finder, module_name, _ in pkgutil.iter_modules([str(components_path)]):
+        if module_name != glb.ai_vendor:
+            continue
         full_module_name = f"{components_path.name}.{module_name}"
         # try:
         module = importlib.import_module(full_module_name)
@@ -56,6 +63,11 @@ def func(func: str, **kwargs):
         return
     return components[name][func](**kwargs)
 
+# capability:
+# a capability of the selected vendor, like full_history, default when it does not say
+def capability(name: str, default=None):
+    return components.get(glb.ai_vendor, {}).get(name, default)
+
 def load_all_components():
     load_components(f"{glb.workspace}/src/ai")
     return
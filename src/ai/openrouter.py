@@ -99,4 +99,6 @@ def ai_register():
         "chat": chat,
         "init": init,
         "reset": reset,
+        # every request sends the whole conversation
+        "full_history": True,
     }
@@ -9,6 +9,7 @@ from xai_sdk.tools import x_search
 
 import global_cfg as glb
 import general as gen
+import toolset
 
 if glb.ai_vendor == 'xai':
     if not os.path.isfile(glb.xai_token_file):
@@ -31,10 +32,14 @@ default_tools = [
    web_search(), 
    # x_search(),
 ]
-# converted from openai format
-converted_tools = []
-# if there are tools, use default_tools + converted_tools, if not, just use default_tools
-current_tools = None
+# __convert_tool:
+# convert a tool definition from openai format to xAI format
+def __convert_tool(single_tool):
+    return tool(
+        name=single_tool["function"]["name"],
+        description=single_tool["function"]["description"],
+        parameters=single_tool["function"]["parameters"]
+       )
 
 previous_response_id = None
 
@@ -43,7 +48,9 @@ chat_history = []
 def chat(*args, **kwargs) -> str:
     if glb.ai_vendor != 'xai':
         return "ERROR: xAI client not initialize."
-    global current_tools
+    # the tools are per call, sessions may chat at the same time with different tools
+    # if there are tools, use default_tools + converted_tools, if not, just use default_tools
+    current_tools = None
     model = "grok-4-1-fast-reasoning"
     messages = None
     tools = None
@@ -53,23 +60,19 @@ def chat(*args, **kwargs) -> str:
     for x, v in kwargs.items():
         match x:
             case "model":
-                if v.startswith("grok"):
-                    model = v
-                # else may be openrouter format, ignore the prefix
+                # may be openrouter format like x-ai/grok-code-fast-1, ignore the vendor prefix,
+                # names with a dot are openrouter aliases unknown to xAI, keep the default
+                name = v.split("/")[-1] if v else ""
+                if name.startswith("grok") and "." not in name:
+                    model = name
             case "messages":
                 messages = v
             case "tool_choice":
                 tool_choice = v
             case "tools":
                 tools = v
-                converted_tools = []
-                for single_tool in tools:
-                    converted_tools.append(tool(
-                        name=single_tool["function"]["name"],
-                        description=single_tool["function"]["description"],
-                        parameters=single_tool["function"]["parameters"]
-                       ))
-                current_tools = default_tools + converted_tools
+                # converted once per tool set, see toolset.toolset_payload
+                current_tools = default_tools + toolset.toolset_payload("xai", tools, __convert_tool)
             case "temperature":
                 temperature = v
             case "mode":
@@ -81,8 +84,8 @@ def chat(*args, **kwargs) -> str:
                 store_messages=False,
                 temperature=temperature,
             )
-            grok_chat.append(system(messages[0]["content"]))
-        case 'main':
+        case 'main' | 'code':
+            # code mode is the main chat flow on a coding model, the model is chosen by the caller
             grok_chat = client.chat.create(
                 model=model,
                 tools=current_tools,
@@ -92,8 +95,6 @@ def chat(*args, **kwargs) -> str:
                 store_messages=True,
                 temperature=temperature,
             )
-        case 'code':
-            return "Code mode not supported yet."
     if previous_response_id is None:
         grok_chat.append(system(messages[0]["content"]))
     # add user chat
@@ -139,4 +140,6 @@ def ai_register():
         "chat": chat,
         "init": init,
         "reset": reset,
+        # only the latest message is sent, the history is kept by xAI (previous_response_id)
+        "full_history": False,
     }
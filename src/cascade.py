@@ -0,0 +1,217 @@
+"""
+Model cascade scheduler.
+
+agent.cfg defines three models: model_aux (fast and cheap), model_code (good at code)
+and model_main (the large reasoning model). Most turns don't need the main model, so
+each chat request is first sent to the cheapest route that is likely adequate:
+- aux:  short chat without tools.
+- code: turns that use file or shell tools (fileio, batch).
+- main: everything else.
+
+A reply is checked before it's accepted. When a tool call can not be parsed, or the
+reply is empty or hedging, the request is escalated to the next route and retried,
+main is the last stop.
+
+Every attempt updates per-route statistics (latency average and a window of recent
+outcomes). A route whose recent success rate drops under route_min_success is skipped
+and its turns go straight to the escalation target, so routing adapts to how well the
+cheaper models actually do. The statistics are kept in logs/cascade.json, written at
+most every stats_save_interval seconds and at exit, not on every attempt.
+"""
+# python standard library
+import atexit
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+# project modules
+import global_cfg as glb
+import general as gen
+import ai
+
+# escalation order of each route
+route_escalate = {
+    "aux": "main",
+    "code": "main",
+    "main": None,
+}
+# tools that make a turn a coding turn
+route_code_tools = {"fileio", "batch"}
+# a chat message longer than this, or with code in it, goes to main
+route_aux_max_chars = 300
+# recent outcomes kept per route, and the success rate needed to keep using it
+route_window = 20
+route_min_samples = 8
+route_min_success = 0.7
+
+# a short reply that starts by hedging is escalated, a longer one that says it does not
+# know something is a legitimate answer, 0 turns the check off
+hedge_max_chars = 200
+hedge_pattern = re.compile(r"\s*(i'?m not sure|i am not sure|i don'?t know|i cannot help|"
+                           r"i can'?t help|i'?m unable to (answer|help)|unable to (answer|help))\b",
+                           re.IGNORECASE)
+
+stats_file = f"{glb.logdir}{glb.path_sep}cascade.json"
+stats_save_interval = 60
+stats_lock = threading.Lock()
+# one writer of the statistics file at a time
+stats_save_lock = threading.Lock()
+# the monotonic time of the last save
+stats_saved = 0.0
+route_stats = {}
+
+# ================================================================
+# Statistics
+# ================================================================
+def __stats(route: str) -> dict:
+    if route not in route_stats:
+        route_stats[route] = {
+            "count": 0,
+            "success": 0,
+            "latency": 0.0,
+            "recent": collections.deque(maxlen=route_window),
+        }
+    return route_stats[route]
+
+# __load_stats:
+# load the statistics of previous runs
+def __load_stats():
+    if not os.path.isfile(stats_file):
+        return
+    try:
+        with open(stats_file, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        for route, value in saved.items():
+            stats = __stats(route)
+            stats["count"] = value["count"]
+            stats["success"] = value["success"]
+            stats["latency"] = value["latency"]
+            stats["recent"].extend(value["recent"])
+    except Exception as e:
+        print(f"Cascade: failed to load statistics, start from scratch. {e}")
+
+# __stats_copy:
+# a copy of the statistics to save, the caller holds stats_lock
+def __stats_copy() -> dict:
+    global stats_saved
+    stats_saved = time.monotonic()
+    return {route: dict(stats, recent=list(stats["recent"])) for route, stats in route_stats.items()}
+
+# __save_stats:
+# write a copy of the statistics, outside stats_lock so the routing does not wait for it
+def __save_stats(saved: dict):
+    with stats_save_lock:
+        try:
+            with open(stats_file, 'w', encoding='utf-8') as f:
+                json.dump(saved, f)
+        except OSError as e:
+            print(f"Cascade: failed to save statistics. {e}")
+
+# __save_at_exit:
+# save the statistics of the attempts since the last save
+def __save_at_exit():
+    with stats_lock:
+        saved = __stats_copy() if route_stats else None
+    if saved:
+        __save_stats(saved)
+
+# route_record:
+# record the outcome of one attempt on a route
+def route_record(route: str, latency: float, success: bool):
+    with stats_lock:
+        stats = __stats(route)
+        stats["count"] += 1
+        stats["success"] += 1 if success else 0
+        # exponential moving average, recent latency matters more
+        if stats["count"] == 1:
+            stats["latency"] = latency
+        else:
+            stats["latency"] = 0.8 * stats["latency"] + 0.2 * latency
+        stats["recent"].append(1 if success else 0)
+        saved = __stats_copy() if time.monotonic() - stats_saved >= stats_save_interval else None
+    if saved:
+        __save_stats(saved)
+
+# route_healthy:
+# a route is used only while its recent success rate is good enough
+def route_healthy(route: str) -> bool:
+    with stats_lock:
+        recent = __stats(route)["recent"]
+        if len(recent) < route_min_samples:
+            return True
+        return sum(recent) / len(recent) >= route_min_success
+
+# route_report:
+# one line per route, for debugging
+def route_report() -> str:
+    lines = []
+    with stats_lock:
+        for route, stats in route_stats.items():
+            recent = stats["recent"]
+            rate = sum(recent) / len(recent) if recent else 1.0
+            lines.append(f"{route}: calls={stats['count']} recent_success={rate:.0%} "
+                         f"latency={stats['latency']:.2f}s")
+    return "\n".join(lines)
+
+# ================================================================
+# Routing
+# ================================================================
+# route_select:
+# pick the cheapest adequate route for the user input and the tools of this turn,
+# unhealthy routes are skipped in favor of their escalation target
+def route_select(user_input: str, tools: list) -> str:
+    tool_names = {tool["function"]["name"] for tool in tools} if tools else set()
+    if tool_names & route_code_tools:
+        route = "code"
+    elif tool_names:
+        route = "main"
+    elif len(user_input) <= route_aux_max_chars and "```" not in user_input:
+        route = "aux"
+    else:
+        route = "main"
+    while route_escalate[route] and not route_healthy(route):
+        gen.debug_out(f"Cascade: route {route} is unhealthy, skip to {route_escalate[route]}")
+        route = route_escalate[route]
+    return route
+
+# reply_check:
+# return an empty string when the reply is acceptable, otherwise the reason to escalate
+def reply_check(reply) -> str:
+    if not isinstance(reply, dict):
+        return f"invalid reply: {reply}"
+    for tool_call in reply["tool_calls"]:
+        try:
+            args = json.loads(tool_call["function"]["arguments"])
+        except Exception as e:
+            return f"tool call arguments can not be parsed: {e}"
+        if not isinstance(args, dict) or not isinstance(args.get("command"), str):
+            return "tool call has no command"
+    if not reply["tool_calls"]:
+        content = reply["content"] or ""
+        if not content.strip():
+            return "empty reply"
+        if len(content) <= hedge_max_chars and hedge_pattern.match(content):
+            return "low confidence reply"
+    return ""
+
+# cascade_chat:
+# send a chat request along the cascade, starting at `route`, until a reply passes the
+# check or the last route is reached, return (reply, route)
+def cascade_chat(route: str, models: dict, **kwargs):
+    while True:
+        time1 = time.time()
+        reply = ai.func(func="chat", mode=route, model=models[route], **kwargs)
+        latency = time.time() - time1
+        reason = reply_check(reply)
+        route_record(route, latency, not reason)
+        gen.debug_out(f"Cascade: route={route} model={models[route]} latency={latency:.2f}s "
+                      f"{'ok' if not reason else 'failed, ' + reason}")
+        if not reason or not route_escalate[route]:
+            return reply, route
+        route = route_escalate[route]
+
+__load_stats()
+atexit.register(__save_at_exit)
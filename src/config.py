@@ -0,0 +1,194 @@
+"""
+Configuration files.
+
+The .cfg files under the config directory are parsed once into immutable mappings and
+cached by the mtime and size of the file, so reading a configuration is a dict lookup.
+The config service of the runtime checks the loaded files every config_check_interval
+seconds, a changed file is parsed and validated again, and the functions registered with
+config_watch are called with the new configuration, so the models of agent.cfg and the
+access lists of telegram.cfg apply without a restart. A file that fails to parse or to
+validate keeps the previous configuration.
+
+The format of a cfg file:
+- key=value, one per line, lines starting with ';' are comments.
+- "tag_subtag" keys become nested: cfg["tag"]["subtag"].
+- a value in double quotes may span lines until the closing quote.
+- integers are converted, "${name}" is replaced by the environment variable, or by an
+  earlier key of the same file ("${agent00_id}").
+- a value that is an absolute path of an existing file is replaced by the content of the
+  file, like the tokens of telegram.cfg ("${workspace}/tokens/agent00.token").
+"""
+# python standard library
+import asyncio
+import os
+import re
+import threading
+import types
+
+# project modules
+import global_cfg as glb
+
+# the keys every configuration must have and their types, "tag_subtag" for nested keys
+schemas = {
+    "agent": {"model_main": str, "model_aux": str, "model_code": str, "system": str, "toolRouter": str},
+    "telegram": {"user_valid_id_1": int, "group_id_1": int},
+}
+config_check_interval = 2
+# the loaded configurations by name, each is {"stamp": (mtime, size), "cfg": mapping}
+configs = {}
+# the functions called with the new configuration when a file changed, by name
+watchers = {}
+configs_lock = threading.Lock()
+reference_pattern = re.compile(r"\$\{([^}]*)\}")
+
+# __config_file:
+# the file of a configuration
+def __config_file(name: str) -> str:
+    return f"{glb.config_dir}{glb.path_sep}{name}.cfg"
+
+# __stamp:
+# the stamp of a file, a changed stamp reloads the configuration
+def __stamp(path: str) -> tuple:
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+# __resolve_value:
+# convert a raw value to an int, or resolve its references and file content
+def __resolve_value(value: str, cfg: dict) -> int | str:
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    def reference(match):
+        ref = match.group(1)
+        ref_value = os.getenv(ref)
+        if ref_value is not None:
+            return ref_value
+        ref_value = cfg
+        for part in ref.split('_'):
+            if not isinstance(ref_value, dict) or part not in ref_value:
+                raise ValueError(f"Reference {ref} not found in environment variables or config")
+            ref_value = ref_value[part]
+        return str(ref_value)
+    if "${" in value:
+        value = reference_pattern.sub(reference, value)
+    if os.path.isabs(value) and os.path.isfile(value):
+        with open(value, 'r') as f:
+            return f.read()
+    return value
+
+# __parse:
+# parse the text of a cfg file to nested dicts, in one pass over the lines
+def __parse(text: str) -> dict:
+    cfg = {}
+    tag = None
+    lines = None
+    for line in text.splitlines():
+        line = line.strip()
+        if lines is not None:
+            # inside a quoted multi-line value
+            if line.endswith('"'):
+                lines.append(line[:-1])
+                # the rest of the first line is joined to the second one, like before
+                raw_value = lines[0] + "".join(f"{part}\n" for part in lines[1:])
+                lines = None
+            else:
+                lines.append(line)
+                continue
+        else:
+            if not line or line.startswith(';') or '=' not in line:
+                continue
+            tag, _, raw_value = line.partition('=')
+            if raw_value.startswith('"'):
+                raw_value = raw_value[1:]
+                if raw_value.endswith('"'):
+                    raw_value = raw_value[:-1]
+                else:
+                    lines = [raw_value]
+                    continue
+        value = __resolve_value(raw_value, cfg)
+        if '_' in tag:
+            tag, subtag = tag.split('_', 1)
+            cfg.setdefault(tag, {})[subtag] = value
+        else:
+            cfg[tag] = value
+    return cfg
+
+# __validate:
+# check the keys and types a configuration must have
+def __validate(name: str, cfg: dict):
+    for key, value_type in schemas.get(name, {}).items():
+        value = cfg
+        for part in key.split('_', 1):
+            if not isinstance(value, dict) or part not in value:
+                raise ValueError(f"{name}.cfg: missing {key}")
+            value = value[part]
+        if not isinstance(value, value_type):
+            raise ValueError(f"{name}.cfg: {key} must be {value_type.__name__}, got {value!r}")
+
+# __freeze:
+# an immutable view of nested dicts
+def __freeze(cfg: dict) -> types.MappingProxyType:
+    return types.MappingProxyType({key: __freeze(value) if isinstance(value, dict) else value
+                                   for key, value in cfg.items()})
+
+# __load:
+# parse and validate a cfg file, return its stamp and configuration
+def __load(name: str) -> dict:
+    path = __config_file(name)
+    stamp = __stamp(path)
+    with open(path, 'r') as f:
+        cfg = __parse(f.read())
+    __validate(name, cfg)
+    return {"stamp": stamp, "cfg": __freeze(cfg)}
+
+# config_get:
+# the configuration of a name, like "agent" for config/agent.cfg, parsed at the first call
+def config_get(name: str) -> types.MappingProxyType:
+    entry = configs.get(name)
+    if entry is None:
+        with configs_lock:
+            if name not in configs:
+                configs[name] = __load(name)
+            entry = configs[name]
+    return entry["cfg"]
+
+# config_watch:
+# call callback(cfg) with the new configuration whenever the file of the name changes
+def config_watch(name: str, callback):
+    watchers.setdefault(name, []).append(callback)
+
+# config_reload:
+# reload the configurations whose files changed and notify their watchers, return the names
+def config_reload() -> list:
+    changed = []
+    for name, entry in list(configs.items()):
+        try:
+            if __stamp(__config_file(name)) == entry["stamp"]:
+                continue
+            new_entry = __load(name)
+        except Exception as e:
+            print(f"Config {name}.cfg not reloaded, the previous one is kept: {e}")
+            # do not report the same broken file again
+            try:
+                entry["stamp"] = __stamp(__config_file(name))
+            except OSError:
+                pass
+            continue
+        with configs_lock:
+            configs[name] = new_entry
+        changed.append(name)
+        print(f"Config {name}.cfg reloaded.")
+        for callback in watchers.get(name, []):
+            try:
+                callback(new_entry["cfg"])
+            except Exception as e:
+                print(f"Config {name}.cfg: a watcher failed: {e}")
+    return changed
+
+# config_service:
+# check the configuration files for changes, run by the runtime
+async def config_service():
+    while True:
+        await asyncio.sleep(config_check_interval)
+        await asyncio.to_thread(config_reload)
@@ -0,0 +1,198 @@
+"""
+Conversation store of a session.
+
+A conversation keeps every message once, as a compact record (a class with __slots__, the
+role, kind and tool names interned), in two bounded ring buffers:
+- history: the messages sent to grok, after the system message.
+- pending: the records to save to the memory store on /ms, see memory.memory_store.
+A user input or a tool result is one record in both of them, so a large tool output is
+held once however it's viewed. A tool call is only saved to the memory store, an
+assistant message with tool calls is only sent to grok.
+
+When a buffer is full, the oldest record is dropped as a new one is added, instead of
+copying the list to trim it. view() builds the message list of a request, small dicts
+that refer to the contents of the records, tool results whose tool call was dropped are
+left out, the vendor APIs reject them.
+
+Agents often run the same command again (ls, git status) or read the same file again. A
+tool result is kept by its tool and command, and a result of the same command as an
+earlier call that is still sent to grok (the result and its tool call are both in the
+history) is sent as a short reference when the output did not change, or as a diff of the
+changed lines when only a few lines changed, so a monitoring loop does not add the whole
+output to the prompt every time. The memory store always gets the whole result.
+"""
+# python standard library
+import collections
+import difflib
+import sys
+import time
+
+# the messages kept in the history and the records kept for the memory store
+conversation_max_messages = 100
+# tool results shorter than the min are always sent whole, longer than the max are not diffed
+result_min_chars = 200
+result_diff_max_chars = 200000
+
+# tool_result_delta:
+# the text sent instead of a tool result that an earlier call of the same command returned
+# as old, None when the whole result should be sent
+def tool_result_delta(old: str, new: str, tool_call_id: str):
+    if len(new) < result_min_chars:
+        return None
+    if new == old:
+        return f"Output unchanged since tool call {tool_call_id}."
+    if len(new) > result_diff_max_chars or len(old) > result_diff_max_chars:
+        return None
+    lines = difflib.unified_diff(old.splitlines(), new.splitlines(), lineterm="", n=0)
+    # the first two lines are the file headers
+    diff = "\n".join(list(lines)[2:])
+    if len(diff) > len(new) // 2:
+        return None
+    return f"Output changed since tool call {tool_call_id}, the changed lines (unified diff):\n{diff}"
+
+class Record:
+    """one message of a conversation, records can be read like memory entries: record["content"]"""
+    __slots__ = ("role", "content", "kind", "tool", "tool_call_id", "tool_calls", "time")
+
+    def __init__(self, role: str, content: str, kind: str = None, tool: str = None,
+                 tool_call_id: str = None, tool_calls: list = None):
+        self.role = sys.intern(role)
+        self.content = content if content else ""
+        self.kind = sys.intern(kind) if kind else kind
+        self.tool = sys.intern(tool) if tool else tool
+        self.tool_call_id = tool_call_id
+        self.tool_calls = tool_calls
+        self.time = time.time()
+
+    # __getitem__:
+    # read a field like a dict, memory.memory_store takes records as entries
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    # message:
+    # the message of the record as sent to the vendor APIs
+    def message(self) -> dict:
+        if self.role == "tool":
+            return {"role": "tool", "tool_call_id": self.tool_call_id, "content": self.content}
+        if self.role == "assistant":
+            return {"role": "assistant", "content": self.content, "tool_calls": self.tool_calls}
+        return {"role": self.role, "content": self.content}
+
+class Conversation:
+    """the messages of a session and the records to save to the memory store"""
+    __slots__ = ("system", "history", "pending", "results")
+
+    def __init__(self, system_prompt: str = ""):
+        self.system = Record("system", system_prompt)
+        self.history = collections.deque(maxlen=conversation_max_messages)
+        self.pending = collections.deque(maxlen=conversation_max_messages)
+        # the record of the latest whole result of every tool command, by (tool, command)
+        self.results = {}
+
+    def __len__(self) -> int:
+        return len(self.history) + 1
+
+    # add:
+    # add a message sent to grok, with a kind it's saved to the memory store too, return
+    # the record
+    def add(self, role: str, content: str, kind: str = None, tool: str = None,
+            tool_call_id: str = None, tool_calls: list = None) -> Record:
+        record = Record(role, content, kind, tool, tool_call_id, tool_calls)
+        self.history.append(record)
+        if kind:
+            self.pending.append(record)
+        return record
+
+    # note:
+    # add a record that is only saved to the memory store, return the record
+    def note(self, role: str, kind: str, content: str, tool: str = None) -> Record:
+        record = Record(role, content, kind, tool)
+        self.pending.append(record)
+        return record
+
+    # add_tool_result:
+    # add the result of a tool call, an unchanged or slightly changed result of the same
+    # command as an earlier call still in the history is sent as a reference or a diff,
+    # return the record sent to grok
+    def add_tool_result(self, tool: str, command: str, content: str, tool_call_id: str) -> Record:
+        key = (tool, command)
+        earlier = self.results.get(key)
+        delta = None
+        if earlier is not None and self.in_view(earlier):
+            delta = tool_result_delta(earlier.content, content, earlier.tool_call_id)
+        if delta is None:
+            record = self.add("tool", content, kind="tool_result", tool=tool, tool_call_id=tool_call_id)
+            if content:
+                # the next calls of the command refer to this one
+                self.results[key] = record
+        else:
+            record = self.add("tool", delta, tool_call_id=tool_call_id)
+            self.note("tool", "tool_result", content, tool=tool)
+        if len(self.results) > conversation_max_messages:
+            # forget the results that are not in the history anymore
+            kept = set(map(id, self.history))
+            self.results = {key: value for key, value in self.results.items() if id(value) in kept}
+        return record
+
+    # in_view:
+    # whether view() still sends a tool result: the result and the assistant message that
+    # called it are in the history, a result whose call was dropped is left out
+    def in_view(self, record: Record) -> bool:
+        called = False
+        for item in self.history:
+            if item is record:
+                return called
+            if item.role == "assistant" and item.tool_calls and not called:
+                called = any(call["id"] == record.tool_call_id for call in item.tool_calls)
+        return False
+
+    # view:
+    # the messages of a request, the system message first
+    def view(self) -> list:
+        messages = [self.system.message()]
+        answered = False
+        for record in self.history:
+            if record.role == "tool":
+                if not answered:
+                    continue
+            else:
+                # a tool result is only valid after the assistant message that called it
+                answered = record.role == "assistant" and bool(record.tool_calls)
+            messages.append(record.message())
+        return messages
+
+    # last_user:
+    # the content of the latest user input, empty if there is none
+    def last_user(self) -> str:
+        for record in reversed(self.history):
+            if record.role == "user":
+                return record.content
+        return ""
+
+    # close_tool_calls:
+    # answer the tool calls of the latest assistant message that have no result yet
+    def close_tool_calls(self, content: str):
+        answered = set()
+        for record in reversed(self.history):
+            if record.role == "tool":
+                answered.add(record.tool_call_id)
+            elif record.role == "assistant":
+                for tool_call in record.tool_calls or []:
+                    if tool_call["id"] not in answered:
+                        self.add("tool", content, tool_call_id=tool_call["id"])
+                break
+
+    # take_pending:
+    # the records to save to the memory store, the buffer is emptied
+    def take_pending(self) -> list:
+        records = list(self.pending)
+        self.pending.clear()
+        return records
+
+    # reset:
+    # forget the messages and the records, start again with a system prompt
+    def reset(self, system_prompt: str):
+        self.system = Record("system", system_prompt)
+        self.history.clear()
+        self.pending.clear()
+        self.results.clear()
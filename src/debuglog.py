@@ -0,0 +1,191 @@
+"""
+Background JSON debug log.
+
+The messages sent to and received from grok are logged for debugging when glb.debug_json
+is on (see gen.debug_json_out). Logging must not slow down a turn, so debuglog_put only
+puts the message to a bounded queue, a writer thread takes the queued messages in
+batches and appends them as compact JSON lines, one record per line:
+    {"seq": 12, "time": 1760000000.123, "session": "telegram:agent00:77", "data": {...}}
+to a file kept open. When the file is larger than max_bytes it is rotated to
+<file>.1.gz (.zst when the zstandard package is installed), the older ones are shifted to
+<file>.2.gz and so on, up to keep files. The log of the previous run is rotated the same
+way at the first message of a run. When the queue is full, the message is dropped and
+counted, the agent never waits for the log.
+
+Run this module to read a log, pretty printed:
+    $ python3 src/debuglog.py [file] [--session KEY] [--last N] [--follow]
+the file defaults to $workspace/debug/grok.jsonl, rotated .gz and .zst files can be read
+too.
+"""
+# python standard library
+import argparse
+import gzip
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log_file = None
+log_max_bytes = 8 * 1024 * 1024
+log_keep = 3
+log_queue = queue.Queue(maxsize=4096)
+log_dropped = 0
+log_seq = 0
+log_thread = None
+log_lock = threading.Lock()
+
+# debuglog_config:
+# set the log file, the size it's rotated at and the number of rotated files to keep
+def debuglog_config(file: str, max_bytes: int = log_max_bytes, keep: int = log_keep):
+    global log_file, log_max_bytes, log_keep
+    log_file = file
+    log_max_bytes = max_bytes
+    log_keep = keep
+
+# debuglog_put:
+# queue a message for the log, the data is serialized later by the writer thread, so it
+# must not be changed after it's put
+def debuglog_put(data, session_key=None):
+    global log_seq, log_dropped, log_thread
+    with log_lock:
+        if log_thread is None:
+            log_thread = threading.Thread(target=__writer, name="debuglog", daemon=True)
+            log_thread.start()
+        log_seq += 1
+        record = {"seq": log_seq, "time": round(time.time(), 3), "session": session_key, "data": data}
+    try:
+        log_queue.put_nowait(record)
+    except queue.Full:
+        log_dropped += 1
+
+# debuglog_flush:
+# wait until the queued messages are written, at exit
+def debuglog_flush(timeout: float = 2.0):
+    if log_thread is None:
+        return
+    deadline = time.monotonic() + timeout
+    while log_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+# __compressed_name:
+# the name of the n-th rotated file
+def __compressed_name(n: int) -> str:
+    return f"{log_file}.{n}.{'zst' if zstandard else 'gz'}"
+
+# __rotate:
+# shift the rotated files and compress the current log to the first one
+def __rotate():
+    if not os.path.isfile(log_file) or os.path.getsize(log_file) == 0:
+        return
+    for n in range(log_keep - 1, 0, -1):
+        if os.path.exists(__compressed_name(n)):
+            os.replace(__compressed_name(n), __compressed_name(n + 1))
+    with open(log_file, "rb") as src:
+        data = src.read()
+    if zstandard:
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        data = gzip.compress(data)
+    with open(__compressed_name(1), "wb") as dst:
+        dst.write(data)
+    os.remove(log_file)
+
+# __writer:
+# the writer thread, writes the queued messages in batches to the open log file
+def __writer():
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    __rotate()
+    f = open(log_file, "a", encoding="utf-8")
+    dropped = 0
+    while True:
+        batch = [log_queue.get()]
+        while len(batch) < 256:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        lines = []
+        for record in batch:
+            try:
+                lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str))
+            except (TypeError, ValueError) as e:
+                lines.append(json.dumps({"seq": record["seq"], "error": f"not serializable: {e}"}))
+        if log_dropped != dropped:
+            lines.append(json.dumps({"dropped": log_dropped - dropped}))
+            dropped = log_dropped
+        try:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            if f.tell() > log_max_bytes:
+                f.close()
+                __rotate()
+                f = open(log_file, "a", encoding="utf-8")
+        except OSError as e:
+            print(f"Debug log: write failed: {e}")
+        for _ in batch:
+            log_queue.task_done()
+
+# __open_log:
+# open a log file for reading, plain or compressed
+def __open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("reading .zst logs needs the zstandard package")
+        import io
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+# __print_record:
+# pretty print one record like the old debug file did
+def __print_record(line: str, session_key=None):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return
+    if "data" not in record:
+        print(f"\n==== {record} ====")
+        return
+    if session_key and record.get("session") != session_key:
+        return
+    stamp = time.strftime("%H:%M:%S", time.localtime(record["time"]))
+    print(f"\n==== Message {record['seq']} {stamp} {record.get('session') or ''} ========================\n")
+    print(json.dumps(record["data"], ensure_ascii=False, indent=4))
+
+def main():
+    parser = argparse.ArgumentParser(description="Pretty print the debug JSON log of the agent")
+    parser.add_argument("file", nargs="?", help="the log file, $workspace/debug/grok.jsonl by default")
+    parser.add_argument("--session", help="only the messages of a session, like terminal or telegram:agent00:77")
+    parser.add_argument("--last", type=int, default=0, help="only the last N messages")
+    parser.add_argument("--follow", action="store_true", help="keep printing new messages")
+    args = parser.parse_args()
+    path = args.file or os.path.join(os.getenv("workspace", "."), "debug", "grok.jsonl")
+    with __open_log(path) as f:
+        lines = f.readlines()
+        if args.session:
+            lines = [line for line in lines if f'"session":{json.dumps(args.session)}' in line]
+        if args.last:
+            lines = lines[-args.last:]
+        for line in lines:
+            __print_record(line, args.session)
+        while args.follow:
+            line = f.readline()
+            if line:
+                __print_record(line, args.session)
+            else:
+                time.sleep(0.2)
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -5,9 +5,9 @@ This module centralizes lightweight global variables and helper functions
 used across the CLI, daemon, and tool-invocation logic.
 
 Globals exposed here act as simple process-wide flags and stores:
-pause toggles for background tasks, an initial-entry marker, a flag
-indicating whether a tool was used last, and a short place to keep
-recent tool results for logging or returning to callers.
+the reset reasons, the runtime hooks, the default conversation and the
+tool enable switch. The state of a conversation (messages, the memory
+buffer, the last tool result) belongs to its session, see session.py.
 
 Utility functions provide basic XML <-> dict conversion:
 - xml_to_dict(xml_file): parse an XML file into a nested dictionary,
@@ -21,42 +21,33 @@ Design notes:
 - Keep helpers minimal to avoid extra dependencies and simplify testing.
 """
 # python standard library
-import copy
-import json
+import io
 import os
+import threading
 import xml.etree.ElementTree as ET
 import global_cfg as glb
+import config
+import debuglog
+import mdhtml
+import memory
+import session
+import toolset
 
+# reasons to stop the program, use request_reset to add one, so the runtime wakes up at once
 reset_flag = []
-# pause flag for the daemon, when daemon_pause is 1, the daemon will pause and not execute the
-# tasks, when daemon_pause is 0, the daemon will run normally.
-# need to run daemon before grok get user input, so that the daemon can execute the tasks in
-# the background while grok is waiting for user input.
-# when grok is processing user input or executing tools, it can set daemon_pause to 1 to pause
-# the daemon, to avoid the daemon execute tasks at the same time and cause conflicts
-daemon_pause = 0
-# initial switch, to print welcome info and set default conversation at the first entry
-initial = 0
-# default messages for conversation, can be modified by user input commands
-# the first 2 messages are system messages, which are necessary for grok to work,
-# and should not be removed,
-# the 3rd message is a hello message, which can be removed if user want grok to start with no greeting
-default_message = []
+# hooks installed by the runtime (runtime.py), they are thread-safe and can be called from
+# the event loop, worker threads or bot handlers:
+# - input_hook(source, text, events, chat_id, bot): queue a user input for the agent
+# - output_hook(marker, text): the agent wrote output (data), finished a block of output
+#   (done) or the turn (end), text is the output of a remote session
+# - reset_hook(reason): stop the runtime
+input_hook = None
+output_hook = None
+reset_hook = None
+# the system prompt every conversation starts with, set by message_init
+default_system = ""
 # compress_message is for future use, currently not implemented yet
 compress_message = []
-# save_message is the conversation history that will be saved to mem file when user input /m command,
-# it's in plain text format for potential future use, currently it's just a copy of messages with
-# some formatting, but in the future it can be modified to save more info or in a different format
-save_message = []
-# messages is the current conversation history, which will be sent to grok for each chat request,
-messages = []
-# a flag to indicate whether the agent used tool last time, 
-# if yes, the agent will not ask for user input, but directly decide to use tools or not once 
-# again, which can be useful when the agent need to use tools for several times in a row
-tool_used_last_time = 0
-# a variable to store the tool result, which can be used for debugging and also can be sent back
-# to grok as tool call reply content
-tool_result = ""
 # enable or disable tool use, when tool_enable is 1, the agent can use tools, when tool_enable is 0,
 # the tools will be disabled and tool router will not be called, which can be useful when user want 
 # to have a pure chat with grok without tool use
@@ -64,24 +55,17 @@ tool_enable_flag = 1
 
 
 # message_init:
-# initialize the default_message and messages with the system prompt, which is necessary for grok to work,
+# initialize the system prompt every conversation starts with, which is necessary for grok to work,
 def message_init(system_prompt):
-    global default_message, messages
-    default_message = [{"role": "system", "content": system_prompt}]
-    messages = copy.deepcopy(default_message)
+    global default_system
+    default_system = system_prompt
+    session.default_system = system_prompt
 
-# ai_to_html_reparse
+# ai_to_html_reparse:
+# convert the markdown emphasis of a reply to HTML tags in one pass, code is left untouched,
+# see mdhtml
 def ai_to_html_reparse(text):
-    while text.find('***') > -1:
-        text = text.replace("***", "<i><b>", 1)
-        text = text.replace("***", "</b></i>", 1)
-    while text.find('**') > -1:
-        text = text.replace("**", "<b>", 1)
-        text = text.replace("**", "</b>", 1)
-    while text.find('*') > -1:
-        text = text.replace("*", "<i>", 1)
-        text = text.replace("*", "</i>", 1)
-    return text
+    return mdhtml.md_to_html(text)
 
 # xml_to_dict:
 # convert xml file to dictionary, the xml file should have a root element, and the root element
@@ -162,173 +146,87 @@ def dict_to_xml(data, output_file):
     tree = ET.ElementTree(root)
     tree.write(output_file, encoding='utf-8', xml_declaration=True)
 
-# split_unquoted_comma:
-# split a string by comma, but ignore the comma in quotes,
-# the function will return a list of strings
-def split_unquoted_comma(s: str, strip=True) -> list[str]:
-    if not s:
-        return []
-    parts = []
-    current = []
-    in_quotes = False
-    i = 0
-    while i < len(s):
-        char = s[i]
-        if char == '\\' and i + 1 < len(s) and s[i + 1] == '"':
-            current.append('"')
-            i += 2
-            continue
-        if char == '"':
-            in_quotes = not in_quotes
-            current.append(char)
-            i += 1
-            continue
-        if char == ',' and not in_quotes:
-            field = ''.join(current)
-            if strip:
-                field = field.strip()
-            parts.append(field)
-            current = []
-            i += 1
-            continue
-        current.append(char)
-        i += 1
-    if current:
-        field = ''.join(current)
-        if strip:
-            field = field.strip()
-        parts.append(field)
-    return parts
-
-# my_xml_parser:
-# a simple xml parser that can parse the xml in the format of <tag pars>content</tag>, 
-# where pars is a comma separated string of parameters, and content is the text content 
-# of the tag, the function will return a list of dictionaries, each dictionary represents
-#  a tag, and has two keys: "pars" and "content", the value of "pars" is a list of 
-# parameters, and the value of "content" is the text content of the tag, if there are 
-# multiple tags with the same name, they will be stored in a list under the same key
-def my_xml_parser(text, tag):
-    out = []
-    while 1:
-        pre_tag = f"<{tag}"
-        post_tag = f"</{tag}>"
-        index00 = text.find(pre_tag)
-        if index00 > 0:
-            out.append({
-                "content": {"#text": text[0:index00]},
-            })
-        if not index00 > -1:
-            text = text.strip()
-            if text:
-                out.append({
-                    "content": {"#text": text},
-                })
-            break
-        index01 = text.find(f">", index00)
-        if not index01 > index00:
-            break
-        par_text = text[index00+len(pre_tag):index01].strip()
-        if par_text:
-            pars = split_unquoted_comma(par_text)
-        else:
-            pars = []
-        index10 = text.find(post_tag, index01)
-        if not index10 > -1:
-            break
-        content = text[index01+1:index10].strip()
-        out.append({
-            "pars" : {"#list": pars},
-            "file_content" : {"#text": content}
-        })
-        text = text[index10+len(post_tag):].strip()
-    return out
-
 # get_cfg:
-# get configuration from cfg file, the cfg file should be in the format of "key=value", 
-# and the key can be in the format of "tag_subtag", which will be converted to a nested dictionary,
-# the value can be an integer, a string, a reference to another configuration value in the format
-# of "${tag_subtag}", or a file path, if the value is a file path, the function will read the content
-# of the file and return it as the value
-def get_cfg(name: str) -> dict:
-    def _resolve_value(value: str, cfg: dict) -> int | str:
-        try:
-            return int(value)
-        except ValueError:
-            pass
-        # resolve references in the value, the reference format is "${tag_subtag}"
-        # the reference can refer to an environment variable or another configuration value that has been parsed,
-        # and the function will recursively resolve the references until there is no reference in the value
-        while True:
-            index_start = value.find("${")
-            index_end = value.find("}")
-            if index_start == -1 or index_end == -1:
-                break
-            ref = value[index_start + 2:index_end]
-            ref_value = os.getenv(ref)
-            if ref_value is None:
-                # try to get the value from the already parsed cfg
-                ref_parts = ref.split('_')
-                ref_value = cfg
-                for part in ref_parts:
-                    if part in ref_value:
-                        ref_value = ref_value[part]
-                    else:
-                        raise ValueError(f"Reference {ref} not found in environment variables or config")
-            value = value[:index_start] + str(ref_value) + value[index_end + 1:]
-        if os.path.isfile(value):
-            with open(value, 'r') as f:
-                return f.read()
-        return value
-    
-    cfg = {}
-    with open(f"{glb.config_dir}{glb.path_sep}{name}.cfg", 'r') as f:
-        multi_line_flag = 0
-        raw_value = ""
-        tag = ""
-        for line in f:
-            if multi_line_flag:
-                if line.strip().endswith('"'):
-                    line = line.strip()[:-1]
-                    raw_value += line + '\n'
-                    multi_line_flag = 0
-                else:
-                    line = line.strip()
-                    raw_value += line + '\n'
-                    continue
-            else:
-                line = line.strip()
-                if not line or line.startswith(';'):
-                    continue
-                if '=' not in line:
-                    continue
-                tag, _, raw_value = line.partition('=')
-                if raw_value.startswith('"'):
-                    raw_value = raw_value[1:]
-                    if raw_value.endswith('"'):
-                        raw_value = raw_value[:-1]
-                    else:
-                        multi_line_flag = 1
-                        continue
-            value = _resolve_value(raw_value, cfg)
-            if '_' in tag:
-                tag, subtag = tag.split('_', 1)
-                cfg.setdefault(tag, {})[subtag] = value
-            else:
-                cfg[tag] = value
-    return cfg
+# get configuration from cfg file, the file is parsed once and cached, see config.py for
+# the format, the returned mapping is immutable, copy it to change it
+def get_cfg(name: str):
+    return config.config_get(name)
 
 
 # myprint:
-# print text in terminal only, or give to another terminal
+# print text in terminal only, or give to another terminal, the output goes to the fcomm
+# file of the current session, remote sessions like Telegram chats always stream it to
+# the events of the input they handle, with the data marker
 def myprint_fcomm(*args, **kwargs):
-    if glb.grok_use_fileio:
-        fcomm_file = glb.grok_fcomm_out_table[glb.grok_fcomm_in_src]
-        if os.path.isfile(fcomm_file):
-            operation = "a"
-        else:
-            operation = "w"
-        with open(fcomm_file, operation) as f:
-            print(*args, file=f, **kwargs)
+    current = session.session_current()
+    if current["remote"]:
+        text = io.StringIO()
+        print(*args, file=text, **kwargs)
+        if output_hook:
+            output_hook(glb.grok_fcomm_data, text.getvalue())
+    elif glb.grok_use_fileio:
+        text = io.StringIO()
+        print(*args, file=text, **kwargs)
+        fcomm_write(current["out_file"], text.getvalue())
+        if output_hook:
+            output_hook(glb.grok_fcomm_data)
+
+# ================================================================
+# fcomm output channels
+# ================================================================
+# every fcomm output file has a channel: the file is kept open for appending and the output
+# is buffered until the done and end markers, instead of opening the file for every print,
+# fcomm_flush writes it out before the agent waits for the user.
+# the readers may remove the file (the grok CLI wrapper does after reading) or truncate it,
+# so the file is checked at every flush, a removed or replaced file is opened again.
+fcomm_channels = {}
+fcomm_channels_lock = threading.Lock()
+
+# __fcomm_channel:
+# the channel of a file, created at the first output
+def __fcomm_channel(fcomm_file) -> dict:
+    with fcomm_channels_lock:
+        if fcomm_file not in fcomm_channels:
+            fcomm_channels[fcomm_file] = {"file": fcomm_file, "f": None, "buffer": [],
+                                          "lock": threading.Lock()}
+        return fcomm_channels[fcomm_file]
+
+# __fcomm_flush_channel:
+# write the buffer of a channel to its file, the caller holds the channel lock
+def __fcomm_flush_channel(channel):
+    if not channel["buffer"]:
+        return
+    f = channel["f"]
+    try:
+        if f is not None and os.stat(channel["file"]).st_ino != os.fstat(f.fileno()).st_ino:
+            f.close()
+            f = None
+    except FileNotFoundError:
+        f.close()
+        f = None
+    if f is None:
+        f = channel["f"] = open(channel["file"], "a")
+    f.write("".join(channel["buffer"]))
+    f.flush()
+    channel["buffer"].clear()
+
+# fcomm_write:
+# add text to the output of a fcomm file, written at the next flush or at once
+def fcomm_write(fcomm_file, text, flush=False):
+    channel = __fcomm_channel(fcomm_file)
+    with channel["lock"]:
+        channel["buffer"].append(text)
+        if flush:
+            __fcomm_flush_channel(channel)
+
+# fcomm_flush:
+# write the buffered output of the current session to its fcomm file
+def fcomm_flush():
+    current = session.session_current()
+    if glb.grok_use_fileio and not current["remote"]:
+        channel = __fcomm_channel(current["out_file"])
+        with channel["lock"]:
+            __fcomm_flush_channel(channel)
 
 # myprint2:
 def myprint(*args, **kwargs):
@@ -342,67 +240,82 @@ def debug_out(*args, **kwargs):
         print(*args, **kwargs)
 
 # debug_json_out:
-# print json data to file if debug_json switch is on
-debug_json_cnt = 0
+# log json data if debug_json switch is on, the data is written by the background writer of
+# debuglog.py, read the log with: python3 src/debuglog.py
+debuglog.debuglog_config(glb.debug_file, glb.debug_log_max_bytes, glb.debug_log_keep)
 def debug_json_out(data):
     if glb.debug_json:
-        global debug_json_cnt
-        if not os.path.isdir(glb.debug_dir):
-            os.makedirs(glb.debug_dir)
-        if debug_json_cnt == 0:
-            with open(glb.debug_file, "w", encoding="utf-8") as f:
-                f.write('')
-        if not os.path.isfile(glb.debug_file):
-            operation = "w"
-        else:
-            operation = "a"
-        with open(glb.debug_file, operation, encoding="utf-8") as f:
-            f.write(f"\n\n==== Message {debug_json_cnt} ========================\n\n")
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        debug_json_cnt += 1
+        debuglog.debuglog_put(data, session.session_current()["key"])
         
 # grok_done:
-# output done flag to fcomm file
+# output done flag to fcomm file and flush it
 # the remote terminal can print data
 def grok_done():
     myprint_fcomm('\n' + glb.grok_fcomm_done)
+    fcomm_flush()
+    if output_hook:
+        output_hook(glb.grok_fcomm_done)
 
 # grok_end:
-# output end flag to fcomm file
+# output end flag to fcomm file and flush it
 # the remote terminal can stop waiting
 def grok_end():
     myprint_fcomm('\n' + glb.grok_fcomm_end)
+    fcomm_flush()
+    if output_hook:
+        output_hook(glb.grok_fcomm_end)
+
+# grok_resume:
+# the turn goes on after the reply was ended to wait for the user, the reader of the
+# answer reads the output from here
+def grok_resume():
+    if output_hook:
+        output_hook(glb.grok_fcomm_data)
+
+# post_input:
+# give a user input to the agent, source is terminal, task or telegram, chat_id and bot tell
+# the Telegram chats apart, each source and chat is a session of its own (see session.py),
+# events is an optional asyncio.Queue that receives the output markers of the turn
+def post_input(source, text, events=None, chat_id=None, bot=None):
+    if input_hook:
+        input_hook(source, text, events, chat_id, bot)
+    else:
+        print(f"No runtime to handle input from {source}: {text}")
+
+# request_reset:
+# ask the runtime to stop, the reason is kept in reset_flag
+def request_reset(reason):
+    reset_flag.append(reason)
+    if reset_hook:
+        reset_hook(reason)
 
 
 # ================ Command Handlers =================
 def reset_session():
-    global initial
-    initial = 1
+    current = session.session_current()
+    current["initial"] = 1
     ret = "Reset Session $"
     myprint(ret, end=' ')
-    save_message.clear()
-    global messages    
-    messages = copy.deepcopy(default_message)
+    current["conversation"].reset(default_system)
+    for hook in session.reset_hooks:
+        hook(current)
     return ret
 
 def quit_session():
     grok_end()
-    myprint("Quit Session $", end=' ')
-    global reset_flag
-    reset_flag = "User Quit"
-    exit(0)
+    ret = "Quit Session $"
+    myprint(ret, end=' ')
+    request_reset("User Quit")
+    return ret
 
 def memory_save():
-    with open(glb.mem_file, 'a', encoding="utf-8") as f:
-        f.write("".join(save_message))
-    save_message.clear()
+    memory.memory_store(session.session_current()["conversation"].take_pending())
     ret = "Memory Saved $"
     myprint(ret, end=' ')
     return ret
 
 def memory_clear():
-    with open(glb.mem_file, 'w', encoding="utf-8") as f:
-        f.write('')
+    memory.memory_clear_all()
     ret = "Clear Memories $"
     myprint(ret, end=' ')
     return ret
@@ -433,6 +346,11 @@ def tool_disable():
     myprint(ret, end=' ')
     return ret
 
+def token_report():
+    ret = toolset.toolset_report()
+    myprint(ret)
+    return ret
+
 command_handler = {
     'r': reset_session,
     'q': quit_session,
@@ -442,9 +360,11 @@ command_handler = {
     'cd': confirm_disable,
     'te': tool_enable,
     'td': tool_disable,
+    'tk': token_report,
 }
 
 command_description = f"/r: Reset session    /q: Quit\n"\
                        "/ms: Memory save     /mc: Memory clear \n"\
                        "/ce: Confirm enable  /cd: Confirm disable\n"\
-                       "/te: Tool enable     /td: Tool disable\n"
\ No newline at end of file
+                       "/te: Tool enable     /td: Tool disable\n"\
+                       "/tk: Token costs\n"
\ No newline at end of file
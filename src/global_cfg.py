@@ -29,6 +29,7 @@ Date: [2026/02/20]
 import os
 import sys
 import platform
+import startup
 
 # Global configuration variables
 global_debug = 1
@@ -42,6 +43,30 @@ debug_json = 1
 grok_use_fileio = 0  
 # confirm_need switch, if set to 1, the agent will ask for user confirm before executing tool command
 confirm_need = 0
+# batch_cache switch, if set to 1, the results of read-only batch commands (listings, cat, git status)
+# are cached for batch_cache_ttl seconds or until a sandbox file changes, see tool_batch.py
+batch_cache = 0
+batch_cache_ttl = 30
+# the resource limits of every batch command, and of the shell it runs in: cpu seconds, memory
+# (resident, a cgroup memory.max, needs a systemd user manager) in MB, address space in MB,
+# open files and processes of the user, 0 is no limit, see tool_batch.py.
+# the process limit (RLIMIT_NPROC) counts all processes and threads of the user, the agent's
+# and the desktop's too, not only those of the command, so it's off by default, set it well
+# above the count of `ps -L -u $USER | wc -l` or every fork in the shell fails.
+# the address space limit (RLIMIT_AS) counts reserved virtual memory, not used memory, JVMs,
+# node (WebAssembly) and other programs that reserve large ranges fail to start under it, so
+# it's off by default too
+batch_limits = {"cpu": 300, "memory": 4096, "address_space": 0, "files": 1024, "processes": 0}
+# batch_isolate switch, if set to 1, the batch shells run in a bubblewrap (bwrap) sandbox: a
+# read-only view of the system, a private /tmp, pid and ipc namespaces, only the sandbox dir is
+# writable, needs bwrap installed
+batch_isolate = 0
+# memory_semantic switch, if set to 1, memories are also retrieved by a local semantic index,
+# which needs numpy, otherwise only keyword search is used
+memory_semantic = 1
+# worker_threads is the size of the thread pool that runs the LLM requests and the tool calls of
+# all sessions, sessions beyond it wait for a free worker
+worker_threads = 4
 
 # --- Global configuration from OS ---
 # Notice: these environment variables should be set in the OS before running the program
@@ -76,42 +101,35 @@ debug_dir = f"{workspace}{path_sep}debug"
 fcomm_dir = f"{workspace}{path_sep}fcomm"
 token_dir = f"{workspace}{path_sep}tokens"
 config_dir = f"{workspace}{path_sep}config"
+snapshot_dir = f"{workspace}{path_sep}snapshots"
+cache_dir = f"{workspace}{path_sep}cache"
 
 # --- Files ---
-debug_file = f"{debug_dir}{path_sep}grok.json"
+# the debug JSON log, one message per line, rotated and compressed when it's larger than
+# debug_log_max_bytes, debug_log_keep rotated files are kept, see debuglog.py
+debug_file = f"{debug_dir}{path_sep}grok.jsonl"
+debug_log_max_bytes = 8 * 1024 * 1024
+debug_log_keep = 3
+# mem_file is the plain text memory of older versions, imported into mem_db once
 mem_file = f"{workspace}{path_sep}memories.txt"
+mem_db = f"{workspace}{path_sep}memories.db"
+mem_index_dir = f"{workspace}{path_sep}memory_index"
+# the definitions and prompts of the tools, so the tool modules are imported on first use
+tool_manifest_file = f"{cache_dir}{path_sep}tools.json"
 # the file path for agent and remote terminal communication when grok_use_fileio switch is on
-# when user use terminal or telegram input, the agent will change reply file to grok_fcomm_out,
-# when the agent execute task and want to send the result back to grok, it will change reply file
-# to grok_fcomm_out_task, so that the main loop can distinguish the source of the input and handle
-# the reply accordingly, for example, when the input is from task execution, the main loop can
-# choose to print the reply in terminal instead of sending it back to grok, or do some other 
-# special handling for task execution reply
-# 0 is for normal conversation input,
-# 1 is for telegram bot input,
-grok_fcomm_in_src = 0
-# terminal or local input
+# the grok CLI wrapper writes the user input to grok_fcomm_in, inputs of scheduled tasks and
+# Telegram are given to the runtime directly, see gen.post_input
 grok_fcomm_in = f"{fcomm_dir}{path_sep}msg.grok"
-# daemon task input
-grok_fcomm_in_task = f"{fcomm_dir}{path_sep}msg_task.grok"
-# telegram or other remote input
-grok_fcomm_in_tele = f"{fcomm_dir}{path_sep}msg_tele.grok"
 grok_fcomm_in_table = [
     grok_fcomm_in,
-    grok_fcomm_in_task,
-    grok_fcomm_in_tele,
 ]
 
-def grok_fcomm_remote():
-    return 1 if grok_fcomm_in_src == 1 else 0
-
 # the file path for agent to output tool command and thought when grok_use_fileio switch is on
+# the terminal and the task sessions write to grok_fcomm_out, the output of a Telegram chat
+# is streamed to its handler through the events of the input (see session.py)
 grok_fcomm_out = f"{fcomm_dir}{path_sep}reply.grok"
-grok_fcomm_out_tele = f"{fcomm_dir}{path_sep}reply_tele.grok"
-grok_fcomm_out_tele_active = f"{fcomm_dir}{path_sep}send_tele.grok"
 grok_fcomm_out_table = [
     grok_fcomm_out,
-    grok_fcomm_out_tele,
 ]
 
 grok_token_file = f"{token_dir}{path_sep}grok.token"
@@ -119,6 +137,8 @@ xai_token_file = f"{token_dir}{path_sep}xai.token"
 # --- Communication Protocol Markers ---
 grok_fcomm_done = "<GROK status=done/>"
 grok_fcomm_end = "<GROK status=end/>"
+# data is not written to the files, it only tells the runtime that new output was written
+grok_fcomm_data = "<GROK status=data/>"
 
 grok_fcomm_start = "<GROK status=start/>"
 grok_tool_req_flag = "<tools_req/>"
@@ -136,6 +156,12 @@ if not os.path.exists(fcomm_dir):
     os.makedirs(fcomm_dir)
 if not os.path.exists(token_dir):
     os.makedirs(token_dir)
+if not os.path.exists(snapshot_dir):
+    os.makedirs(snapshot_dir)
+if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+
+startup.mark("global_cfg dirs")
 
 # --- Clear FComm files at startup ---
 for fcomm_file in grok_fcomm_in_table:
@@ -147,6 +173,8 @@ for fcomm_file in grok_fcomm_out_table:
         with open(fcomm_file, "w") as f:
             f.write("")
 
+startup.mark("global_cfg fcomm")
+
 # --- Load API token ---
 with open(grok_token_file, "r") as f:
     grok_token = f.read().rstrip(' \n')
@@ -154,9 +182,3 @@ with open(grok_token_file, "r") as f:
         print("Error: your Grok API key is invalid.")
         exit(-1)
 
-# --- Load previous memories ---
-try:
-    with open(mem_file, "r", encoding="utf-8") as f:
-        memories = f.read()
-except FileNotFoundError:
-    memories = "No previous conversation."
@@ -0,0 +1,147 @@
+"""
+Markdown emphasis to HTML.
+
+Grok marks emphasis with asterisks: ***bold italic***, **bold** and *italic*, converted to
+<i><b>, <b> and <i> tags. The text is read once, left to right:
+- fenced code blocks (``` or ~~~ lines) and code spans (`code`, ``co`de``) are copied
+  as they are, asterisks inside them are not emphasis.
+- a run of 1 to 3 asterisks can open emphasis when the next character is not a space and
+  the previous one is not a letter or digit, it can close emphasis when the previous
+  character is not a space and the next one is not a letter or digit, so shell globs
+  (ls *.py), products (a*b) and bullets (* item) stay as they are.
+- a closer matches the nearest opener of the same length, the openers between them stay
+  asterisks, and so do all unmatched runs. Emphasis and code spans do not span a blank line.
+The conversion is linear in the length of the text.
+"""
+
+tags_open = {1: "<i>", 2: "<b>", 3: "<i><b>"}
+tags_close = {1: "</i>", 2: "</b>", 3: "</b></i>"}
+
+# fence_marker:
+# the fence marker a line opens or closes a code block with, None if it's not a fence
+def fence_marker(line: str):
+    stripped = line.lstrip(" ")
+    if len(line) - len(stripped) > 3:
+        return None
+    for char in "`~":
+        if stripped.startswith(char * 3):
+            return char * (len(stripped) - len(stripped.lstrip(char)))
+    return None
+
+# __is_word:
+# whether a character is a letter or digit, the ends of the text are not
+def __is_word(char: str) -> bool:
+    return char.isalnum()
+
+# __convert_paragraph:
+# convert the emphasis of a paragraph, pieces are appended to out
+def __convert_paragraph(text: str, out: list):
+    n = len(text)
+    pieces = []
+    # open delimiters: [index in pieces, length], and how many of each length are open
+    stack = []
+    open_count = {1: 0, 2: 0, 3: 0}
+    # the code span lengths known to have no closer after a position
+    no_closer = {}
+    start = 0
+    i = 0
+    while i < n:
+        char = text[i]
+        if char == "`":
+            j = i
+            while j < n and text[j] == "`":
+                j += 1
+            ticks = text[i:j]
+            end = -1
+            if no_closer.get(len(ticks), n + 1) > j:
+                search = j
+                while True:
+                    end = text.find(ticks, search)
+                    if end < 0:
+                        no_closer[len(ticks)] = j
+                        break
+                    if end + len(ticks) < n and text[end + len(ticks)] == "`":
+                        # a longer run, skip it
+                        search = end + len(ticks)
+                        while search < n and text[search] == "`":
+                            search += 1
+                        continue
+                    break
+            if end >= 0:
+                # a code span, copied as it is
+                i = end + len(ticks)
+            else:
+                i = j
+            continue
+        if char != "*":
+            i += 1
+            continue
+        j = i
+        while j < n and text[j] == "*":
+            j += 1
+        length = j - i
+        before = text[i - 1] if i > 0 else " "
+        after = text[j] if j < n else " "
+        if length > 3:
+            i = j
+            continue
+        can_close = not before.isspace() and not __is_word(after)
+        can_open = not after.isspace() and not __is_word(before)
+        if can_close and open_count[length]:
+            # close the nearest opener of the same length, the openers above it stay asterisks
+            while True:
+                index, opener_length = stack.pop()
+                open_count[opener_length] -= 1
+                if opener_length == length:
+                    break
+            pieces[index] = tags_open[length]
+            pieces.append(text[start:i])
+            pieces.append(tags_close[length])
+            start = j
+        elif can_open:
+            pieces.append(text[start:i])
+            stack.append([len(pieces), length])
+            open_count[length] += 1
+            pieces.append(text[i:j])
+            start = j
+        i = j
+    pieces.append(text[start:])
+    out.extend(pieces)
+
+# __convert_inline:
+# convert the emphasis of a text without fenced code blocks, paragraph by paragraph, neither
+# emphasis nor code spans go on over a blank line
+def __convert_inline(text: str, out: list):
+    start = 0
+    while True:
+        end = text.find("\n\n", start)
+        if end < 0:
+            __convert_paragraph(text[start:], out)
+            return
+        __convert_paragraph(text[start:end], out)
+        out.append("\n\n")
+        start = end + 2
+
+# md_to_html:
+# convert the emphasis of a text to HTML tags, code blocks and spans are left untouched
+def md_to_html(text: str) -> str:
+    out = []
+    paragraph = []
+    fence = None
+    for line in text.splitlines(keepends=True):
+        if fence is None:
+            marker = fence_marker(line)
+            if marker:
+                __convert_inline("".join(paragraph), out)
+                paragraph = []
+                fence = marker
+                out.append(line)
+            else:
+                paragraph.append(line)
+        else:
+            out.append(line)
+            marker = fence_marker(line)
+            if marker and marker[0] == fence[0] and len(marker) >= len(fence) and not line.strip(" \n" + fence[0]):
+                fence = None
+    __convert_inline("".join(paragraph), out)
+    return "".join(out)
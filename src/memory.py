@@ -0,0 +1,250 @@
+"""
+Long-term memory store for the agent, backed by SQLite.
+
+Every saved conversation is stored as structured records: user input, assistant
+replies, tool calls and tool results, each with a timestamp, the tool name and the
+turn it belongs to. A turn starts with a user input and holds everything the agent
+did to answer it.
+
+The FTS5 full-text index over the records lets the agent retrieve only the turns
+relevant to the current user input (ranked by BM25) instead of pasting the whole
+history into the system prompt, so the prompt size stays flat as memories grow.
+When the SQLite build has no FTS5, retrieval falls back to a plain keyword scan.
+
+The optional semantic index (memory_index.py) is updated with every stored turn,
+its nearest turns are merged with the keyword results by reciprocal rank fusion.
+
+The old plain-text memories.txt is imported once as legacy turns and renamed.
+Key functions:
+- memory_entry: build a record to store, the sessions keep conversation.Record ones.
+- memory_store: write the pending records of a conversation to the store.
+- memory_retrieve: render the top-k relevant turns for the <MEMORY/> prompt section.
+- memory_clear_all: forget everything.
+"""
+# python standard library
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# project modules
+import global_cfg as glb
+import memory_index
+
+# max number of turns pasted into the prompt, and max characters per record
+memory_top_k = 5
+memory_record_chars = 600
+
+memory_lock = threading.Lock()
+memory_conn = None
+memory_fts = 1
+
+# ================================================================
+# Database
+# ================================================================
+# __connect:
+# open the database once, create the tables and import the legacy memory file
+def __connect():
+    global memory_conn, memory_fts
+    if memory_conn is not None:
+        return memory_conn
+    memory_conn = sqlite3.connect(glb.mem_db, check_same_thread=False)
+    memory_conn.execute("""
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY,
+            turn INTEGER NOT NULL,
+            time REAL NOT NULL,
+            role TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            tool TEXT,
+            content TEXT NOT NULL
+        )""")
+    memory_conn.execute("CREATE INDEX IF NOT EXISTS records_turn ON records(turn)")
+    try:
+        memory_conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS records_fts
+            USING fts5(content, tool, content='records', content_rowid='id')""")
+    except sqlite3.OperationalError:
+        print("Memory: SQLite has no FTS5, fall back to keyword scan.")
+        memory_fts = 0
+    memory_conn.commit()
+    __import_legacy()
+    __sync_index()
+    return memory_conn
+
+# __sync_index:
+# build the semantic index from the store when it's missing, e.g. the first start with
+# numpy installed, later updates are incremental
+def __sync_index():
+    if not memory_index.index_enabled() or memory_index.index_size():
+        return
+    turns = [row[0] for row in memory_conn.execute("SELECT DISTINCT turn FROM records")]
+    memory_index.index_add(__turn_texts(turns))
+
+# __turn_texts:
+# the text of each turn for the semantic index, as a list of (turn, text)
+def __turn_texts(turns):
+    texts = {}
+    for turn in turns:
+        texts[turn] = []
+    for start in range(0, len(turns), 500):
+        batch = turns[start:start + 500]
+        marks = ",".join("?" for _ in batch)
+        for turn, content in memory_conn.execute(
+                f"SELECT turn, content FROM records WHERE turn IN ({marks}) ORDER BY id", batch):
+            texts[turn].append(content[:memory_record_chars])
+    return [(turn, "\n".join(parts)) for turn, parts in texts.items()]
+
+# __import_legacy:
+# import memories.txt written by older versions, one turn per <user> block
+def __import_legacy():
+    if not os.path.isfile(glb.mem_file):
+        return
+    with open(glb.mem_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    blocks = [block for block in re.split(r'(?=<user>)', text) if block.strip()]
+    entries = []
+    for block in blocks:
+        entries.append(memory_entry("user", "legacy", block.strip()))
+    __insert(entries)
+    os.replace(glb.mem_file, f"{glb.mem_file}.migrated")
+    print(f"Memory: imported {len(blocks)} legacy turns from {glb.mem_file}")
+
+# __insert:
+# insert records, a new turn is started by every user record
+def __insert(entries):
+    cursor = memory_conn.cursor()
+    turn = cursor.execute("SELECT COALESCE(MAX(turn), 0) FROM records").fetchone()[0]
+    first_turn = turn + 1
+    if entries and entries[0]["role"] != "user":
+        # the conversation was trimmed before the first user input, open a turn for it
+        turn += 1
+    for entry in entries:
+        if entry["role"] == "user":
+            turn += 1
+        cursor.execute(
+            "INSERT INTO records(turn, time, role, kind, tool, content) VALUES (?, ?, ?, ?, ?, ?)",
+            (turn, entry["time"], entry["role"], entry["kind"], entry["tool"], entry["content"]))
+        if memory_fts:
+            cursor.execute("INSERT INTO records_fts(rowid, content, tool) VALUES (?, ?, ?)",
+                           (cursor.lastrowid, entry["content"], entry["tool"] or ""))
+    memory_conn.commit()
+    if memory_index.index_enabled() and entries:
+        memory_index.index_add(__turn_texts(list(range(first_turn, turn + 1))))
+
+# ================================================================
+# Memory operations
+# ================================================================
+# memory_entry:
+# build one record of the conversation, kind is one of user, assistant, tool_call,
+# tool_result or legacy
+def memory_entry(role: str, kind: str, content: str, tool: str = None) -> dict:
+    return {
+        "time": time.time(),
+        "role": role,
+        "kind": kind,
+        "tool": tool,
+        "content": content if content else "",
+    }
+
+# memory_store:
+# write records to the store, return the number of records written
+def memory_store(entries) -> int:
+    with memory_lock:
+        __connect()
+        __insert(entries)
+    return len(entries)
+
+# memory_clear_all:
+# delete all records
+def memory_clear_all():
+    with memory_lock:
+        __connect()
+        memory_conn.execute("DELETE FROM records")
+        if memory_fts:
+            memory_conn.execute("INSERT INTO records_fts(records_fts) VALUES ('delete-all')")
+        memory_conn.commit()
+    memory_index.index_clear()
+
+# __query_terms:
+# turn free text into FTS5 query terms, every word is quoted so that user input can
+# not inject FTS5 operators
+def __query_terms(text: str) -> list[str]:
+    terms = []
+    for word in re.findall(r'\w+', text.lower()):
+        if len(word) > 1 and word not in terms:
+            terms.append(word)
+    return terms[:32]
+
+# memory_search:
+# return the ids of the top-k turns relevant to the text, best first
+def memory_search(text: str, top_k: int = memory_top_k) -> list[int]:
+    terms = __query_terms(text)
+    if not terms:
+        return []
+    with memory_lock:
+        __connect()
+        if memory_fts:
+            query = " OR ".join(f'"{term}"' for term in terms)
+            # bm25() is only allowed in a plain full-text query, rank the records first,
+            # then group the best records by turn
+            rows = memory_conn.execute("""
+                SELECT records.turn, MIN(hits.score) AS score
+                FROM (SELECT rowid, bm25(records_fts) AS score FROM records_fts
+                      WHERE records_fts MATCH ? ORDER BY score LIMIT ?) AS hits
+                JOIN records ON records.id = hits.rowid
+                GROUP BY records.turn ORDER BY score LIMIT ?""",
+                (query, top_k * 8, top_k)).fetchall()
+        else:
+            condition = " OR ".join("content LIKE ?" for _ in terms)
+            rows = memory_conn.execute(f"""
+                SELECT turn, COUNT(*) AS hits FROM records WHERE {condition}
+                GROUP BY turn ORDER BY hits DESC, turn DESC LIMIT ?""",
+                [f"%{term}%" for term in terms] + [top_k]).fetchall()
+    return [row[0] for row in rows]
+
+# memory_render:
+# render turns in the same xml-ish format the agent used to save memories
+def memory_render(turns: list[int]) -> str:
+    if not turns:
+        return ""
+    with memory_lock:
+        __connect()
+        marks = ",".join("?" for _ in turns)
+        rows = memory_conn.execute(f"""
+            SELECT turn, time, kind, tool, content FROM records
+            WHERE turn IN ({marks}) ORDER BY turn, id""", turns).fetchall()
+    if not rows:
+        # the turns are gone, like stale ids of the index
+        return ""
+    out = []
+    current_turn = None
+    for turn, stamp, kind, tool, content in rows:
+        if turn != current_turn:
+            if current_turn is not None:
+                out.append("</turn>\n")
+            current_turn = turn
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(stamp))
+            out.append(f"<turn time=\"{date}\">\n")
+        if len(content) > memory_record_chars:
+            content = content[:memory_record_chars] + "...(truncated)"
+        tag = "assistant" if kind == "tool_call" else kind
+        tool_attr = f" tool=\"{tool}\"" if tool else ""
+        out.append(f"<{tag}{tool_attr}>{content}</{tag}>\n")
+    out.append("</turn>\n")
+    return "".join(out)
+
+# memory_retrieve:
+# get the memories relevant to the user input, ready for the <MEMORY/> prompt section
+def memory_retrieve(text: str, top_k: int = memory_top_k) -> str:
+    turns = memory_search(text, top_k)
+    nearest = memory_index.index_search(text, top_k)
+    if nearest:
+        # reciprocal rank fusion of the keyword and the semantic ranking
+        scores = {}
+        for ranking in (turns, nearest):
+            for rank, turn in enumerate(ranking):
+                scores[turn] = scores.get(turn, 0.0) + 1.0 / (60 + rank)
+        turns = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return memory_render(turns) or "No relevant previous conversation."
@@ -0,0 +1,135 @@
+"""
+Semantic index over saved memory turns.
+
+Keyword search (memory.py) only finds turns that share words with the user input.
+This index adds recall for turns that are related but worded differently: every turn
+is embedded with a hashed n-gram vectorizer (word unigrams, word bigrams and character
+trigrams hashed into a fixed number of buckets, then L2-normalized), and the nearest
+turns are found with a flat cosine-similarity search in NumPy.
+
+The index is append-only and persisted under glb.mem_index_dir as two raw files, so
+saving new memories only appends the new rows instead of rewriting the index:
+- vectors.f32: float32 rows of index_dim values.
+- turns.i64: the memory turn id of each row.
+
+NumPy is optional, without it the index is disabled and memory retrieval uses the
+keyword search only.
+"""
+# python standard library
+import os
+import re
+import threading
+import zlib
+
+# project modules
+import global_cfg as glb
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+index_dim = 1024
+index_lock = threading.Lock()
+index_vectors = None
+index_turns = None
+
+vector_file = f"{glb.mem_index_dir}{glb.path_sep}vectors.f32"
+turn_file = f"{glb.mem_index_dir}{glb.path_sep}turns.i64"
+
+# index_enabled:
+# the semantic index needs numpy and the memory_semantic switch
+def index_enabled() -> bool:
+    return np is not None and glb.memory_semantic
+
+# embed:
+# hashed n-gram vector of a text, crc32 is used because python's hash() is salted per process
+def embed(text: str):
+    vector = np.zeros(index_dim, dtype=np.float32)
+    words = re.findall(r'\w+', text.lower())
+    features = list(words)
+    features += [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    for feature in features:
+        h = zlib.crc32(feature.encode('utf-8'))
+        # the top bit decides the sign to reduce the bias of hash collisions
+        vector[h % index_dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+# __load:
+# load the persisted index once
+def __load():
+    global index_vectors, index_turns
+    if index_vectors is not None:
+        return
+    if os.path.isfile(vector_file) and os.path.isfile(turn_file):
+        index_vectors = np.fromfile(vector_file, dtype=np.float32).reshape(-1, index_dim)
+        index_turns = np.fromfile(turn_file, dtype=np.int64)
+        rows = min(len(index_vectors), len(index_turns))
+        index_vectors = index_vectors[:rows]
+        index_turns = index_turns[:rows]
+    else:
+        index_vectors = np.zeros((0, index_dim), dtype=np.float32)
+        index_turns = np.zeros(0, dtype=np.int64)
+
+# index_size:
+# number of indexed turns
+def index_size() -> int:
+    if not index_enabled():
+        return 0
+    with index_lock:
+        __load()
+        return len(index_turns)
+
+# index_add:
+# embed and append turns, `turns` is a list of (turn_id, text)
+def index_add(turns):
+    global index_vectors, index_turns
+    if not index_enabled() or not turns:
+        return
+    vectors = np.stack([embed(text) for _, text in turns])
+    ids = np.array([turn for turn, _ in turns], dtype=np.int64)
+    with index_lock:
+        __load()
+        os.makedirs(glb.mem_index_dir, exist_ok=True)
+        with open(vector_file, 'ab') as f:
+            vectors.tofile(f)
+        with open(turn_file, 'ab') as f:
+            ids.tofile(f)
+        index_vectors = np.concatenate([index_vectors, vectors])
+        index_turns = np.concatenate([index_turns, ids])
+
+# index_search:
+# return the turn ids nearest to the text, best first, turns under min_score are dropped
+def index_search(text: str, top_k: int, min_score: float = 0.1) -> list[int]:
+    if not index_enabled():
+        return []
+    query = embed(text)
+    with index_lock:
+        __load()
+        if not len(index_turns):
+            return []
+        scores = index_vectors @ query
+        turns = index_turns
+    count = min(top_k, len(scores))
+    best = np.argpartition(-scores, count - 1)[:count]
+    best = best[np.argsort(-scores[best])]
+    return [int(turns[i]) for i in best if scores[i] >= min_score]
+
+# index_clear:
+# drop the whole index
+def index_clear():
+    global index_vectors, index_turns
+    if np is None:
+        return
+    with index_lock:
+        for path in (vector_file, turn_file):
+            if os.path.isfile(path):
+                os.remove(path)
+        index_vectors = None
+        index_turns = None
@@ -0,0 +1,210 @@
+"""
+Asyncio runtime of the agent.
+
+One event loop hosts everything that used to run in separate threads and coordinate
+through module globals:
+- the dispatcher, which takes user inputs from the inbox queue and hands them to the
+  worker of their session,
+- one worker per session (see session.py), which runs the inputs of its session one
+  turn at a time as a cancellable task (agent.agent_turn),
+- the terminal input, either the fcomm file written by the grok CLI wrapper or stdin,
+- the services registered by tools (the task scheduler, the Telegram bots).
+
+Inputs from every source go through the inbox queue (gen.post_input). Sessions run
+concurrently, a turn in one Telegram chat does not wait for a turn in another. Within a
+session, a new input pre-empts the running turn: the turn task is cancelled at its next
+await and the new input is handled right away. When the agent is waiting for a tool
+confirm, the next input of the session answers it.
+
+Blocking LLM requests and tool executions run in a bounded thread pool of
+glb.worker_threads workers shared by all sessions, a cancelled turn stops waiting for
+them at once, their late results are dropped.
+
+Stopping is event driven too: gen.request_reset wakes the runtime, which cancels all
+tasks and returns.
+"""
+# python standard library
+import asyncio
+import collections
+import concurrent.futures
+import os
+import sys
+import threading
+
+# project modules
+import global_cfg as glb
+import general as gen
+import agent
+import config
+import session
+import startup
+import tools
+
+loop = None
+inbox = None
+stop_event = None
+# the input queue and the worker task of every session, by session key
+session_queues = {}
+session_workers = {}
+
+# ================================================================
+# Hooks for other threads, see general.py
+# ================================================================
+# __post_input:
+# queue a user input, thread-safe
+def __post_input(source, text, events=None, chat_id=None, bot=None):
+    message = {"source": source, "chat_id": chat_id, "bot": bot, "text": text, "events": events}
+    loop.call_soon_threadsafe(inbox.put_nowait, message)
+
+# __output_marker:
+# forward an output marker and the output of a remote session, as (marker, text), to the
+# events queue of the input the current session is handling, thread-safe
+def __output_marker(marker, text=""):
+    events = session.session_current()["events"]
+    if events is not None:
+        loop.call_soon_threadsafe(events.put_nowait, (marker, text))
+
+# __reset:
+# stop the runtime, thread-safe
+def __reset(reason):
+    loop.call_soon_threadsafe(stop_event.set)
+
+# ================================================================
+# Input sources
+# ================================================================
+# fcomm_input_service:
+# read the input of the grok CLI wrapper from the fcomm file, the wrapper is another
+# process, so the file is checked every 0.1 second
+async def fcomm_input_service():
+    while True:
+        if os.path.isfile(glb.grok_fcomm_in):
+            with open(glb.grok_fcomm_in, 'r') as f:
+                fcomm_rx = f.read()
+            # find start flag in the file, if found, clear the file and queue the content
+            # before the start flag as user input
+            if fcomm_rx.find(glb.grok_fcomm_start) >= 0:
+                open(glb.grok_fcomm_in, 'w').write('')
+                __post_input("terminal", fcomm_rx.replace(glb.grok_fcomm_start, '').strip())
+        await asyncio.sleep(0.1)
+
+# __stdin_reader:
+# read stdin in a daemon thread, a blocking read must not keep the program alive
+def __stdin_reader():
+    for line in sys.stdin:
+        __post_input("terminal", line.rstrip("\n"))
+
+# ================================================================
+# Session workers
+# ================================================================
+# __run_turn:
+# run one input of the session as a task, and watch the session queue while it runs
+async def __run_turn(current, message, queue, pending):
+    current["events"] = message["events"]
+    turn = asyncio.create_task(agent.agent_turn(message["text"]))
+    while not turn.done():
+        getter = asyncio.create_task(queue.get())
+        done, _ = await asyncio.wait({turn, getter}, return_when=asyncio.FIRST_COMPLETED)
+        if getter not in done:
+            getter.cancel()
+            continue
+        new_message = getter.result()
+        # a command (/r and the like) is not the answer to a tool confirm, it pre-empts the turn
+        if current["confirm_future"] and not current["confirm_future"].done() \
+                and not new_message["text"].startswith("/"):
+            # the answer to a tool confirm, the turn goes on and its output goes to the
+            # reader of the answer, the reader of the first input got the end flag
+            current["events"] = new_message["events"]
+            current["confirm_future"].set_result(new_message["text"])
+        else:
+            gen.debug_out(f"SYS: New input pre-empts the current turn of {current['key']}.")
+            turn.cancel()
+            pending.appendleft(new_message)
+    try:
+        await turn
+    except asyncio.CancelledError:
+        gen.myprint("Turn cancelled.")
+    except Exception as e:
+        gen.myprint(f"ERROR: agent turn failed. {e}")
+    # the end flag lets the remote terminal stop waiting
+    gen.grok_end()
+    current["events"] = None
+
+# session_worker:
+# handle the inputs of one session one by one, the session is entered once, the turn
+# tasks and their worker threads inherit it
+async def session_worker(current, queue):
+    session.session_enter(current)
+    pending = collections.deque()
+    while True:
+        message = pending.popleft() if pending else await queue.get()
+        await __run_turn(current, message, queue, pending)
+
+# dispatcher:
+# hand every input to the worker of its session, start the worker at the first input
+async def dispatcher():
+    while True:
+        message = await inbox.get()
+        current = session.session_get(message["source"], message["chat_id"], message["bot"])
+        key = current["key"]
+        if key not in session_workers:
+            gen.debug_out(f"SYS: New session {key}.")
+            session_queues[key] = asyncio.Queue()
+            session_workers[key] = asyncio.create_task(
+                __guard(f"session {key}", session_worker(current, session_queues[key])))
+        session_queues[key].put_nowait(message)
+
+# __guard:
+# run a service, a failing service is reported but does not stop the others
+async def __guard(name, service):
+    try:
+        await service
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Service {name} stopped with error: {e}")
+
+# ================================================================
+# Entry
+# ================================================================
+# runtime_main:
+# start the agent worker, the input sources and the tool services, then wait for stop
+async def runtime_main():
+    global loop, inbox, stop_event
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+    stop_event = asyncio.Event()
+    # asyncio.to_thread runs on the default executor, bound it so concurrent sessions can
+    # not start more LLM requests and tool calls than the pool allows
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+        max_workers=glb.worker_threads, thread_name_prefix="agent"))
+    gen.input_hook = __post_input
+    gen.output_hook = __output_marker
+    gen.reset_hook = __reset
+
+    services = [asyncio.create_task(dispatcher()),
+                asyncio.create_task(__guard("config", config.config_service()))]
+    if glb.grok_use_fileio:
+        services.append(asyncio.create_task(fcomm_input_service()))
+    else:
+        threading.Thread(target=__stdin_reader, daemon=True).start()
+    for name, tool in tools.tools.items():
+        if tool.get("service"):
+            services.append(asyncio.create_task(__guard(name, tool["service"]())))
+
+    startup.mark("runtime services")
+    if startup.trace:
+        # the tool modules of the services are imported lazily, wait for them so the trace
+        # shows their import time
+        await asyncio.gather(*[asyncio.to_thread(tools.tool_import, name)
+                               for name, tool in tools.tools.items() if tool.get("service")],
+                             return_exceptions=True)
+        startup.mark("service imports")
+    startup.done()
+
+    gen.grok_end()
+    await stop_event.wait()
+    gen.debug_out(f"SYS: Reset flag detected: {gen.reset_flag}, exiting.")
+    services += session_workers.values()
+    for service in services:
+        service.cancel()
+    await asyncio.gather(*services, return_exceptions=True)
@@ -0,0 +1,120 @@
+"""
+Conversation sessions.
+
+The agent serves several conversations at once: the local terminal, the task scheduler
+and every Telegram chat. Each conversation is a session with its own message history,
+memory buffer and tool state, so one conversation never sees the turns of another, and
+a slow turn in one chat does not hold up the others.
+
+Sessions are keyed by source:
+- "terminal": the local terminal or the grok CLI wrapper.
+- "task": the inputs of scheduled tasks.
+- "telegram:<bot>:<chat id>": one per Telegram bot and chat, a user or a group.
+
+Every Telegram bot (agent00, agent01, ...) is an agent worker of its own, it may have a
+profile that overrides the models of the cascade routes and limits the tools it offers,
+see session_profile. Sessions without a profile use the defaults of agent.cfg.
+
+The session of the running turn is kept in a context variable. asyncio tasks and
+asyncio.to_thread copy the context, so the code of a turn, on the event loop or in a
+worker thread, finds its session with session_current() without passing it around.
+Code that runs outside any turn, like startup, gets the terminal session.
+"""
+# python standard library
+import contextvars
+import threading
+
+# project modules
+import global_cfg as glb
+import conversation
+
+# the system prompt every new session starts with, set by gen.message_init
+default_system = ""
+# the profile of every bot, by bot name, see session_profile
+profiles = {}
+# functions called with a session when it's reset (/r), the tools drop the state they keep
+# for the session, like the shell of the batch tool
+reset_hooks = []
+
+sessions = {}
+sessions_lock = threading.Lock()
+current_session = contextvars.ContextVar("current_session", default=None)
+
+# session_key:
+# the key of the session of a source, bot and chat_id tell the Telegram chats apart
+def session_key(source: str, chat_id=None, bot=None) -> str:
+    key = source
+    if bot is not None:
+        key += f":{bot}"
+    if chat_id is not None:
+        key += f":{chat_id}"
+    return key
+
+# session_profile:
+# register the profile of a bot, the sessions of the bot use it, a profile is a dict:
+# - models: the model of some cascade routes, {"main": ..., "aux": ..., "code": ...}
+# - tools: the names of the tools the bot may use, None for all tools
+# a registered profile is updated in place, so the running sessions see the change
+def session_profile(bot: str, models: dict = None, tools: list = None):
+    profiles.setdefault(bot, {}).update({"models": models or {}, "tools": tools})
+
+# __session_new:
+# a session is a plain dict, the fields are:
+# - conversation: the messages sent to grok and the records to save to the memory store
+#   on /ms, see conversation.py
+# - current_tools: the tool definitions offered to grok in this turn
+# - tool_used_last_time: whether the last reply called tools, the turn goes on if so
+# - tool_result: the result of the last tool call
+# - initial: set by a reset, the next turn prints the welcome info
+# - memory_query, memory_text: the memories retrieved for the latest user input
+# - memory_prompt: the system prompt of the latest request, with the memories and the
+#   tools offered in the turn
+# - confirm_future: set while the turn waits for a tool confirm from the user
+# - events: the events queue of the input that is being handled, see runtime.py
+# - remote: 1 for remote terminals like Telegram, they get a lite format
+# - out_file: the fcomm file the output of the session goes to, remote sessions have none,
+#   their output goes to the events
+# - profile: the models and tools of the bot, see session_profile
+def __session_new(key: str, source: str, chat_id, bot) -> dict:
+    remote = 1 if source == "telegram" else 0
+    return {
+        "key": key,
+        "source": source,
+        "chat_id": chat_id,
+        "bot": bot,
+        "profile": profiles.get(bot, {"models": {}, "tools": None}),
+        "remote": remote,
+        "out_file": None if remote else glb.grok_fcomm_out,
+        "conversation": conversation.Conversation(default_system),
+        "current_tools": [],
+        "tool_used_last_time": 0,
+        "tool_result": "",
+        "initial": 0,
+        "memory_query": None,
+        "memory_text": "",
+        "memory_prompt": "",
+        "confirm_future": None,
+        "events": None,
+    }
+
+# session_get:
+# return the session of a source, create it at the first input
+def session_get(source: str, chat_id=None, bot=None) -> dict:
+    key = session_key(source, chat_id, bot)
+    with sessions_lock:
+        if key not in sessions:
+            sessions[key] = __session_new(key, source, chat_id, bot)
+        return sessions[key]
+
+# session_enter:
+# make a session the current one of the running task or thread
+def session_enter(session: dict):
+    current_session.set(session)
+
+# session_current:
+# the session of the running turn, the terminal session outside any turn
+def session_current() -> dict:
+    session = current_session.get()
+    if session is None:
+        session = session_get("terminal")
+    return session
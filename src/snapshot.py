@@ -0,0 +1,263 @@
+"""
+Versioned snapshot store for sandbox files.
+
+Every file touched by the fileio tool gets a version history instead of a single
+'.bak' copy. File content is split into line-aligned, content-defined chunks, each
+chunk is zlib-compressed and stored once under its sha256, so a long editing session
+only pays for the lines that actually changed.
+
+Layout under glb.snapshot_dir:
+- objects/<2 hex>/<sha256>: compressed chunk data, shared by all files and versions.
+- index/<sha1 of path>.json: the version list of one file, and the current head.
+
+Each version records its parent, so an undo moves the head back along the chain and
+a new edit after an undo starts a new branch, the old versions stay in the history.
+Key functions:
+- snapshot_record: record the current state of a file as a new version if it changed.
+- snapshot_undo: restore a file to an earlier version.
+- snapshot_history: list the versions of a file.
+- snapshot_diff: unified diff between the file and one of its versions.
+- change_hooks: the functions called with the path of every file the fileio tool changes,
+  like the read-only result cache of the batch tool.
+"""
+# python standard library
+import difflib
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+# project modules
+import global_cfg as glb
+
+object_dir = f"{glb.snapshot_dir}{glb.path_sep}objects"
+index_dir = f"{glb.snapshot_dir}{glb.path_sep}index"
+# a chunk is cut at a line boundary when the line hash hits the mask and the chunk is
+# not too small, or when the chunk reaches the hard size limit
+chunk_min_size = 512
+chunk_max_size = 16384
+chunk_cut_mask = 0x1F
+
+# the fileio tool may be called from several threads, keep index updates atomic
+snapshot_lock = threading.Lock()
+# the functions called with the path of a changed file, see snapshot_changed
+change_hooks = []
+
+# ================================================================
+# Chunk store
+# ================================================================
+# split_chunks:
+# split data into line-aligned chunks, the cut points only depend on the content of
+# the lines around them, so an insertion only changes the chunks it touches
+def split_chunks(data: bytes) -> list[bytes]:
+    chunks = []
+    start = 0
+    pos = 0
+    size = len(data)
+    while pos < size:
+        end = data.find(b'\n', pos)
+        end = size if end == -1 else end + 1
+        line_hash = zlib.crc32(data[pos:end])
+        pos = end
+        chunk_size = pos - start
+        if chunk_size >= chunk_max_size or \
+            (chunk_size >= chunk_min_size and (line_hash & chunk_cut_mask) == 0):
+            chunks.append(data[start:pos])
+            start = pos
+    if start < size:
+        chunks.append(data[start:])
+    return chunks
+
+# __object_path:
+# get the storage path of a chunk by its hash
+def __object_path(digest: str) -> str:
+    return f"{object_dir}{glb.path_sep}{digest[:2]}{glb.path_sep}{digest}"
+
+# put_chunk:
+# store a chunk if it is not stored yet, return its hash
+def put_chunk(chunk: bytes) -> str:
+    digest = hashlib.sha256(chunk).hexdigest()
+    path = __object_path(digest)
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(chunk, 6))
+        os.replace(tmp_path, path)
+    return digest
+
+# get_chunk:
+# load a chunk by its hash
+def get_chunk(digest: str) -> bytes:
+    with open(__object_path(digest), 'rb') as f:
+        return zlib.decompress(f.read())
+
+# ================================================================
+# Version index
+# ================================================================
+# __index_path:
+# get the index file path of a tracked file
+def __index_path(path: str) -> str:
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return f"{index_dir}{glb.path_sep}{key}.json"
+
+def __load_index(path: str) -> dict:
+    index_file = __index_path(path)
+    if not os.path.isfile(index_file):
+        return {"path": path, "head": None, "versions": []}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def __save_index(index: dict):
+    os.makedirs(index_dir, exist_ok=True)
+    index_file = __index_path(index["path"])
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_file, index_file)
+
+def __find_version(index: dict, version_id):
+    for version in index["versions"]:
+        if version["id"] == version_id:
+            return version
+    return None
+
+# __read_state:
+# read the current state of a file as (deleted, data)
+def __read_state(path: str) -> tuple[bool, bytes]:
+    if not os.path.isfile(path):
+        return True, b''
+    with open(path, 'rb') as f:
+        return False, f.read()
+
+# __version_data:
+# rebuild the content of a version from its chunks
+def __version_data(version: dict) -> bytes:
+    return b''.join(get_chunk(digest) for digest in version["chunks"])
+
+# snapshot_changed:
+# tell the change hooks that a file was changed
+def snapshot_changed(path: str):
+    for hook in change_hooks:
+        hook(path)
+
+# snapshot_tracked:
+# only files inside the sandbox are tracked
+def snapshot_tracked(path: str) -> bool:
+    sandbox = os.path.realpath(glb.sandbox)
+    return os.path.realpath(path).startswith(sandbox + os.sep)
+
+# snapshot_record:
+# record the current state of the file as a new version on top of the head, nothing
+# is recorded when the state equals the head, return the head version id
+def snapshot_record(path: str, op: str):
+    if op != "external":
+        snapshot_changed(path)
+    if not snapshot_tracked(path):
+        return None
+    path = os.path.realpath(path)
+    with snapshot_lock:
+        index = __load_index(path)
+        deleted, data = __read_state(path)
+        head = __find_version(index, index["head"])
+        if head is None and deleted:
+            # never existed, nothing to remember
+            return None
+        if head is None and op == "external":
+            op = "original"
+        chunks = [put_chunk(chunk) for chunk in split_chunks(data)]
+        if head and head["deleted"] == deleted and head["chunks"] == chunks:
+            return head["id"]
+        version_id = len(index["versions"]) + 1
+        index["versions"].append({
+            "id": version_id,
+            "parent": index["head"],
+            "time": time.time(),
+            "op": op,
+            "size": len(data),
+            "deleted": deleted,
+            "chunks": chunks,
+        })
+        index["head"] = version_id
+        __save_index(index)
+        return version_id
+
+# snapshot_undo:
+# move the head back `steps` versions along the parent chain and restore the file,
+# changes made outside the fileio tool are recorded first so they can be redone
+def snapshot_undo(path: str, steps: int = 1) -> str:
+    if not snapshot_tracked(path):
+        return "ERROR: only files in the sandbox have history."
+    if steps < 1:
+        return "ERROR: steps must be a positive number."
+    snapshot_record(path, "external")
+    path = os.path.realpath(path)
+    with snapshot_lock:
+        index = __load_index(path)
+        target = __find_version(index, index["head"])
+        if target is None:
+            return "ERROR: no history for this file."
+        for _ in range(steps):
+            target = __find_version(index, target["parent"])
+            if target is None:
+                return "ERROR: not enough history to undo."
+        if target["deleted"]:
+            if os.path.isfile(path):
+                os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(__version_data(target))
+        index["head"] = target["id"]
+        __save_index(index)
+    snapshot_changed(path)
+    return f"SUCCESS: file restored to version {target['id']}."
+
+# snapshot_history:
+# list the versions of a file, newest first, the head is marked with '*'
+def snapshot_history(path: str) -> str:
+    if not snapshot_tracked(path):
+        return "ERROR: only files in the sandbox have history."
+    path = os.path.realpath(path)
+    with snapshot_lock:
+        index = __load_index(path)
+    if not index["versions"]:
+        return "ERROR: no history for this file."
+    lines = []
+    for version in reversed(index["versions"]):
+        mark = '*' if version["id"] == index["head"] else ' '
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(version["time"]))
+        state = "deleted" if version["deleted"] else f"{version['size']} bytes"
+        lines.append(f"{mark} v{version['id']} parent={version['parent']} {stamp} "
+                     f"{version['op']} {state}")
+    return "\n".join(lines)
+
+# snapshot_diff:
+# unified diff from a version to the current file, the default version is the parent
+# of the head, which shows what the last edit changed
+def snapshot_diff(path: str, version_id=None) -> str:
+    if not snapshot_tracked(path):
+        return "ERROR: only files in the sandbox have history."
+    path = os.path.realpath(path)
+    with snapshot_lock:
+        index = __load_index(path)
+        head = __find_version(index, index["head"])
+        if head is None:
+            return "ERROR: no history for this file."
+        if version_id is None:
+            if head["parent"] is None:
+                return "ERROR: no earlier version to diff against."
+            version_id = head["parent"]
+        version = __find_version(index, version_id)
+        if version is None:
+            return f"ERROR: version {version_id} not found."
+        old_data = __version_data(version)
+    _, new_data = __read_state(path)
+    old_lines = old_data.decode('utf-8', errors='replace').splitlines(keepends=True)
+    new_lines = new_data.decode('utf-8', errors='replace').splitlines(keepends=True)
+    diff = "".join(difflib.unified_diff(old_lines, new_lines,
+                                        fromfile=f"{path}@v{version['id']}",
+                                        tofile=f"{path}@current"))
+    return diff if diff else "No difference."
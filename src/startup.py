@@ -0,0 +1,167 @@
+"""
+Startup tracing of the agent.
+
+The startup is marked in phases (global_cfg, the agent setup, the tools, the AI vendor,
+the runtime services), every mark records the time since this module was imported, main.py
+imports it first. The marks cost nothing unless the environment variable grok_startup_trace
+is set, then the phases are written to debug/startup_phases.json once the runtime is ready
+for input, and with grok_startup_exit also set the agent exits right after.
+
+Run this module to trace or benchmark the startup:
+    $ python3 src/startup.py --runs 3 --budget 3.0
+It starts the agent main.py the given number of times with -X importtime and the tracing
+variables set, takes the phases of every run and the import time of every module, and
+writes the report of the fastest run to debug/startup_report.json, with the import time
+summed per top level package (openai, xai_sdk, telegram, ...). When the fastest run is
+slower than the budget in seconds it exits with 1, so a benchmark script can fail on a
+startup regression.
+"""
+# python standard library
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+trace = os.getenv("grok_startup_trace") == "1"
+trace_exit = os.getenv("grok_startup_exit") == "1"
+start_time = time.perf_counter()
+# the end of every phase, [name, seconds since start]
+phases = []
+
+# mark:
+# the phase of the given name ends now
+def mark(name: str):
+    phases.append([name, time.perf_counter() - start_time])
+
+# done:
+# the agent is ready for input, write the phases when tracing, and exit if asked
+def done():
+    mark("ready")
+    if not trace:
+        return
+    import global_cfg as glb
+    report = {"total": phases[-1][1], "phases": __phase_durations(phases)}
+    with open(f"{glb.debug_dir}{glb.path_sep}startup_phases.json", "w") as f:
+        json.dump(report, f, indent=1)
+    if trace_exit:
+        sys.stdout.flush()
+        os._exit(0)
+
+# __phase_durations:
+# the duration of every phase, from the end of the previous one
+def __phase_durations(marks) -> list:
+    durations = []
+    last = 0.0
+    for name, end in marks:
+        durations.append({"phase": name, "seconds": round(end - last, 4), "end": round(end, 4)})
+        last = end
+    return durations
+
+# __parse_importtime:
+# the lines of -X importtime, "import time: self [us] | cumulative | imported package",
+# nested imports are indented under the package name
+def __parse_importtime(stderr: str) -> list:
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        modules.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_us": int(fields[0]),
+            "cumulative_us": int(fields[1]),
+        })
+    return modules
+
+# __run_once:
+# start the agent once with tracing, return its wall time, phases and imports
+def __run_once(main_file: str, debug_dir: str, timeout: float) -> dict:
+    env = dict(os.environ, grok_startup_trace="1", grok_startup_exit="1")
+    phases_file = os.path.join(debug_dir, "startup_phases.json")
+    if os.path.exists(phases_file):
+        os.remove(phases_file)
+    begin = time.perf_counter()
+    ret = subprocess.run([sys.executable, "-X", "importtime", main_file], env=env,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, text=True, timeout=timeout)
+    wall = time.perf_counter() - begin
+    if not os.path.exists(phases_file):
+        tail = "\n".join(line for line in ret.stderr.splitlines() if not line.startswith("import time:"))
+        raise RuntimeError(f"the agent exited with {ret.returncode} before it was ready.\n{tail[-2000:]}")
+    with open(phases_file, "r") as f:
+        run = json.load(f)
+    run["wall"] = round(wall, 4)
+    run["imports"] = __parse_importtime(ret.stderr)
+    return run
+
+# __packages:
+# the import time summed per top level package, slowest first
+def __packages(imports: list) -> list:
+    packages = {}
+    for module in imports:
+        top = module["module"].split(".")[0]
+        packages[top] = packages.get(top, 0) + module["self_us"]
+    ordered = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return [{"package": name, "seconds": round(us / 1e6, 4)} for name, us in ordered]
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace and benchmark the startup of the agent")
+    parser.add_argument("--runs", type=int, default=1, help="number of startups, the fastest is reported")
+    parser.add_argument("--budget", type=float, default=0, help="fail when the fastest startup takes longer, in seconds")
+    parser.add_argument("--top", type=int, default=15, help="number of packages and modules to print")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a startup")
+    args = parser.parse_args()
+
+    workspace = os.getenv("workspace")
+    if not workspace:
+        print("ERROR: set the workspace environment variable first, see start.sh.")
+        return 2
+    debug_dir = os.path.join(workspace, "debug")
+    os.makedirs(debug_dir, exist_ok=True)
+    main_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+    runs = []
+    for i in range(args.runs):
+        try:
+            runs.append(__run_once(main_file, debug_dir, args.timeout))
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            print(f"ERROR: startup run {i + 1} failed: {e}")
+            return 2
+        print(f"Run {i + 1}: ready in {runs[-1]['total']:.3f}s, process {runs[-1]['wall']:.3f}s")
+    best = min(runs, key=lambda run: run["total"])
+    report = {
+        "runs": [run["total"] for run in runs],
+        "total": best["total"],
+        "wall": best["wall"],
+        "budget": args.budget or None,
+        "phases": best["phases"],
+        "packages": __packages(best["imports"]),
+        "modules": sorted(best["imports"], key=lambda module: module["cumulative_us"], reverse=True),
+    }
+    report_file = os.path.join(debug_dir, "startup_report.json")
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print(f"{'=' * 60}\nPhases:")
+    for phase in report["phases"]:
+        print(f"  {phase['phase']:<32}{phase['seconds']:>9.3f}s")
+    print("Import time by package (self time):")
+    for package in report["packages"][:args.top]:
+        print(f"  {package['package']:<32}{package['seconds']:>9.3f}s")
+    print("Slowest top level imports (cumulative):")
+    for module in [m for m in report["modules"] if m["depth"] == 0][:args.top]:
+        print(f"  {module['module']:<32}{module['cumulative_us'] / 1e6:>9.3f}s")
+    print(f"Report: {report_file}\n{'=' * 60}")
+    if args.budget and best["total"] > args.budget:
+        print(f"FAIL: startup {best['total']:.3f}s exceeds the budget {args.budget:.3f}s.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""
+Inline tag scanner.
+
+The agent marks parts of its output with inline tags, like the files sent to Telegram:
+    some text <grok_tele_file name="report.txt">the content</grok_tele_file> more text
+tag_scan reads such a text once, left to right, and returns its segments as offsets into
+the text, nothing is copied until the caller slices a segment:
+    {"tag": None, "start": 0, "end": 9}                                  the text around tags
+    {"tag": "grok_tele_file", "start": 41, "end": 52, "pars": ['name="report.txt"']}
+the offsets of a segment leave out the whitespace around it, whitespace-only text is left
+out. A tag that is opened but not closed is text.
+
+Run this module for a micro-benchmark of the scanner:
+    $ python3 src/tagscan.py [--size N] [--runs N]
+"""
+# python standard library
+import argparse
+import re
+import sys
+import time
+
+# the compiled opening tag patterns by tag name
+openers = {}
+# the tokens that split the parameters of a tag: an escaped quote, a quote, a comma
+par_pattern = re.compile(r'\\"|"|,')
+
+# split_unquoted_comma:
+# split a string by comma, but ignore the comma in quotes, \" is a quote that does not
+# open or close quotes, the function will return a list of strings
+def split_unquoted_comma(s: str, strip=True) -> list[str]:
+    if not s:
+        return []
+    parts = []
+    current = []
+    in_quotes = False
+    last = 0
+    for match in par_pattern.finditer(s):
+        token = match.group()
+        if token == ',':
+            if in_quotes:
+                continue
+            current.append(s[last:match.start()])
+            field = ''.join(current)
+            parts.append(field.strip() if strip else field)
+            current = []
+        elif token == '"':
+            in_quotes = not in_quotes
+            continue
+        else:
+            current.append(s[last:match.start()])
+            current.append('"')
+        last = match.end()
+    current.append(s[last:])
+    field = ''.join(current)
+    # a trailing comma does not start an empty field
+    if field:
+        parts.append(field.strip() if strip else field)
+    return parts
+
+# __opener:
+# the compiled pattern of the opening tag of a name, the group is the parameter text
+def __opener(tag: str) -> re.Pattern:
+    pattern = openers.get(tag)
+    if pattern is None:
+        pattern = openers[tag] = re.compile(re.escape(f"<{tag}") + r"([^>]*)>")
+    return pattern
+
+# __strip_span:
+# the offsets of text[start:end] without the whitespace around it
+def __strip_span(text: str, start: int, end: int) -> tuple:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+# __text_segment:
+# append the text segment of text[start:end] to out, stripped of the whitespace around
+# it, unless it's only whitespace
+def __text_segment(text: str, start: int, end: int, out: list):
+    start, end = __strip_span(text, start, end)
+    if start < end:
+        out.append({"tag": None, "start": start, "end": end})
+
+# __tag_scan_range:
+# scan text[start:end] for the tags of a name, append the segments of the tags and of the
+# text before them to out, return the offset after the last tag
+def __tag_scan_range(text: str, tag: str, start: int, end: int, out: list) -> int:
+    opener = __opener(tag)
+    closer = f"</{tag}>"
+    position = start
+    while True:
+        match = opener.search(text, position, end)
+        if match is None:
+            return position
+        close = text.find(closer, match.end(), end)
+        if close < 0:
+            return position
+        __text_segment(text, position, match.start(), out)
+        content_start, content_end = __strip_span(text, match.end(), close)
+        out.append({"tag": tag, "start": content_start, "end": content_end,
+                    "pars": split_unquoted_comma(match.group(1).strip())})
+        position = close + len(closer)
+
+# tag_scan:
+# the segments of a text with the tags of a name, see the module documentation
+def tag_scan(text: str, tag: str) -> list:
+    out = []
+    position = __tag_scan_range(text, tag, 0, len(text), out)
+    __text_segment(text, position, len(text), out)
+    return out
+
+# tag_par:
+# the value of a key=value parameter of a tag segment, without quotes, default if missing
+def tag_par(segment: dict, key: str, default=None):
+    prefix = f"{key}="
+    for par in segment.get("pars", ()):
+        if par.startswith(prefix):
+            return par[len(prefix):].strip('"')
+    return default
+
+# __benchmark_text:
+# a reply of about size characters with text and file tags
+def __benchmark_text(size: int) -> str:
+    unit = ("Here are the results, see the file.\n"
+            '<grok_tele_file name="out.txt", note="a, b">' + "line of output\n" * 20 + "</grok_tele_file>\n")
+    return unit * max(1, size // len(unit))
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the inline tag scanner")
+    parser.add_argument("--size", type=int, default=1000000, help="the size of the largest text, in characters")
+    parser.add_argument("--runs", type=int, default=5, help="the runs per size, the best one is shown")
+    args = parser.parse_args()
+    size = 1000
+    while size <= args.size:
+        text = __benchmark_text(size)
+        best = min(__time(lambda: tag_scan(text, "grok_tele_file")) for _ in range(args.runs))
+        print(f"{len(text):>10} chars  tag_scan {best * 1000:9.3f} ms  "
+              f"{len(text) / best / 1e6:7.1f} Mchar/s")
+        size *= 10
+    return 0
+
+# __time:
+# the seconds a call takes
+def __time(call) -> float:
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,70 @@
+import asyncio
 import importlib
+import json
 import pkgutil
 import sys
+import threading
 from pathlib import Path
 import global_cfg as glb
 
+"""
+Tools are loaded lazily from a manifest: the name, description, definition and prompt of
+every tool are cached in glb.tool_manifest_file, so the agent can offer the tools without
+importing their modules. A tool module is imported on the first call of its handler, or
+when the runtime starts its service, services are started together so their modules are
+imported in parallel worker threads.
+The manifest is rebuilt for a module whose file changed (mtime or size), by importing it
+once and calling its tool_register.
+"""
 tools = {}
+# the module of every tool, by tool name
+tool_modules = {}
+# the info returned by tool_register of the imported modules, by tool name
+tool_registered = {}
+# a lock per tool, the modules of different tools are imported in parallel
+tool_locks = {}
+tool_locks_lock = threading.Lock()
+
+# __module_stamp:
+# the stamp of a module file, a changed stamp rebuilds its manifest entry
+def __module_stamp(path: Path) -> list:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+# __manifest_read:
+# the cached manifest, by module name, empty when missing or broken
+def __manifest_read() -> dict:
+    try:
+        with open(glb.tool_manifest_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# tool_import:
+# import the module of a tool and return what its tool_register returns, thread-safe
+def tool_import(name: str) -> dict:
+    with tool_locks_lock:
+        lock = tool_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in tool_registered:
+            module = importlib.import_module(tool_modules[name])
+            tool_registered[name] = module.tool_register()
+        return tool_registered[name]
+
+# __lazy_handler:
+# a handler that imports the tool module at its first call
+def __lazy_handler(name: str):
+    def handler(*args, **kwargs):
+        return tool_import(name)["handler"](*args, **kwargs)
+    return handler
+
+# __lazy_service:
+# a service that imports the tool module in a worker thread, then runs the real service
+def __lazy_service(name: str):
+    async def service():
+        info = await asyncio.to_thread(tool_import, name)
+        await info["service"]()
+    return service
 
 def load_tools(tools_dir: str) -> dict:
     global tools
@@ -14,16 +74,45 @@ def load_tools(tools_dir: str) -> dict:
     if str(tools_path.parent) not in sys.path:
         sys.path.insert(0, str(tools_path.parent))
 
+    manifest = __manifest_read()
+    updated = {}
     for finder, module_name, _ in pkgutil.iter_modules([str(tools_path)]):
         full_module_name = f"{tools_path.name}.{module_name}"
-        # try:
-        module = importlib.import_module(full_module_name)
-        if hasattr(module, "tool_register"):
+        stamp = __module_stamp(tools_path / f"{module_name}.py")
+        entry = manifest.get(module_name)
+        if not entry or entry["stamp"] != stamp:
+            module = importlib.import_module(full_module_name)
+            if not hasattr(module, "tool_register"):
+                continue
             info = module.tool_register()
-            tools[info["name"]] = info
-            print(f"✅ Load: Tool [{info['name']}] - {info['description']}")
-        # except Exception as e:
-        #     print(f"❌ Failed to load tool {module_name}: {e}")
+            tool_registered[info["name"]] = info
+            entry = {
+                "stamp": stamp,
+                "name": info["name"],
+                "description": info["description"],
+                "definition": info["definition"],
+                "prompt": info["prompt"],
+                "service": "service" in info,
+            }
+        updated[module_name] = entry
+        tool_modules[entry["name"]] = full_module_name
+        tools[entry["name"]] = {
+            "name": entry["name"],
+            "description": entry["description"],
+            "handler": __lazy_handler(entry["name"]),
+            "definition": entry["definition"],
+            "prompt": entry["prompt"],
+        }
+        if entry["service"]:
+            tools[entry["name"]]["service"] = __lazy_service(entry["name"])
+        print(f"✅ Load: Tool [{entry['name']}] - {entry['description']}")
+    if updated != manifest:
+        try:
+            with open(glb.tool_manifest_file, "w", encoding="utf-8") as f:
+                json.dump(updated, f, ensure_ascii=False, indent=1)
+        except OSError as e:
+            print(f"❌ Failed to save the tool manifest: {e}")
+    return tools
 
 
 def run_tool(tools: dict, name: str, args=None):
@@ -40,4 +129,4 @@ def load_all_tools():
 if __name__ == "__main__":
     load_all_tools()
     while True:
-        pass
\ No newline at end of file
+        pass
@@ -1,8 +1,25 @@
+import os
+import re
+import secrets
+import selectors
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
 import global_cfg as glb
+import session
+import snapshot
 
-# tool_batch costs approximately 200 tokens when sent to the LLM vendor.
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# the token cost of tool_batch is counted by toolset.py, see the /tk command.
 if sys.platform.lower().__contains__("win"):
     tool_define_batch = {
         "type": "function",
@@ -41,13 +58,15 @@ else:
             "name": "batch",
             "description": (
                 "Execute a bash command in the user's terminal. "
+                "The shell is kept between the calls of a conversation: cd, exported variables "
+                "and an activated virtualenv stay for the next calls. "
                 "**When user require to search or list files in sandbox, must use this tool. **"
                 "Allowed uses: directory listing, reading file content (cat), simple checks, "
                 "environment queries, and other non-destructive operations. "
                 "NEVER use this tool to create, modify, append, overwrite, or delete any file. "
                 "Use raw bash syntax only — no HTML encoding. "
                 "Rules: "
-                f"(1) NEVER use 'cd'; use absolute paths starting with {glb.sandbox}. "
+                f"(1) Use absolute paths starting with {glb.sandbox}, or cd into it first. "
                 "(2) NEVER chain commands after a heredoc EOF with &&. "
                 "(3) One call = at most 1-2 simple actions. "
                 "(4) Output raw syntax: use < > not &lt; &gt;, use && not &amp;&amp;, "
@@ -72,16 +91,468 @@ tool_rule_batch = """Must only used in sandbox, unless user give you permission
 NEVER use `batch` to create, modify, append, overwrite, or delete any file.
 Must use this tool for sandbox file seraching and listing. """
 
-# tool_handle_batch:
-# handle the batch tool call from grok, currently just print the command and thought, and ask for confirm
-def tool_handle_batch(cmd):
+# ================================================================
+# Shell sessions
+# ================================================================
+# on POSIX every conversation session has a bash of its own that lives across the batch
+# calls, so cd, exported variables and activated virtualenvs persist, and a call does not
+# start a new shell. a command is sent with a framed protocol: it runs through eval, with
+# stdin from /dev/null, then a random sentinel is printed to stdout with the return code
+# and the working directory, and to stderr, the output is read up to the sentinels.
+# a syntax error of the command does not stop the shell, a shell that exits, hangs longer
+# than batch_timeout or fails the health check after batch_idle_check idle seconds is
+# killed and a new one is started. at most batch_shell_max shells are kept, the least
+# recently used one is stopped first.
+# a runaway command must not take the agent down: the shell sets the limits of
+# glb.batch_limits with ulimit when it starts, every command inherits them, so a command
+# is stopped when it uses up its CPU time, and can not open more files or start more
+# processes than allowed. the memory limit caps the resident memory of the shell and all
+# it started, it's the memory.max of a cgroup, the shell runs in a systemd scope of its
+# own (systemd-run --user --scope), without a systemd user manager it's not set. the
+# address space limit (ulimit -v) is only set when configured. with glb.batch_isolate the shell runs in
+# bwrap, where only the sandbox dir is writable. the CPU time of a command is read from
+# /proc/<shell>/stat before and after it, a command that ran longer than
+# batch_usage_report seconds or hit a limit gets its usage in the tool result.
+batch_shell_max = 8
+batch_timeout = 600
+batch_idle_check = 60
+batch_usage_report = 1.0
+# the ulimit options of glb.batch_limits, and the factor from the configured unit
+limit_options = {"cpu": ("-t", 1), "address_space": ("-v", 1024), "files": ("-n", 1), "processes": ("-u", 1)}
+# whether systemd-run can start a scope with a memory limit, None until it's tried
+memory_scope = None
+clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+# the shells by session key, least recently used first, each is a dict:
+# proc, lock (one command at a time), cwd (after the last command), used (monotonic time),
+# times (the user and system CPU seconds of the shell and its children so far)
+batch_shells = {}
+batch_shells_lock = threading.Lock()
+
+# __memory_scope:
+# the command prefix that runs a command in a systemd scope with the memory limit of
+# glb.batch_limits, empty when there is no limit or no systemd user manager to run it
+def __memory_scope() -> list:
+    global memory_scope
+    memory = glb.batch_limits.get("memory")
+    if not memory:
+        return []
+    scope = ["systemd-run", "--user", "--scope", "--quiet", "-p", f"MemoryMax={memory}M", "--"]
+    if memory_scope is None:
+        memory_scope = False
+        if shutil.which("systemd-run"):
+            try:
+                memory_scope = subprocess.run(scope + ["true"], capture_output=True,
+                                              timeout=10).returncode == 0
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        if not memory_scope:
+            print("Batch tool: systemd-run can not start a user scope, the memory limit is not set.")
+    return scope if memory_scope else []
+
+# __shell_command:
+# the command line of a shell, in bwrap when the shells are isolated, in a memory limited
+# scope when it can be
+def __shell_command() -> list:
+    shell = ["bash", "--noprofile", "--norc"]
+    if glb.batch_isolate:
+        bwrap = shutil.which("bwrap")
+        if bwrap is None:
+            print("Batch tool: bwrap is not installed, the shells are not isolated.")
+        else:
+            shell = [bwrap, "--ro-bind", "/", "/", "--dev", "/dev", "--proc", "/proc", "--tmpfs", "/tmp",
+                     "--bind", glb.sandbox, glb.sandbox, "--chdir", glb.sandbox,
+                     "--unshare-pid", "--unshare-ipc", "--unshare-uts", "--die-with-parent", "--"] + shell
+    return __memory_scope() + shell
+
+# __shell_limits:
+# the ulimit command of glb.batch_limits, soft and hard limits, so a command can not raise
+# them again, the hard CPU limit is a few seconds later, a command gets SIGXCPU at the soft
+# one and is reported as out of CPU time
+def __shell_limits() -> str:
+    options = []
+    for name, value in glb.batch_limits.items():
+        if value and name in limit_options:
+            option, factor = limit_options[name]
+            options.append(f"{option} {value * factor + (5 if name == 'cpu' else 0)}")
+    if not options:
+        return ""
+    command = f"ulimit {' '.join(options)}"
+    if glb.batch_limits.get("cpu"):
+        command += f" && ulimit -S -t {glb.batch_limits['cpu']}"
+    return command
+
+# __shell_start:
+# start a shell in the sandbox, in a process group of its own, with the resource limits
+def __shell_start() -> dict:
+    proc = subprocess.Popen(__shell_command(), cwd=glb.sandbox,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            start_new_session=True)
+    os.set_blocking(proc.stdout.fileno(), False)
+    os.set_blocking(proc.stderr.fileno(), False)
+    shell = {"proc": proc, "lock": threading.Lock(), "cwd": glb.sandbox, "used": time.monotonic(),
+             "times": None}
+    limits = __shell_limits()
+    if limits:
+        returncode, _, err = shell_exec(shell, limits, 5)
+        if returncode != 0:
+            print(f"Batch tool: the resource limits are not set. {err.strip()}")
+    return shell
+
+# shell_stop:
+# kill a shell and everything it started
+def shell_stop(shell: dict):
+    proc = shell["proc"]
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+# shell_exec:
+# run a command in a shell, return (returncode, stdout, stderr), the returncode is None
+# when the shell exited or the command timed out, the shell must be stopped then
+def shell_exec(shell: dict, cmd: str, timeout: float) -> tuple:
+    proc = shell["proc"]
+    sentinel = f"__grok_{secrets.token_hex(8)}__"
+    quoted = cmd.replace("'", "'\\''")
+    # the sentinel line: the return code, the fields of /proc/<shell>/stat after the
+    # command name, and the working directory, separated by tabs
+    script = (f"eval '{quoted}' < /dev/null\n"
+              f"__grok_status=$?\n"
+              f"read -r __grok_stat < /proc/$$/stat 2>/dev/null || __grok_stat=\n"
+              f"printf '\\n%s %d\\t%s\\t%s\\n' {sentinel} \"$__grok_status\" \"${{__grok_stat##*) }}\" \"$PWD\"\n"
+              f"printf '\\n%s\\n' {sentinel} >&2\n")
+    try:
+        proc.stdin.write(script.encode())
+        proc.stdin.flush()
+    except OSError as e:
+        return None, "", f"the shell is not running: {e}"
+    markers = {proc.stdout.fileno(): f"\n{sentinel} ".encode(), proc.stderr.fileno(): f"\n{sentinel}\n".encode()}
+    # the output of each stream, and where its sentinel was found
+    data = {fd: bytearray() for fd in markers}
+    found = {}
+    selector = selectors.DefaultSelector()
+    for fd in markers:
+        selector.register(fd, selectors.EVENT_READ)
+    deadline = time.monotonic() + timeout
+    returncode = None
+    try:
+        while len(found) < 2 or returncode is None:
+            left = deadline - time.monotonic()
+            if left <= 0 or not selector.get_map():
+                break
+            for key, _ in selector.select(left):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fd)
+                    continue
+                buffer = data[key.fd]
+                start = max(0, len(buffer) - len(markers[key.fd]))
+                buffer += chunk
+                if key.fd not in found:
+                    index = buffer.find(markers[key.fd], start)
+                    if index >= 0:
+                        found[key.fd] = index
+            stdout_fd = proc.stdout.fileno()
+            if stdout_fd in found and returncode is None:
+                line_start = found[stdout_fd] + len(markers[stdout_fd])
+                line_end = data[stdout_fd].find(b"\n", line_start)
+                if line_end >= 0:
+                    line = bytes(data[stdout_fd][line_start:line_end]).decode(errors="replace")
+                    code, stat, shell["cwd"] = line.split("\t", 2)
+                    returncode = int(code)
+                    shell["times"] = shell_times(stat)
+        if returncode is None and not selector.get_map():
+            # both pipes are closed, the shell exited
+            try:
+                proc.wait(1)
+            except subprocess.TimeoutExpired:
+                pass
+    finally:
+        selector.close()
+    out, err = (bytes(data[fd][:found.get(fd, len(data[fd]))]).decode(errors="replace") for fd in markers)
+    if returncode is None:
+        if err and not err.endswith("\n"):
+            err += "\n"
+        if proc.poll() is None:
+            err += f"The command did not finish in {timeout} seconds."
+        else:
+            err += f"The shell exited with {proc.returncode}."
+    return returncode, out, err
+
+# shell_times:
+# the user and system CPU seconds of a shell and its children from the fields of its
+# /proc stat after the command name, None when they are not known
+def shell_times(stat: str):
+    fields = stat.split()
+    if len(fields) < 15:
+        return None
+    # utime, stime, cutime and cstime are the fields 14 to 17 of the stat line
+    utime, stime, cutime, cstime = (int(field) for field in fields[11:15])
+    return ((utime + cutime) / clock_ticks, (stime + cstime) / clock_ticks)
+
+# __usage:
+# the usage note of a command, empty when it was quick and hit no limit
+def __usage(before, after, wall: float, returncode: int) -> str:
+    limit = ""
+    if returncode in (128 + signal.SIGXCPU, -signal.SIGXCPU):
+        limit = ", limit=the command used up its CPU time limit"
+    elif returncode in (128 + signal.SIGKILL, -signal.SIGKILL):
+        limit = ", limit=the command was killed, it may have run out of memory"
+    if wall < batch_usage_report and not limit:
+        return ""
+    usage = f", usage=wall {wall:.2f}s"
+    if before and after:
+        user = after[0] - before[0]
+        system = after[1] - before[1]
+        usage += f", cpu {user + system:.2f}s (user {user:.2f}s, sys {system:.2f}s)"
+    return usage + limit
+
+# __shell_get:
+# the shell of the current session, a new one when it has none or it's not running, the
+# shell is returned locked, its lock is taken under batch_shells_lock so the shell can not
+# be stopped as the least recently used one before it's used, a shell that is busy with
+# another command of the session is waited for
+def __shell_get() -> dict:
+    key = session.session_current()["key"]
+    stopped = []
+    while True:
+        with batch_shells_lock:
+            shell = batch_shells.pop(key, None)
+            if shell is not None and not shell["lock"].acquire(blocking=False):
+                busy = batch_shells[key] = shell
+            else:
+                if shell is not None and shell["proc"].poll() is not None:
+                    shell["lock"].release()
+                    stopped.append(shell)
+                    shell = None
+                if shell is None:
+                    shell = __shell_start()
+                    shell["lock"].acquire()
+                batch_shells[key] = shell
+                for other in list(batch_shells):
+                    if len(batch_shells) <= batch_shell_max:
+                        break
+                    if not batch_shells[other]["lock"].locked():
+                        stopped.append(batch_shells.pop(other))
+                break
+        with busy["lock"]:
+            pass
+    for old in stopped:
+        shell_stop(old)
+    return shell
+
+# __shell_drop:
+# stop a shell of a session, the next call starts a new one
+def __shell_drop(key: str, shell: dict):
+    with batch_shells_lock:
+        if batch_shells.get(key) is shell:
+            del batch_shells[key]
+    shell_stop(shell)
+
+# __shell_reset:
+# stop the shell of a session that is reset, the new conversation starts with a new shell
+# in the sandbox, not in the working directory and the variables of the old one
+def __shell_reset(current: dict):
+    shell = batch_shells.get(current["key"])
+    if shell is not None:
+        __shell_drop(current["key"], shell)
+
+# shell_cwd:
+# the working directory of the shell of the current session
+def shell_cwd() -> str:
+    shell = batch_shells.get(session.session_current()["key"])
+    return shell["cwd"] if shell else glb.sandbox
+
+# __shell_run:
+# run a command in the shell of the current session, a shell that does not answer the
+# health check after a while is replaced first
+def __shell_run(cmd):
+    key = session.session_current()["key"]
+    shell = __shell_get()
+    try:
+        if time.monotonic() - shell["used"] > batch_idle_check and shell_exec(shell, ":", 5)[0] is None:
+            __shell_drop(key, shell)
+            shell["lock"].release()
+            shell = None
+            shell = __shell_get()
+        before = shell["times"]
+        start = time.monotonic()
+        returncode, out, err = shell_exec(shell, cmd, batch_timeout)
+        shell["used"] = time.monotonic()
+        usage = __usage(before, shell["times"], shell["used"] - start, returncode)
+        if returncode is None:
+            # a shell that exited reports its exit code, a command that timed out -1
+            returncode = shell["proc"].poll()
+            if returncode is None:
+                returncode = -1
+            __shell_drop(key, shell)
+            err += " A new shell is started, the working directory and the variables are reset."
+    finally:
+        if shell is not None:
+            shell["lock"].release()
+    return f"returncode={returncode}, stdout={out}, stderr={err}{usage}"
+
+# ================================================================
+# Read-only result cache
+# ================================================================
+# when glb.batch_cache is on, the results of read-only commands are kept by command, so a
+# listing repeated in a tool loop does not start a shell again. a cached result is used
+# for glb.batch_cache_ttl seconds, until a file is changed by the fileio tool (see
+# snapshot.change_hooks) or, with the watchdog package, by anything in the sandbox, or
+# until a command that is not read-only runs. the model is told when a result is cached.
+# a command is read-only when every command of its pipes and lists is one of
+# read_only_commands, without redirections to files, command or process substitutions,
+# parameter expansions that assign (${X:=y}) or background jobs. commands that run another
+# command (env, xargs, nice, timeout) are not in the list, whatever they run.
+read_only_commands = {
+    "ls", "dir", "cat", "type", "head", "tail", "wc", "grep", "egrep", "fgrep", "rg", "findstr",
+    "find", "stat", "file", "du", "df", "pwd", "echo", "printenv", "uname", "whoami", "id",
+    "tree", "sort", "cut", "diff", "cmp", "md5sum", "sha1sum", "sha256sum", "basename",
+    "dirname", "realpath", "readlink", "which", "where", "git",
+}
+# the read-only subcommands of git, and the options that make a command run or write
+# something, also with the value attached (-ofile) or in a group of short options (-uo),
+# any --output option does too
+read_only_git = {"status", "log", "diff", "show", "ls-files", "rev-parse", "blame", "describe"}
+writing_options = {
+    "find": {"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"},
+    "sort": {"-o"},
+    "tree": {"-o"},
+    "rg": {"--pre"},
+    "file": {"-C", "--compile"},
+    "git": {"--ext-diff", "--textconv"},
+}
+# the operators that split a command into simple commands, and the unsafe constructs, an
+# assigning expansion sets a variable of the persistent shell, a cached result would skip it
+list_pattern = re.compile(r"\|\||&&|[|;\n]")
+unsafe_pattern = re.compile(r"`|\$\(|\$\{[^}]*=|<\(|<<|(?<![0-9>&])&(?![&>])|>(?!\s*/dev/null|&[0-9])")
+batch_cache_max = 128
+# the cached results by (session key, working directory, command), each is (time, result),
+# the generation counts the invalidations, a result is only cached when no file changed
+# while the command ran
+batch_results = {}
+batch_generation = 0
+batch_lock = threading.Lock()
+batch_observer = None
+
+# __writing_option:
+# whether the words of a simple command have one of its writing_options
+def __writing_option(words: list) -> bool:
+    for option in writing_options.get(words[0], ()):
+        for word in words[1:]:
+            if word.startswith(option):
+                return True
+            # a group of short options, like -uo for -u -o
+            if len(option) == 2 and len(word) > 2 and word[0] == "-" and word[1] != "-" \
+                    and option[1] in word:
+                return True
+    return False
+
+# batch_read_only:
+# whether a command only reads, see read_only_commands
+def batch_read_only(cmd: str) -> bool:
+    if unsafe_pattern.search(cmd):
+        return False
+    for part in list_pattern.split(cmd):
+        try:
+            words = shlex.split(part)
+        except ValueError:
+            return False
+        if not words:
+            continue
+        if words[0] not in read_only_commands:
+            return False
+        if words[0] == "git" and (len(words) < 2 or words[1] not in read_only_git):
+            return False
+        if __writing_option(words):
+            return False
+        if any(word.startswith("--output") for word in words):
+            return False
+    return True
+
+# batch_invalidate:
+# forget the cached results, a file may have changed
+def batch_invalidate(path=None):
+    global batch_generation
+    with batch_lock:
+        batch_generation += 1
+        batch_results.clear()
+
+# __sandbox_event:
+# forget the cached results when the sandbox changes, opening and reading files does not
+# count, and neither do the files git refreshes under .git while reading
+def __sandbox_event(event):
+    if f"{glb.path_sep}.git{glb.path_sep}" in event.src_path:
+        return
+    if event.event_type in ("created", "deleted", "modified", "moved"):
+        batch_invalidate(event.src_path)
+
+# __watch_sandbox:
+# watch the sandbox for changes made outside the tools, needs the watchdog package
+def __watch_sandbox():
+    global batch_observer
+    if Observer is None or batch_observer is not None:
+        return
+    handler = FileSystemEventHandler()
+    handler.on_any_event = __sandbox_event
+    batch_observer = Observer()
+    batch_observer.daemon = True
+    try:
+        batch_observer.schedule(handler, glb.sandbox, recursive=True)
+        batch_observer.start()
+    except OSError as e:
+        print(f"Batch tool: the sandbox is not watched, cached results expire after {glb.batch_cache_ttl} seconds. {e}")
+
+# __batch_run:
+# run a command in the shell of the session, a new cmd.exe on Windows
+def __batch_run(cmd):
     try:
+        if not glb.os_type.startswith("win"):
+            return __shell_run(cmd)
         ret = subprocess.run(cmd, text=True, shell=True, capture_output=True)
         ret = f"returncode={ret.returncode}, stdout={ret.stdout}, stderr={ret.stderr}"
     except Exception as e:
         ret = f"ERROR: Exception occurred while executing batch command. Exception: {e}"
     return ret
 
+# tool_handle_batch:
+# handle the batch tool call from grok, currently just print the command and thought, and ask for confirm
+def tool_handle_batch(cmd):
+    if not glb.batch_cache:
+        return __batch_run(cmd)
+    if not batch_read_only(cmd):
+        # the command may change files
+        ret = __batch_run(cmd)
+        batch_invalidate()
+        return ret
+    __watch_sandbox()
+    now = time.monotonic()
+    # the results are kept by session and working directory too, the shells differ
+    key = (session.session_current()["key"], shell_cwd(), cmd)
+    with batch_lock:
+        cached = batch_results.get(key)
+        generation = batch_generation
+    if cached and now - cached[0] < glb.batch_cache_ttl:
+        return (f"{cached[1]}\n(cached result of {now - cached[0]:.0f} seconds ago, "
+                f"the command was not run again)")
+    ret = __batch_run(cmd)
+    with batch_lock:
+        if not ret.startswith("ERROR:") and generation == batch_generation:
+            batch_results.pop(key, None)
+            batch_results[key] = (now, ret)
+            while len(batch_results) > batch_cache_max:
+                del batch_results[next(iter(batch_results))]
+    return ret
+
+snapshot.change_hooks.append(batch_invalidate)
+session.reset_hooks.append(__shell_reset)
+
 def tool_register():
     return {
         "name": "batch",
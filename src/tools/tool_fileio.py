@@ -14,6 +14,7 @@ Key functions:
 - file_delete_lines: Deletes a range of lines.
 - file_replace_lines: Replaces lines with new data.
 - file_replace_symbol: Replaces all occurrences of a symbol in the file.
+- file_undo / file_history / file_diff: Restore and inspect file versions kept by the snapshot store.
 - execute_fileio_command: Parses and executes file I/O commands from agents.
 """
 
@@ -21,8 +22,9 @@ import os
 import sys
 import re
 import global_cfg as glb
+import snapshot
 
-# tool_fileio costs approximately 350 tokens when sent to the LLM vendor.
+# the token cost of tool_fileio is counted by toolset.py, see the /tk command.
 tool_define_fileio = {
     "type": "function",
     "function": {
@@ -62,6 +64,14 @@ tool_define_fileio = {
                         "replace_symbol <path> <symbol> <content>\n"
                         "  Replace all occurrences of <symbol> in the file with <content>. "
                         "Returns error if file or symbol not found.\n\n"
+                        "undo <path> [steps]\n"
+                        "  Restore the file to the version before the last [steps] edits (default 1). "
+                        "Use this to revert a wrong edit instead of rewriting the file.\n\n"
+                        "history <path>\n"
+                        "  List the recorded versions of the file, the current one is marked with *.\n\n"
+                        "diff <path> [version]\n"
+                        "  Show a unified diff from the given version to the current file, "
+                        "default is what the last edit changed.\n\n"
                         "Note: <content> is treated as a single argument. "
                         "Multiple lines of content should be separated by \n"
                     )
@@ -72,7 +82,7 @@ tool_define_fileio = {
     }
 }
 
-tool_brief_fileio = """File I/O tool for reading, writing, delete files, and remove/insert/replace lines in file, and replace symbols. """
+tool_brief_fileio = """File I/O tool for reading, writing, delete files, and remove/insert/replace lines in file, and replace symbols, undo edits and show file history/diff. """
 
 tool_rule_fileio = """All operations must be performed only within the sandbox. NEVER use fileio to modify tasks. """
 
@@ -136,8 +146,10 @@ def file_write(path, data):
     dir_name = os.path.dirname(path)
     if dir_name and not os.path.isdir(dir_name):
         os.makedirs(dir_name)
+    snapshot.snapshot_record(path, "external")
     with open(path, 'w') as f:
         f.write(data)
+    snapshot.snapshot_record(path, "write")
     return "SUCCESS: file written."
 
 # file_read
@@ -161,8 +173,10 @@ def file_append(path, data):
     dir_name = os.path.dirname(path)
     if dir_name and not os.path.isdir(dir_name):
         os.makedirs(dir_name)
+    snapshot.snapshot_record(path, "external")
     with open(path, 'a') as f:
         f.write(data)
+    snapshot.snapshot_record(path, "append")
     return "SUCCESS: file appended."
 
 # file_delete
@@ -172,7 +186,9 @@ def file_delete(path):
     print(f"DEBUG: file_delete called with path={path}")
     """delete a file, if the file does not exist, return error"""
     if os.path.isfile(path):
+        snapshot.snapshot_record(path, "external")
         os.remove(path)
+        snapshot.snapshot_record(path, "delete")
         return "SUCCESS: File deleted."
     else:
         return "ERROR: file not found."
@@ -189,11 +205,9 @@ def file_insert_lines(path, line_num, data):
     """insert multiple lines before line_num"""
     if not os.path.isfile(path):
         return "ERROR: file not found."
+    snapshot.snapshot_record(path, "external")
     with open(path, 'r') as f:
         lines = f.readlines()
-    if not os.path.isfile(path + '.bak'):
-        with open(path + '.bak', 'w') as f:
-            f.writelines(lines)
     if line_num < 1 or line_num > len(lines) + 1:
         return "ERROR: line number out of range."
     data_list = data.split('\n')
@@ -201,6 +215,7 @@ def file_insert_lines(path, line_num, data):
         lines.insert(line_num - 1 + i, item + '\n')
     with open(path, 'w') as f:
         f.writelines(lines)
+    snapshot.snapshot_record(path, "insert_lines")
     return "SUCCESS: line inserted."
 
 # file_delete_lines
@@ -211,11 +226,9 @@ def file_delete_lines(path, line_num, count):
     """delete `count` lines starting from line_num"""
     if not os.path.isfile(path):
         return "ERROR: file not found."
+    snapshot.snapshot_record(path, "external")
     with open(path, 'r') as f:
         lines = f.readlines()
-    if not os.path.isfile(path + '.bak'):
-        with open(path + '.bak', 'w') as f:
-            f.writelines(lines)
     if line_num < 1 or line_num > len(lines):
         return "ERROR: line number out of range."
     if line_num + count - 1 > len(lines):
@@ -223,6 +236,7 @@ def file_delete_lines(path, line_num, count):
     del lines[line_num - 1 : line_num - 1 + count]
     with open(path, 'w') as f:
         f.writelines(lines)
+    snapshot.snapshot_record(path, "delete_lines")
     return "SUCCESS: line deleted."
 
 # file_replace_lines
@@ -234,11 +248,9 @@ def file_replace_lines(path, line_num, count, data):
     """replace `count` lines starting from line_num with data_list"""
     if not os.path.isfile(path):
         return "ERROR: file not found."
+    snapshot.snapshot_record(path, "external")
     with open(path, 'r') as f:
         lines = f.readlines()
-    if not os.path.isfile(path + '.bak'):
-        with open(path + '.bak', 'w') as f:
-            f.writelines(lines)
     if line_num < 1 or line_num > len(lines):
         return "ERROR: line number out of range."
     if line_num + count - 1 > len(lines):
@@ -249,6 +261,7 @@ def file_replace_lines(path, line_num, count, data):
         lines.insert(line_num - 1 + i, item + '\n')
     with open(path, 'w') as f:
         f.writelines(lines)
+    snapshot.snapshot_record(path, "replace_lines")
     return "SUCCESS: line replaced."
 
 # file_replace_symbol
@@ -268,10 +281,37 @@ def file_replace_symbol(path, symbol, data):
     if symbol not in content:
         return "ERROR: symbol not found."
     content = content.replace(symbol, data)
+    snapshot.snapshot_record(path, "external")
     with open(path, 'w') as f:
         f.write(content)
+    snapshot.snapshot_record(path, "replace_symbol")
     return "SUCCESS: symbol replaced."
 
+# ================================================================
+# File history operations, versions are kept by the snapshot store
+# ================================================================
+# file_undo
+# restore the file to the version `steps` edits ago
+def file_undo(path, steps=1):
+    path = path_preprocess(path)
+    print(f"DEBUG: file_undo called with path={path}, steps={steps}")
+    return snapshot.snapshot_undo(path, steps)
+
+# file_history
+# list all recorded versions of the file
+def file_history(path):
+    path = path_preprocess(path)
+    print(f"DEBUG: file_history called with path={path}")
+    return snapshot.snapshot_history(path)
+
+# file_diff
+# show the difference between a recorded version and the current file,
+# without version it shows what the last edit changed
+def file_diff(path, version=None):
+    path = path_preprocess(path)
+    print(f"DEBUG: file_diff called with path={path}, version={version}")
+    return snapshot.snapshot_diff(path, version)
+
 # ================================================================
 # Agent tool calls
 # ================================================================
@@ -302,6 +342,27 @@ def tool_handle_fileio(agent_cmd):
     elif agent_cmd.startswith("replace_symbol "):
         args = agent_cmd[len("replace_symbol "):].split(" ", 2)
         return file_replace_symbol(args[0], args[1], args[2])
+    elif agent_cmd.startswith("undo "):
+        args = agent_cmd[len("undo "):].split()
+        if not args:
+            return "ERROR: undo needs a file path."
+        steps = args[1] if len(args) > 1 else "1"
+        if not steps.isdigit():
+            return f"ERROR: the steps to undo must be a number, not {steps}."
+        return file_undo(args[0], int(steps))
+    elif agent_cmd.startswith("history "):
+        args = agent_cmd[len("history "):].split()
+        if not args:
+            return "ERROR: history needs a file path."
+        return file_history(args[0])
+    elif agent_cmd.startswith("diff "):
+        args = agent_cmd[len("diff "):].split()
+        if not args:
+            return "ERROR: diff needs a file path."
+        version = args[1].lstrip("v") if len(args) > 1 else None
+        if version is not None and not version.isdigit():
+            return f"ERROR: the version must be a number like 3 or v3, not {args[1]}."
+        return file_diff(args[0], int(version) if version is not None else None)
     else:
         return f"ERROR: unknown fileio command."
 
@@ -29,9 +29,9 @@ Note: This module is part of a larger system for task automation and should be u
  scheduling mechanisms.
 """
 # python standard library
+import asyncio
 import os
 import sys
-import threading
 import time
 import xml.etree.ElementTree as ET
 from datetime import datetime
@@ -40,7 +40,7 @@ from datetime import datetime
 import global_cfg as glb
 import general as gen
 
-# tool_task costs approximately 250 tokens when sent to the LLM vendor.
+# the token cost of tool_task is counted by toolset.py, see the /tk command.
 tool_define_task = {
     "type": "function",
     "function": {
@@ -275,8 +275,7 @@ def execute_task(load_task, current_task, task_path, taskfile):
             exec_info += f' Per {interval_seconds} seconds'
         else:
             exec_info = f"(Once)"
-        with open(glb.grok_fcomm_in_task, "w") as f:  # assuming 'agent' is available in scope
-            f.write(f"<scheduled_task info='{exec_info}'>\n{action_text}</scheduled_task>\n{glb.grok_fcomm_start}")
+        gen.post_input("task", f"<scheduled_task info='{exec_info}'>\n{action_text}</scheduled_task>")
             
     # ------------------ Post-execution cleanup / update ------------------
     if not is_loop_enabled:
@@ -328,20 +327,18 @@ def daemon_task():
                   f"which is in {start_time - time.time():.1f} seconds. Task details:")
             print(current_task)
 
-# run_daemon:
-# Run the daemon in a separate thread, the daemon will execute the daemon_task
-# function every interval seconds, the main thread can continue to do other things,
-# and the daemon will keep running in the background
-def run_daemon(interval=1):
-    """Run a daemon that executes every interval seconds"""
-    def worker():
-        while True:
-            if not gen.daemon_pause:
-                daemon_task()
-                time.sleep(interval)
-    
-    thread = threading.Thread(target=worker, daemon=True)
-    thread.start()
+# task_service:
+# the scheduler runs on the runtime's event loop, it checks the task files every interval
+# seconds in a worker thread, due tasks are queued to the agent as inputs, the agent
+# handles them when it's free, so the scheduler never waits for the agent
+async def task_service(interval=1):
+    """Run the scheduler every interval seconds"""
+    while True:
+        try:
+            await asyncio.to_thread(daemon_task)
+        except Exception as e:
+            print(f"Daemon: failed to check tasks. {e}")
+        await asyncio.sleep(interval)
 
 
 # ================================================================
@@ -389,11 +386,11 @@ def tool_handle_task(command):
         return "ERROR: Unknown subcommand."
 
 def tool_register():
-    run_daemon()
     return {
         "name": "task",
         "description": "Manage scheduled tasks with XML-defined actions and looping behavior.",
         "handler": tool_handle_task,
+        "service": task_service,
         "definition": tool_define_task,
         "prompt": {
             "brief": tool_brief_task,
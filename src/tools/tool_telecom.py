@@ -1,23 +1,32 @@
 import os
-import threading
 import asyncio
+import collections
+import concurrent.futures
+import hmac
+import io
 import json
 import random
 import time
 from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 
 import global_cfg as glb
 import general as gen
+import config
+import session
+import tagscan
 
 
-# tool_telecom costs approximately 150 tokens when sent to the LLM vendor.
+# the token cost of tool_telecom is counted by toolset.py, see the /tk command.
 tool_define_telecom = {
     "type": "function",
     "function": {
@@ -47,28 +56,49 @@ tool_brief_telecom = """Send Telegram messages to the user or group chat. """
 
 tool_rule_telecom = """Messages can only send to default users or groups. """
 
-# flag of whether the Telegram bot is handling a message, when grok_handling is 1,
-# it means the bot is handling a message and waiting for the reply from grok, at 
-# this time, if the bot receives another message, it will reply with a non-favored 
-# message to ask the user to wait until the current message is handled, and when 
-# grok_handling is 0, it means the bot is not handling any message, at this time, 
-# if the bot receives a message, it will handle the message and set grok_handling
-# to 1 until it receives the reply from grok and send it back to the user, then set 
-# grok_handling back to 0 to handle the next message
-grok_handling = 0
-
 # read Telegram bot configuration
 cfg_telegram = gen.get_cfg("telegram")
 # create a fast LUT from agent id to agent name for later use
 agent_id_name_map = {}
-for name in cfg_telegram:
-    if name.startswith("agent"):
-        agent_id = int(cfg_telegram[name]['id'])
-        agent_id_name_map.update({agent_id: name})
 
-tool_telecom_send_target = 'user'  # or 'group', decide whether to send message to user or group, if user, the bot will reply to the user who sent the message, if group, the bot will send message to the group defined in the configuration file
-last_chat_user = cfg_telegram['user']['valid_id_1']  # the chat id of the last user who sent a message, used to reply to the user when tool_telecom_send_target is 'user'
-last_chat_group = cfg_telegram['group']['id_1']  # the chat id of the last message received, used to reply to the user when tool_telecom_send_target is 'user'
+# __profiles_build:
+# every agent bot is an agent worker of its own, the optional keys of a bot set its profile:
+# - agentNN_model_main, agentNN_model_aux, agentNN_model_code: the models of its routes
+# - agentNN_tools: comma separated names of the tools it may use, all tools by default
+# the profiles are built again when telegram.cfg changes, new bots need a restart
+def __profiles_build(cfg):
+    for name in cfg:
+        if name.startswith("agent"):
+            agent_id = int(cfg[name]['id'])
+            agent_id_name_map.update({agent_id: name})
+            models = {}
+            for route in ("main", "aux", "code"):
+                if f"model_{route}" in cfg[name]:
+                    models[route] = cfg[name][f"model_{route}"]
+            bot_tools = None
+            if "tools" in cfg[name]:
+                bot_tools = [tool.strip() for tool in str(cfg[name]["tools"]).split(",") if tool.strip()]
+            session.session_profile(name, models, bot_tools)
+
+__profiles_build(cfg_telegram)
+# the active messages of the telecom tool are sent by the first bot
+agent_main_bot = next(iter(agent_id_name_map.values()), None)
+# webhook mode, Telegram pushes the updates to a local receiver instead of being polled
+cfg_webhook = cfg_telegram.get('webhook', {})
+webhook_enable = cfg_webhook.get('enable', 0)
+# the limits of a webhook request: the body size, the header lines, the seconds of a read
+webhook_body_max = 1 << 20
+webhook_headers_max = 100
+webhook_read_timeout = 10
+# the Bot API server, can point to a local stand-in server for tests (env/fake_telegram.py)
+bot_api_url = cfg_telegram.get('api', {}).get('url')
+# the running bots by name, and the event loop they run on
+bot_apps = {}
+bot_loop = None
+
+# the chat ids the telecom tool sends to, the last user and group that sent a message
+last_chat_user = cfg_telegram['user']['valid_id_1']
+last_chat_group = cfg_telegram['group']['id_1']
 
 non_favored_reply_table = [
     "Fuck you!", "Beat it!", "Get lost!", "Scram!", "Take a hike!",
@@ -99,206 +129,422 @@ def split_message(text: str, max_length: int = 4096) -> list[str]:
         text = text[split_pos:].lstrip()
     return chunks
 
+# ================================================================
+# Outbound queue
+# ================================================================
+# every message to Telegram goes through the queue of its bot and chat, the sender of a
+# queue keeps the order of the chat, waits for the tokens of the rate limits, merges the
+# small text messages waiting in a row, and retries on flood wait and network errors,
+# a failed message is reported to the sender and never stops the agent.
+# Telegram allows about 30 messages per second per bot, one per second per private chat
+# and 20 per minute per group, edits count as messages, so every send and edit takes a
+# token of the bucket of the bot and of the chat.
+rate_bot = (30.0, 30)           # tokens per second, burst
+rate_private = (1.0, 1)
+rate_group = (20.0 / 60, 3)
+# token buckets by key, each is [tokens, last refill time]
+rate_buckets = {}
+# the queues by (bot, chat_id), each is {"items": deque, "wake": Event, "task": Task}
+outbox = {}
+# only texts shorter than this are merged, and the merged text stays under the limit
+outbox_merge_chars = 1000
+outbox_max_chars = 4096
+outbox_retries = 5
+
+# __rate_limits:
+# the buckets a message of the bot to the chat takes a token from
+def __rate_limits(bot, chat_id):
+    return [(f"bot:{bot}", rate_bot), (f"chat:{chat_id}", rate_private if chat_id > 0 else rate_group)]
+
+# __rate_acquire:
+# take a token from the buckets of the bot and the chat, return 0 when taken, otherwise
+# the seconds to wait for the tokens, nothing is taken then
+def __rate_acquire(bot, chat_id) -> float:
+    now = time.monotonic()
+    limits = __rate_limits(bot, chat_id)
+    wait = 0.0
+    for key, (rate, burst) in limits:
+        bucket = rate_buckets.setdefault(key, [burst, now])
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            wait = max(wait, (1 - bucket[0]) / rate)
+    if wait:
+        return wait
+    for key, _ in limits:
+        rate_buckets[key][0] -= 1
+    return 0.0
+
+# __rate_penalty:
+# Telegram asked to wait, empty the buckets of the bot and the chat for that long
+def __rate_penalty(bot, chat_id, seconds):
+    now = time.monotonic()
+    for key, (rate, burst) in __rate_limits(bot, chat_id):
+        rate_buckets[key] = [-seconds * rate, now]
+
+# __retry_after:
+# the seconds of a flood wait, newer versions of the library give a timedelta
+def __retry_after(e: RetryAfter) -> float:
+    retry_after = e.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+# __brief:
+# the caption of a document, the head of its content
+def __brief(content):
+    return content[:content.find(' ', 100)] + "..." if len(content) > 100 else content
+
+# outbox_send:
+# queue a text, or a document as (filename, bytes, caption), to a chat and wait until it's
+# sent, return the sent message, merge allows the text to be merged with its neighbors
+async def outbox_send(bot, chat_id, text=None, document=None, merge=False):
+    key = (bot, chat_id)
+    if key not in outbox:
+        outbox[key] = {"items": collections.deque(), "wake": asyncio.Event()}
+        outbox[key]["task"] = asyncio.create_task(__outbox_sender(bot, chat_id, outbox[key]))
+    future = asyncio.get_running_loop().create_future()
+    merge = merge and document is None and len(text) < outbox_merge_chars
+    outbox[key]["items"].append({"text": text, "document": document, "merge": merge, "future": future})
+    outbox[key]["wake"].set()
+    return await future
+
+# __outbox_sender:
+# send the messages of one queue in order
+async def __outbox_sender(bot, chat_id, queue):
+    items = queue["items"]
+    while True:
+        if not items:
+            queue["wake"].clear()
+            await queue["wake"].wait()
+            continue
+        batch = [items.popleft()]
+        if batch[0]["merge"]:
+            size = len(batch[0]["text"])
+            while items and items[0]["merge"] and size + len(items[0]["text"]) + 1 < outbox_max_chars:
+                size += len(items[0]["text"]) + 1
+                batch.append(items.popleft())
+        while wait := __rate_acquire(bot, chat_id):
+            await asyncio.sleep(wait)
+        try:
+            message = await __outbox_deliver(bot, chat_id, batch)
+            for item in batch:
+                if not item["future"].done():
+                    item["future"].set_result(message)
+        except Exception as e:
+            print(f"Telegram outbox: failed to send to {chat_id} by {bot}. {e}")
+            for item in batch:
+                if not item["future"].done():
+                    item["future"].set_exception(e)
+
+# __outbox_deliver:
+# send a batch, retry after a flood wait and with backoff after network errors
+async def __outbox_deliver(bot, chat_id, batch):
+    for attempt in range(outbox_retries):
+        app = bot_apps.get(bot)
+        if app is None:
+            raise RuntimeError(f"Telegram bot {bot} is not running.")
+        try:
+            if batch[0]["document"]:
+                filename, data, caption = batch[0]["document"]
+                return await app.bot.send_document(chat_id=chat_id, document=io.BytesIO(data),
+                                                   filename=filename, caption=caption)
+            text = "\n".join(item["text"] for item in batch)
+            return await app.bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            __rate_penalty(bot, chat_id, __retry_after(e))
+            await asyncio.sleep(__retry_after(e))
+        except BadRequest:
+            raise
+        except (TimedOut, NetworkError) as e:
+            if attempt == outbox_retries - 1:
+                raise
+            gen.debug_out(f"Telegram outbox: {e}, retry in {2 ** attempt} seconds.")
+            await asyncio.sleep(2 ** attempt)
+    raise RuntimeError("Telegram keeps asking to wait, the message is dropped.")
+
 # general_telegram_send:
-# a general function to send message to Telegram
-async def general_telegram_send(handler, fcomm_tx):
+# a general function to send message to Telegram, the <grok_tele_file name=...> parts
+# of the text are sent as documents, the rest as texts, all through the outbound queue
+async def general_telegram_send(bot, chat_id, fcomm_tx, merge=False):
     fcomm_tx = fcomm_tx.strip()
-    if fcomm_tx:
-        remote_tx = gen.xml_parser(fcomm_tx, "grok_tele_file")
-    else:
-        return
-    # reply to the user's message
-    if isinstance(handler, Update):
-        for seq in remote_tx:
-            if seq.__contains__("content"):
-                await handler.message.reply_text(seq["content"]["#text"])
-            else:
-                for key in seq["pars"]["#list"]:
-                    if key.find("name=") == 0:
-                        file_name = key[5:].strip("\"")
-                reply_file = f"{glb.workspace}{glb.path_sep}fcomm{glb.path_sep}{file_name}"
-                content = seq["file_content"]["#text"]
-                with open(reply_file, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                brief = content[:content.find(' ', 100)] + "..." if len(content) > 100 else content
-                await handler.message.reply_document(document=open(reply_file, 'rb'),
-                                                    filename=file_name,
-                                                    caption=brief)
-    # send message to the user or group
-    # bug fixed: ContextTypes.DEFAULT_TYPE is not allowed to compare instance type
-    else:
-        if tool_telecom_send_target == 'user':
-            id = last_chat_user
+    if not fcomm_tx:
+        return []
+    sends = []
+    for segment in tagscan.tag_scan(fcomm_tx, "grok_tele_file"):
+        content = fcomm_tx[segment["start"]:segment["end"]]
+        if segment["tag"] is None:
+            for chunk in split_message(content):
+                sends.append(outbox_send(bot, chat_id, text=chunk, merge=merge))
         else:
-            id = last_chat_group
-        for seq in remote_tx:
-            if seq.__contains__("content"):
-                await handler.bot.send_message(chat_id=id, text=seq["content"]["#text"])
-            else:
-                for key in seq["pars"]["#list"]:
-                    if key.find("name=") == 0:
-                        file_name = key[5:].strip("\"")
-                reply_file = f"{glb.workspace}{glb.path_sep}fcomm{glb.path_sep}{file_name}"
-                content = seq["file_content"]["#text"]
-                with open(reply_file, 'w', encoding='utf-8') as f:
-                    f.write(content)
-                brief = content[:content.find(' ', 100)] + "..." if len(content) > 100 else content
-                await handler.bot.send_document(chat_id=id, 
-                                                document=open(reply_file, 'rb'), 
-                                                filename=file_name, 
-                                                caption=brief) 
-            
+            file_name = tagscan.tag_par(segment, "name", "grok_file.txt")
+            sends.append(outbox_send(bot, chat_id,
+                                     document=(file_name, content.encode("utf-8"), __brief(content))))
+    # the sends are queued in this order, a failed one does not stop the others
+    return await asyncio.gather(*sends, return_exceptions=True)
+
 
+# ================================================================
+# Access control
+# ================================================================
+# only the chats of the user and group ids of telegram.cfg may talk to the bots, the ids
+# are kept in frozen sets built when the configuration is loaded, and checked once per
+# update by acl_middleware before any handler runs, so the handlers do not check access.
+# a change of telegram.cfg applies at once, see config.config_watch.
+# every allowed chat also has a token bucket, an allowed chat that floods is slowed down.
+# the unknown chats share one bucket, so spam from many chat ids does not add a bucket per
+# id: now and then one of them gets a non-favored reply, all other updates from them are
+# dropped right away.
+acl_rate_allowed = (1.0, 10)        # updates per second, burst
+acl_rate_unknown = (1.0 / 60, 1)    # non-favored replies per second, burst
+# the access lists, {"groups": frozenset, "users": frozenset}
+acl = {}
+# token buckets of the allowed chats by chat id, and of all unknown chats by acl_unknown,
+# each is [tokens, last refill time]
+acl_buckets = {}
+acl_unknown = "unknown"
+# anti_flood_cnt is the number of non-favored replies left for all unknown chats, one is
+# given back every second up to anti_flood_max
 anti_flood_cnt = 0
+anti_flood_max = 3
+anti_flood_time = time.time()
+
+# __acl_build:
+# build the access lists from the telegram configuration
+def __acl_build(cfg):
+    acl["groups"] = frozenset(int(i) for i in cfg.get('group', {}).values())
+    acl["users"] = frozenset(int(i) for i in cfg.get('user', {}).values())
+
+# __acl_take:
+# take a token from the bucket of a chat, or of acl_unknown, return False when it has none
+def __acl_take(chat_id, rate, burst):
+    now = time.monotonic()
+    bucket = acl_buckets.setdefault(chat_id, [burst, now])
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
+
+# tackle_non_favored_access:
+# 1 for a group of the access lists, 2 for a user, 0 for an unknown chat
+def tackle_non_favored_access(chat_id):
+    if chat_id in acl["groups"]:
+        return 1
+    if chat_id in acl["users"]:
+        return 2
+    return 0
+
 async def non_favored_access_reply(update: Update):
-    print(f"Non-favored access attempt detected from chat id: {update.message.chat.id}")
-    global anti_flood_cnt
+    print(f"Non-favored access attempt detected from chat id: {update.effective_chat.id}")
+    global anti_flood_cnt, anti_flood_time
+    refill = int(time.time() - anti_flood_time)
+    if refill > 0:
+        anti_flood_cnt = min(anti_flood_max, anti_flood_cnt + refill)
+        anti_flood_time += refill
     if anti_flood_cnt > 0:
         if random.randint(0, 3) == 0:
-            await update.message.reply_text(non_favored_reply_table[random.randint(0, len(non_favored_reply_table) - 1)])
+            await update.effective_message.reply_text(non_favored_reply_table[random.randint(0, len(non_favored_reply_table) - 1)])
             anti_flood_cnt -= 1
 
-def tackle_non_favored_access(update: Update):
-    access_id = update.message.chat.id
-    for i in cfg_telegram['group']:
-        if cfg_telegram['group'][i] == access_id:
-            return 1
-    for i in cfg_telegram['user']:
-        if cfg_telegram['user'][i] == access_id:
-            return 2
-    return 0
+# acl_middleware:
+# runs before all handlers of a bot (handler group -1), an update that is not allowed
+# stops here and no handler sees it
+async def acl_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat is None or update.effective_message is None:
+        raise ApplicationHandlerStop
+    if tackle_non_favored_access(chat.id):
+        if not __acl_take(chat.id, *acl_rate_allowed):
+            gen.debug_out(f"Telegram chat {chat.id} is flooding, update dropped.")
+            raise ApplicationHandlerStop
+        return
+    if __acl_take(acl_unknown, *acl_rate_unknown):
+        await non_favored_access_reply(update)
+    raise ApplicationHandlerStop
+
+# __telegram_cfg_load:
+# apply a changed telegram.cfg, the access lists and the bot profiles
+def __telegram_cfg_load(cfg):
+    __acl_build(cfg)
+    acl_buckets.clear()
+    __profiles_build(cfg)
+    gen.debug_out(f"Telegram access lists reloaded: {len(acl['users'])} users, {len(acl['groups'])} groups.")
+
+__acl_build(cfg_telegram)
+config.config_watch("telegram", __telegram_cfg_load)
+
+# chat_session:
+# the session of the bot and the chat of an update
+def chat_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    bot = agent_id_name_map.get(int(context.bot.id))
+    return session.session_get("telegram", update.message.chat.id, bot)
 
 # start:
 # a handler function when telegram bot receives a /start message
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
     await update.message.reply_text("Start: Hello! I'm Grok, your AI assistant. How can I /help you today?")
 
 # help_command:
 # a handler function when telegram bot receives a /help message
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
     reply = f"Help: Here are the commands you can use:\n{gen.command_description}"
     await update.message.reply_text(reply)
 
-# reset_command:
-# a handler function when telegram bot receives a /r message, it will reset the conversation
-async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
-    await update.message.reply_text(gen.command_handler['r']())
-
 # quit_command:
 # a handler function when telegram bot receives a /q message, it will quit the bot
 async def quit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
     await update.message.reply_text("Goodbye!")
     gen.command_handler['q']()
 
+# session_command:
+# a handler function when telegram bot receives a command of the session: /r reset, /ms
+# memory save, /mc memory clear, /ce /cd confirm enable and disable, /te /td tool enable
+# and disable, /tk token costs. the command is queued to the session like a message and
+# its output is streamed the same way, so it runs between the turns of the session, a
+# command sent during a turn pre-empts it, and /r can not reset the conversation of a
+# running turn
+async def session_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await message_handler(update, context)
 
-# memory_save_command:
-# a handler function when telegram bot receives a /memory message, it will print the current conversation memory
-async def memory_save_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
-    await update.message.reply_text(gen.command_handler['ms']())
-
-# memory_clear_command:
-# a handler function when telegram bot receives a /cm message, it will clear the conversation memory
-async def memory_clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
-    await update.message.reply_text(gen.command_handler['mc']())
-
-# confirm_enable_command:
-# a handler function when telegram bot receives a /ce message, it will enable the confirm mode
-async def confirm_enable_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
-    await update.message.reply_text(gen.command_handler['ce']())
-
-# confirm_disable_command:
-# a handler function when telegram bot receives a /cd message, it will disable the confirm mode
-async def confirm_disable_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
-    await update.message.reply_text(gen.command_handler['cd']())
-
-# tool_enable_command:
-# a handler function when telegram bot receives a /te message, it will enable the tool use
-async def tool_enable_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
-        return
-    await update.message.reply_text(gen.command_handler['te']())
+# ================================================================
+# Streaming replies
+# ================================================================
+# a reply is shown while the turn runs: a placeholder is sent at once, then edited with
+# the output of the agent as it arrives (tool commands, tool results, replies), every done
+# marker closes the message and the next output starts a new one.
+# new messages go through the outbound queue, edits take the tokens of the rate limits
+# themselves, an edit without tokens is put off and merged with the output that arrives
+# meanwhile.
+stream_placeholder = "Whassup boss?"
+stream_max_chars = 4096
+
+# __stream_text:
+# the text of a block as it's shown while streaming, the tail of an oversized block is cut
+def __stream_text(text):
+    text = text.strip()
+    if len(text) > stream_max_chars:
+        text = text[:stream_max_chars - 20].rstrip() + "\n... (continued)"
+    return text
+
+# __stream_send:
+# send or edit the message of the stream, return 0 when done, otherwise the seconds to
+# wait before the next try
+async def __stream_send(stream, text):
+    if stream["message"] is None:
+        try:
+            stream["message"] = await outbox_send(stream["bot"], stream["chat_id"], text=text)
+            stream["shown"] = text
+        except Exception as e:
+            print(f"Telegram stream: failed to send the message. {e}")
+        return 0
+    wait = __rate_acquire(stream["bot"], stream["chat_id"])
+    if wait:
+        return wait
+    try:
+        await stream["message"].edit_text(text)
+        stream["shown"] = text
+    except RetryAfter as e:
+        __rate_penalty(stream["bot"], stream["chat_id"], __retry_after(e))
+        return __retry_after(e)
+    except BadRequest as e:
+        # "message is not modified" and the like, the text is shown anyway
+        stream["shown"] = text
+        gen.debug_out(f"Telegram stream: {e}")
+    except TelegramError as e:
+        print(f"Telegram stream: failed to edit the message. {e}")
+    return 0
 
-# tool_disable_command:
-# a handler function when telegram bot receives a /td message, it will disable the tool use
-async def tool_disable_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if tackle_non_favored_access(update) == 0:
-        await non_favored_access_reply(update)
+# stream_update:
+# show the text of the block so far, return the seconds until the next edit is allowed,
+# or None when the shown text is up to date
+async def stream_update(stream):
+    text = __stream_text(stream["text"])
+    if not text or text == stream["shown"]:
+        return None
+    wait = await __stream_send(stream, text)
+    return wait or None
+
+# stream_finish:
+# show the whole block, waiting for the rate limit if needed, an oversized block is
+# sent as a document, the streamed message keeps its head
+async def stream_finish(stream):
+    text = stream["text"].strip()
+    if not text:
         return
-    await update.message.reply_text(gen.command_handler['td']())
+    wait = await stream_update(stream)
+    while wait:
+        await asyncio.sleep(wait)
+        wait = await stream_update(stream)
+    if len(text) > stream_max_chars:
+        try:
+            await outbox_send(stream["bot"], stream["chat_id"],
+                              document=("grok_reply.txt", text.encode("utf-8"), __brief(text)))
+        except Exception as e:
+            print(f"Telegram stream: failed to send the document. {e}")
+
+# __events_read:
+# the output of the events queued so far after the first one, and whether the turn ended
+def __events_read(events, first):
+    items = [first] if first else []
+    while not events.empty():
+        items.append(events.get_nowait())
+    data = "".join(text for _, text in items)
+    return data, any(marker == glb.grok_fcomm_end for marker, _ in items)
 
 # message_handler:
 # a handler function when telegram bot receives a normal message (not command),
+# the message is queued to the session of the bot and the chat, the reply is streamed
+# to the user: every output of the turn (a data marker with its text on the events queue)
+# updates the current message at the allowed cadence, every done marker in the output
+# finishes it, the end marker finishes the turn. the output comes with the events, so it
+# goes to the handler of the input that is handled, a message that pre-empts or answers a
+# turn only gets the output from then on
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global grok_handling
+    current = chat_session(update, context)
+    print(f"Received Telegram message: {update.message.text} from {current['chat_id']} "
+          f"to {current['bot']}")
+    events = asyncio.Queue()
+    gen.post_input("telegram", update.message.text, events, current["chat_id"], current["bot"])
+    stream = {"update": update, "bot": current["bot"], "chat_id": current["chat_id"],
+              "message": None, "text": "", "shown": ""}
+    # the placeholder shows at once that the message is being handled
+    await __stream_send(stream, stream_placeholder)
+    wait = None
     while True:
-        if not grok_handling:
-            if update:
-                print(f"Received Telegram message: {update.message.text} from {update.message.chat.id}")
-                # handle the message and send reply if needed
-                with open(glb.grok_fcomm_in_tele, 'w') as f:
-                    f.write(update.message.text)
-                    f.write('\n' + glb.grok_fcomm_start)
-                grok_handling = 1
-            else:
-                await asyncio.sleep(1)
-        else:
-            if os.path.isfile(glb.grok_fcomm_out_tele):
-                with open(glb.grok_fcomm_out_tele, 'r') as f:
-                    fcomm_tx = f.read()
-                done = 0
-                end = 0
-                if fcomm_tx.find(glb.grok_fcomm_done) >= 0:
-                    fcomm_tx = fcomm_tx.replace(glb.grok_fcomm_done, '')
-                    done = 1
-                    with open(glb.grok_fcomm_out_tele, 'w') as f:
-                        f.write("")
-                if fcomm_tx.find(glb.grok_fcomm_end) >= 0:
-                    fcomm_tx = fcomm_tx.replace(glb.grok_fcomm_end, '')
-                    end = 1
-                    with open(glb.grok_fcomm_out_tele, 'w') as f:
-                        f.write("")
-                if done or end:
-                    # not empty message, send it back to user
-                    await general_telegram_send(update, fcomm_tx)
-                    if end:
-                        grok_handling = 0
-                        return
-            else:
-                await asyncio.sleep(1)
+        try:
+            first = await asyncio.wait_for(events.get(), wait)
+        except asyncio.TimeoutError:
+            first = None
+        # the markers in the output split it into blocks
+        data, ended = __events_read(events, first)
+        data = data.replace(glb.grok_fcomm_end, glb.grok_fcomm_done)
+        blocks = data.split(glb.grok_fcomm_done)
+        for block in blocks[:-1]:
+            stream["text"] += block
+            await stream_finish(stream)
+            # the next output starts a new message, an unused placeholder is kept for it
+            if stream["text"].strip():
+                stream.update(message=None, text="", shown="")
+        stream["text"] += blocks[-1]
+        if ended:
+            await stream_finish(stream)
+            break
+        wait = await stream_update(stream)
+    # no output at all, the placeholder is not needed
+    if stream["message"] is not None and not stream["text"].strip():
+        try:
+            await stream["message"].delete()
+        except TelegramError:
+            pass
 
 # echo:
-# a handler function when telegram bot receives a normal message (not command), 
-# it will reply with the same message content,
+# a handler function when telegram bot receives a normal message (not command),
+# every bot is an agent worker, each chat with a bot is a session of its own, sessions
+# are answered at the same time, a message sent while the previous one of the same
+# session is still handled pre-empts it, the runtime cancels the running turn and
+# handles the new message
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        if tackle_non_favored_access(update) == 0:
-            await non_favored_access_reply(update)
-            return
         global last_chat_user, last_chat_group
         id = update.message.chat.id
         if id > 0:
@@ -307,116 +553,147 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             last_chat_group = id
         agent = agent_id_name_map.get(int(context.bot.id))
         if agent:
-            if agent == 'agent00':
-                if not grok_handling:
-                    placeholder = await update.message.reply_text("Whassup boss?")
-                    await message_handler(update, context)
-                    await placeholder.delete()
-                else:
-                    await update.message.reply_text("Hold on, I'm handling something for you.")
-            else:
-                pass
+            await message_handler(update, context)
     except Exception as e:
+        # an error of one message must not stop the bot and the agent
         print(f"Error in echo handler: {e}")
-        gen.reset_flag.append(f'Telegram Bot Error {e}')
 
 
-# bot_daemon_send_message:
-# this function is called by the main loop of the agent to send the message in grok
-async def bot_daemon_send_message(context: ContextTypes.DEFAULT_TYPE):
+# __webhook_head:
+# read the request line and the headers of a webhook request, return method, path, headers
+async def __webhook_head(reader):
+    request_line = await reader.readline()
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while len(headers) < webhook_headers_max:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return method, path, headers
+
+# __webhook_receive:
+# a minimal HTTP/1.1 receiver for the updates Telegram pushes in webhook mode, one POST
+# per update to <webhook_url>/<bot name>, the bot is the last segment of the path, so the
+# receiver works with or without a proxy that strips the path of the url, the request must carry the secret token of the webhook, the
+# update is put to the update queue of the bot, the same way the poller does. the receiver
+# is open to anyone who can reach it, so the path and the secret are checked before the
+# body is read, the body is bounded by webhook_body_max and every read by
+# webhook_read_timeout
+async def __webhook_receive(reader, writer):
+    status = "200 OK"
     try:
-        fcomm_tx = ""
-        check_list = [glb.grok_fcomm_out_tele, glb.grok_fcomm_out_tele_active]
-        for fcomm_file in check_list:
-            if not os.path.isfile(fcomm_file):
-                continue
-            if grok_handling == 1 and fcomm_file == glb.grok_fcomm_out_tele:
-                continue
-            done = 0
-            end = 0
-            with open(fcomm_file, 'r') as f:
-                fcomm_tx = f.read()
-                if fcomm_tx.find(glb.grok_fcomm_done) >= 0:
-                    with open(fcomm_file, 'w') as f:
-                        f.write("")
-                    fcomm_tx = fcomm_tx.replace(glb.grok_fcomm_done, '')
-                    done = 1
-                if fcomm_tx.find(glb.grok_fcomm_end) >= 0:
-                    with open(fcomm_file, 'w') as f:
-                        f.write("")
-                    fcomm_tx = fcomm_tx.replace(glb.grok_fcomm_end, '')
-                    end = 1
-                fcomm_tx = fcomm_tx.strip()
-            if fcomm_tx and (done or end):
-                await general_telegram_send(context, fcomm_tx)
-        global anti_flood_cnt
-        if anti_flood_cnt < 3:
-            anti_flood_cnt += 1
+        method, path, headers = await asyncio.wait_for(__webhook_head(reader), webhook_read_timeout)
+        app = bot_apps.get(path.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1])
+        length = int(headers.get("content-length", 0))
+        secret = str(cfg_webhook.get('secret') or "")
+        if method != "POST" or app is None:
+            status = "404 Not Found"
+        elif not secret or not hmac.compare_digest(
+                headers.get("x-telegram-bot-api-secret-token", "").encode(), secret.encode()):
+            status = "403 Forbidden"
+        elif length < 0 or length > webhook_body_max:
+            status = "413 Content Too Large"
+        else:
+            body = await asyncio.wait_for(reader.readexactly(length), webhook_read_timeout)
+            await app.update_queue.put(Update.de_json(json.loads(body), app.bot))
+    except asyncio.TimeoutError:
+        status = "408 Request Timeout"
     except Exception as e:
-        print(f"Error in bot_daemon_send_message: {e}")
-        gen.reset_flag.append(f'Telegram Bot Error {e}')
-
-
-# bot_daemon:
-# this function runs the Telegram bot in a separate thread to avoid blocking the main thread 
-# of the agent, and uses asyncio to run the bot asynchronously, so that it can handle multiple
-# messages at the same time without blocking each other, the bot will also check the access 
-# of the incoming messages and reply with a non-favored message if the access is not allowed,
-# and only allow messages from the specified user ids or group id in the configuration file 
-# to interact with the bot, you can modify the access control logic in the tackle_non_favored_access
-# function as needed, for example, you can add more user ids or group ids to allow, or you can
-# implement a more complex access control logic based on your requirements.
-def bot_daemon(token: str, bot_name: str):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    async def _start_bot(token=token):
-        token = token.strip()
-        app = Application.builder().token(token).build()
-        # add handlers for start, help and echo commands
-        app.add_handler(CommandHandler("start", start_command))
-        app.add_handler(CommandHandler("help", help_command))
-        app.add_handler(CommandHandler("q", quit_command))
-        app.add_handler(CommandHandler("r", reset_command))
-        app.add_handler(CommandHandler("ms", memory_save_command))
-        app.add_handler(CommandHandler("mc", memory_clear_command))
-        app.add_handler(CommandHandler("ce", confirm_enable_command))
-        app.add_handler(CommandHandler("cd", confirm_disable_command))
-        app.add_handler(CommandHandler("te", tool_enable_command))
-        app.add_handler(CommandHandler("td", tool_disable_command))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
-        # a periodic task to check the message from grok and send it to Telegram if needed, runs every 1 second
-        app.job_queue.run_repeating(bot_daemon_send_message, interval=1)
-        # start the bot
+        print(f"Telegram webhook: bad request. {e}")
+        status = "400 Bad Request"
+    try:
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+# bot_service:
+# this coroutine runs one Telegram bot on the event loop of the runtime, together with
+# the agent, the bot keeps handling updates while the agent works, updates are handled
+# concurrently so a new message can pre-empt the turn of the previous one, the bot will
+# also check the access of the incoming updates in acl_middleware before any handler, and
+# only allow messages from the specified user ids or group id in the configuration file to
+# interact with the bot, you can modify the access control logic in the
+# tackle_non_favored_access function as needed.
+async def bot_service(token: str, bot_name: str):
+    token = token.strip()
+    builder = Application.builder().token(token).concurrent_updates(True)
+    if bot_api_url:
+        builder = builder.base_url(bot_api_url)
+    app = builder.build()
+    # add handlers for start, help and echo commands
+    app.add_handler(TypeHandler(Update, acl_middleware), group=-1)
+    app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("q", quit_command))
+    app.add_handler(CommandHandler(["r", "ms", "mc", "ce", "cd", "te", "td", "tk"], session_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
+    try:
         await app.initialize()
-        await app.updater.start_polling(drop_pending_updates=True)
+        if webhook_enable:
+            # Telegram pushes the updates to <webhook_url>/<bot name>, see __webhook_receive
+            await app.bot.set_webhook(url=f"{cfg_webhook['url'].rstrip('/')}/{bot_name}",
+                                      secret_token=str(cfg_webhook['secret']),
+                                      drop_pending_updates=True)
+        else:
+            await app.updater.start_polling(drop_pending_updates=True)
         await app.start()
+        bot_apps[bot_name] = app
         print(f"Agent {bot_name} Start...")
         await asyncio.Event().wait()
-    try:
-        loop.run_until_complete(_start_bot(token))
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
+        # the other bots and the agent go on without this one
         print(f"Agent {bot_name} Error: {e}")
-        gen.reset_flag.append(f'Telegram Bot Error {e}')
-
-
-# start_telegram_bot:
-# starts every bots defined in the telegram configuration file in a separate thread,
-# called by main.py at the beginning to start the Telegram bot
-def start_telegram_bot():
-    # starts every bots defined in the telegram configuration file in a separate thread, 
-    # and also starts a daemon thread to handle the messages received from Telegram
+    finally:
+        bot_apps.pop(bot_name, None)
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+
+
+# telegram_service:
+# runs every bot defined in the telegram configuration file, registered as the service
+# of the telecom tool and started by the runtime, in webhook mode it also runs the
+# receiver of the updates, one for all bots
+async def telegram_service():
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    bots = []
     for name in cfg_telegram:
         if name.startswith("agent"):
-            token = cfg_telegram[name]['token']
-            bot_thread = threading.Thread(target=bot_daemon, args=(token, name), daemon=True)
-            bot_thread.start()
+            bots.append(bot_service(cfg_telegram[name]['token'], name))
+    if not webhook_enable:
+        await asyncio.gather(*bots)
+        return
+    if not cfg_webhook.get('secret'):
+        # the receiver is reachable by anyone, without a secret it can not tell Telegram apart
+        for bot in bots:
+            bot.close()
+        print("Telegram webhook: webhook_secret is not set, the bots are not started.")
+        return
+    server = await asyncio.start_server(__webhook_receive, cfg_webhook.get('listen', '127.0.0.1'),
+                                        cfg_webhook.get('port', 8443))
+    print(f"Telegram webhook listens on {cfg_webhook.get('listen', '127.0.0.1')}:"
+          f"{cfg_webhook.get('port', 8443)}")
+    async with server:
+        await asyncio.gather(*bots)
 
 
 # ================================================================
 # Agent tool calls
 # ================================================================
 # tool_handle_telecom:
-# an active tool for agent to send message to the last contacted user or the group
+# an active tool for agent to send message to the last contacted user or the group,
+# the tool runs in a worker thread, the message is queued to the outbound queue of the
+# first bot, small messages sent in a row may be merged into one, when Telegram asks to
+# wait the tool does not block the turn, the message is sent later
 def tool_handle_telecom(agent_cmd):
     agent_cmd = agent_cmd.strip().split(' ', 1)
     if len(agent_cmd) < 2:
@@ -426,19 +703,28 @@ def tool_handle_telecom(agent_cmd):
     target = target.strip().lower()
     if target != 'user' and target != 'group':
         return "Invalid target for tool_telecom_send, must be 'user' or 'group'"
-    global tool_telecom_send_target
-    tool_telecom_send_target = target
-    with open(glb.grok_fcomm_out_tele_active, 'w') as f:
-        f.write(message)
-        f.write('\n' + glb.grok_fcomm_end)
+    if bot_apps.get(agent_main_bot) is None:
+        return "ERROR: Telegram bot is not running."
+    chat_id = last_chat_user if target == 'user' else last_chat_group
+    future = asyncio.run_coroutine_threadsafe(
+        general_telegram_send(agent_main_bot, chat_id, message, merge=True), bot_loop)
+    try:
+        results = future.result(timeout=10)
+    except concurrent.futures.TimeoutError:
+        return "Telecom tool: The message is queued, Telegram is rate limiting, it will be sent later."
+    except Exception as e:
+        return f"ERROR: Failed to send the Telegram message. {e}"
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        return f"ERROR: Failed to send {len(failed)} of {len(results)} Telegram messages. {failed[0]}"
     return "Telecom tool: Successfully sent the message."
 
 def tool_register():
-    start_telegram_bot()
     return {
         "name": "telecom",
         "description": "Telecom tool for sending messages to users or groups.",
         "handler": tool_handle_telecom,
+        "service": telegram_service,
         "definition": tool_define_telecom,
         "prompt": {
             "brief": tool_brief_telecom,
@@ -0,0 +1,135 @@
+"""
+Tool schema compiler.
+
+The tools are compiled once at startup (toolset_compile): every tool gets a content hash
+of its definition and prompts, its prompt fragments for the system prompt (<TOOLS_DEF/>)
+and the tool router (<TOOLS_BRIEF/>), and its token cost. The AI vendors build their tool
+payloads with toolset_payload, which caches the converted tools by the hashes of the
+tools offered, so a vendor format like the xAI tool objects is built once per tool set,
+not on every request.
+
+Token costs are counted with tiktoken when it is installed (o200k_base, the tokenizer of
+Grok is not public, so it is the nearest exact count), otherwise estimated as 4 characters
+per token. toolset_report shows the cost of every tool and of every section of the system
+prompt, the /tk command prints it.
+"""
+# python standard library
+import hashlib
+import json
+import threading
+
+try:
+    import tiktoken
+    encoder = tiktoken.get_encoding("o200k_base")
+except Exception:
+    encoder = None
+
+# the compiled tools by name, each is a dict:
+# - definition: the tool definition in OpenAI format, as sent to the vendors
+# - hash: the content hash of the definition and the prompts
+# - brief: the fragment of the tool router prompt
+# - prompt: the fragment of the system prompt
+# - tokens: {"definition": ..., "prompt": ..., "brief": ...}
+compiled = {}
+# the prompt sections to report, by name, set by the agent with toolset_section
+sections = {}
+# the vendor payloads by (vendor, hashes of the tools)
+payload_cache = {}
+payload_lock = threading.Lock()
+
+# token_count:
+# the number of tokens of a text
+def token_count(text: str) -> int:
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+# __definition_text:
+# the canonical text of a definition, as serialized in the request
+def __definition_text(definition: dict) -> str:
+    return json.dumps(definition, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+# toolset_compile:
+# compile the tools loaded by tools.load_tools, return the compiled tools
+def toolset_compile(tools: dict) -> dict:
+    compiled.clear()
+    for name, value in tools.items():
+        brief = value['prompt']['brief']
+        rule = value['prompt']['rule']
+        definition_text = __definition_text(value['definition'])
+        entry = {
+            "definition": value['definition'],
+            "hash": hashlib.sha256(f"{definition_text}\0{brief}\0{rule}".encode()).hexdigest()[:16],
+            "brief": f"<tool name=\"{name}\"><brief>{brief}</brief></tool>\n",
+            "prompt": f"<tool name=\"{name}\"><brief>{brief}</brief><rule>{rule}</rule></tool>\n",
+        }
+        entry["tokens"] = {
+            "definition": token_count(definition_text),
+            "prompt": token_count(entry["prompt"]),
+            "brief": token_count(entry["brief"]),
+        }
+        compiled[name] = entry
+    return compiled
+
+# toolset_names:
+# the names of the tools of a list of definitions
+def toolset_names(definitions: list) -> list:
+    return [definition["function"]["name"] for definition in definitions]
+
+# toolset_definitions:
+# the definitions of the named tools, in the order of the names
+def toolset_definitions(names) -> list:
+    return [compiled[name]["definition"] for name in names if name in compiled]
+
+# toolset_prompt:
+# the system prompt fragment of the named tools
+def toolset_prompt(names) -> str:
+    return "".join(compiled[name]["prompt"] for name in names if name in compiled)
+
+# toolset_brief:
+# the tool router prompt fragment of the named tools
+def toolset_brief(names) -> str:
+    return "".join(compiled[name]["brief"] for name in names if name in compiled)
+
+# __definition_hash:
+# the hash of a definition, compiled tools are looked up by name, others are hashed
+def __definition_hash(definition: dict) -> str:
+    entry = compiled.get(definition["function"]["name"])
+    if entry is not None and entry["definition"] is definition:
+        return entry["hash"]
+    return hashlib.sha256(__definition_text(definition).encode()).hexdigest()[:16]
+
+# toolset_payload:
+# the tools of a request in the format of a vendor, convert(definition) builds the vendor
+# format of one tool, the result is cached by the vendor and the hashes of the tools, the
+# cached list must not be modified by the caller
+def toolset_payload(vendor: str, definitions: list, convert) -> list:
+    key = (vendor, tuple(__definition_hash(definition) for definition in definitions))
+    with payload_lock:
+        payload = payload_cache.get(key)
+    if payload is None:
+        payload = [convert(definition) for definition in definitions]
+        with payload_lock:
+            payload_cache[key] = payload
+    return payload
+
+# toolset_section:
+# register a prompt section for the token report
+def toolset_section(name: str, text: str):
+    sections[name] = token_count(text)
+
+# toolset_report:
+# the token cost of every tool and every prompt section
+def toolset_report() -> str:
+    counter = "tiktoken o200k_base" if encoder is not None else "estimated, 4 chars per token"
+    lines = [f"Token costs ({counter}):", "Tools: definition / system prompt / router"]
+    total = [0, 0, 0]
+    for name, entry in compiled.items():
+        tokens = entry["tokens"]
+        lines.append(f"  {name:<12}{tokens['definition']:>6} /{tokens['prompt']:>6} /{tokens['brief']:>6}")
+        total = [total[0] + tokens["definition"], total[1] + tokens["prompt"], total[2] + tokens["brief"]]
+    lines.append(f"  {'all':<12}{total[0]:>6} /{total[1]:>6} /{total[2]:>6}")
+    lines.append("Prompt sections:")
+    for name, tokens in sections.items():
+        lines.append(f"  {name:<24}{tokens:>6}")
+    return "\n".join(lines)
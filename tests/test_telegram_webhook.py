@@ -0,0 +1,107 @@
+"""
+Round trip of the Telegram bridge in webhook mode against the local stand-in server of
+env/fake_telegram.py: a user message is pushed to the webhook receiver of the bot, the
+reply of the bot is read back from /control/sent.
+The workspace is a temporary copy of config/, set before the agent modules are imported.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("telegram")
+
+root = Path(__file__).resolve().parent.parent
+token = "123456:TEST"
+chat_id = 77
+
+
+# __free_port:
+# a port nobody listens on
+def __free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# __control:
+# call a control endpoint of the fake server
+def __control(port, path, data):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/control/{path}",
+                                     data=json.dumps(data).encode(),
+                                     headers={"Content-Type": "application/json"})
+    return json.loads(urllib.request.urlopen(request, timeout=10).read())["result"]
+
+
+# __workspace:
+# a workspace with a telegram.cfg for one bot on the fake server in webhook mode, the
+# webhook url has a path, like a url behind a proxy
+def __workspace(tmp_path, api_port, webhook_port):
+    shutil.copytree(root / "config", tmp_path / "config")
+    (tmp_path / "tokens").mkdir()
+    (tmp_path / "tokens" / "agent00.token").write_text(token)
+    (tmp_path / "tokens" / "grok.token").write_text("test")
+    (tmp_path / "tokens" / "xai.token").write_text("test")
+    cfg = (tmp_path / "config" / "telegram.cfg").read_text()
+    values = {
+        "user_valid_id_1": str(chat_id),
+        "agent00_id": token.split(":")[0],
+        "webhook_enable": "1",
+        "webhook_port": str(webhook_port),
+        "webhook_url": f'"http://127.0.0.1:{webhook_port}/telegram"',
+        "webhook_secret": "test-secret",
+    }
+    for key, value in values.items():
+        cfg = re.sub(rf"^{key}=.*$", f"{key}={value}", cfg, flags=re.M)
+    cfg = re.sub(r"^; api_url=.*$", f'api_url="http://127.0.0.1:{api_port}/bot"', cfg, flags=re.M)
+    (tmp_path / "config" / "telegram.cfg").write_text(cfg)
+    return tmp_path
+
+
+def test_webhook_round_trip(tmp_path, monkeypatch):
+    api_port = __free_port()
+    webhook_port = __free_port()
+    monkeypatch.setenv("workspace", str(__workspace(tmp_path, api_port, webhook_port)))
+    monkeypatch.syspath_prepend(str(root / "src"))
+    monkeypatch.syspath_prepend(str(root / "env"))
+    import fake_telegram
+    server = fake_telegram.serve(port=api_port)
+    spec = importlib.util.spec_from_file_location("tool_telecom", root / "src" / "tools" / "tool_telecom.py")
+    telecom = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(telecom)
+
+    async def run():
+        service = asyncio.create_task(telecom.telegram_service())
+        try:
+            deadline = time.monotonic() + 10
+            while "agent00" not in telecom.bot_apps and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            assert fake_telegram.webhooks[token][0] == f"http://127.0.0.1:{webhook_port}/telegram/agent00"
+            await asyncio.to_thread(__control, api_port, "message",
+                                    {"token": token, "chat_id": chat_id, "text": "/help"})
+            sent = []
+            while not sent and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+                sent = await asyncio.to_thread(__control, api_port, "sent", {"token": token})
+            return sent
+        finally:
+            service.cancel()
+            await asyncio.gather(service, return_exceptions=True)
+
+    try:
+        sent = asyncio.run(run())
+    finally:
+        server.shutdown()
+        sys.modules.pop("fake_telegram", None)
+    replies = [message for message in sent if message["method"].lower() == "sendmessage"]
+    assert replies and int(replies[0]["chat_id"]) == chat_id
+    assert replies[0]["text"].startswith("Help:")